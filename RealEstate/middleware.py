@@ -0,0 +1,83 @@
+## Query budget instrumentation
+## Every request records the number of SQL queries, the total database time and the queries which ran
+## more than once (same SQL with different parameters, the usual sign of an N+1 loop).
+## In DEBUG mode the numbers are added to the response headers, otherwise they are written to the log.
+
+from django.conf import settings
+from django.db import connections
+from contextlib import ExitStack
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# Requests with more queries than this are logged as warnings instead of info
+QUERY_BUDGET_WARNING = getattr(settings, 'QUERY_BUDGET_WARNING', 30)
+
+# "IN (%s, %s, %s)" and "IN (1, 2, 3)" give the same fingerprint whatever the number of items
+IN_LIST = re.compile(r'\bIN \([^()]*\)', re.IGNORECASE)
+NUMBER = re.compile(r'\b\d+\b')
+
+
+def query_fingerprint(sql):
+    sql = IN_LIST.sub('IN (...)', sql)
+    return NUMBER.sub('N', sql)
+
+
+class QueryRecorder():
+    # execute_wrapper for django.db.connection, collects (sql, duration) of every query
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(duration for sql, duration in self.queries)
+
+    def duplicates(self):
+        # {fingerprint: times} of the queries which ran more than once
+        counts = {}
+        for sql, duration in self.queries:
+            fingerprint = query_fingerprint(sql)
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+        return {fingerprint: times for fingerprint, times in counts.items() if times > 1}
+
+
+class QueryBudgetMiddleware():
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+
+        duplicates = recorder.duplicates()
+        if settings.DEBUG:
+            response['X-Query-Count'] = recorder.count
+            response['X-Query-Time-Ms'] = '{:.1f}'.format(recorder.total_time * 1000)
+            response['X-Query-Duplicates'] = sum(duplicates.values()) - len(duplicates)
+        else:
+            level = logging.WARNING if recorder.count > QUERY_BUDGET_WARNING else logging.INFO
+            logger.log(level, '{} {} {}: {} queries in {:.1f} ms, {} duplicated'.format(
+                            request.method, request.path, response.status_code, recorder.count,
+                            recorder.total_time * 1000, len(duplicates)),
+                       extra={'query_count': recorder.count,
+                              'query_time': recorder.total_time,
+                              'query_duplicates': duplicates})
+        return response
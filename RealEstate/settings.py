@@ -19,7 +19,8 @@ secret_file = 'RealEstateKEYS.txt'
 secrets = ['SECRET_KEY', 'DEBUG' , 'DATABASE_NAME', 'DATABASE_USERNAME', 'DATABASE_PASSWORD',
  'EMAIL_HOST', 'EMAIL_HOST_USER', 'EMAIL_HOST_PASSWORD', 'CHATGPT_API', 
  'TELEGRAM_DICTIONARY_BOT_TOKEN', 'TELEGRAM_TOPIC_BOT_TOKEN', 'TELEGRAM_BIRTHDAY_BOT_TOKEN',
- 'TELEGRAM_VOICE_BOT_TOKEN', 'TELEGRAM_ADMIN_CODE', 'REPLICATE_API_TOKEN', 'TELEGRAM_DUTCHING_BOT_TOKEN']
+ 'TELEGRAM_VOICE_BOT_TOKEN', 'TELEGRAM_ADMIN_CODE', 'REPLICATE_API_TOKEN', 'TELEGRAM_DUTCHING_BOT_TOKEN',
+ 'CACHE_LOCATION']
 SECRETS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 filepath = os.path.join(SECRETS_DIR, secret_file)
 secrets_dict = {}
@@ -111,6 +112,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     # Gzip Compression
     'django.middleware.gzip.GZipMiddleware',
+    # Query count, DB time and duplicated queries of each request (headers in DEBUG, log otherwise)
+    'RealEstate.middleware.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     # for debug analysis
     # 'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -184,6 +187,41 @@ DATABASES = {
     }
 }
 
+# Cache
+# Memcached is shared between the gunicorn workers, the cron jobs and the management commands (the service
+# 'memcached' of docker-compose.yml, CACHE_LOCATION in 'RealEstateKEYS.txt' is 'memcached:11211').
+# The rate limits of the Telegram bots and the cache counters need its atomic incr().
+# Without a CACHE_LOCATION (my local PC) a file based cache is used. It holds MAX_ENTRIES files (content versions,
+# facets, search results, page fragments, image versions, rate limit buckets...) and every set() lists them all,
+# its incr() is not atomic between processes either, so the rate limits are only approximate with it.
+CACHE_LOCATION = secrets_dict['CACHE_LOCATION']
+if CACHE_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': CACHE_LOCATION,
+            'OPTIONS': {
+                'no_delay': True,
+                # A cache which is down is a miss, not an error of the page
+                'ignore_exc': True,
+                'max_pool_size': 4,
+                'use_pooling': True,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache'),
+            'OPTIONS': {
+                'MAX_ENTRIES': 50000,
+                # A full cache deletes a tenth of the files, not a third
+                'CULL_FREQUENCY': 10,
+            },
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -370,6 +408,14 @@ LOGGING = {
             'backupCount': 5,
             'formatter': 'verbose',
         },
+        'queries_file': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.path.join(BASE_DIR, 'logs/queries.log'),
+            'maxBytes': 1024 * 1024 * 10,  # 10MB
+            'backupCount': 2,
+            'formatter': 'verbose',
+        },
         'mail_admins': {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
@@ -416,6 +462,12 @@ LOGGING = {
             'level': 'WARNING',  # Changed from INFO to WARNING to reduce log volume
             'propagate': False,
         },
+        # Query budget of each request (RealEstate/middleware.py)
+        'RealEstate.middleware': {
+            'handlers': ['queries_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         # Add specific logger for telegramApp
         'apps.telegramApp': {
             'handlers': ['console', 'telegram_file', 'mail_admins'],
@@ -426,6 +478,45 @@ LOGGING = {
 }
 
 
+# Previous/Next cursor links instead of numbered pages on the list and search pages (baseApp/pagination.py)
+# Links with ?cursor= work either way, old ?page= links always use numbered pages
+CURSOR_PAGINATION = False
+
+# Requests with more SQL queries than this are logged as warnings
+QUERY_BUDGET_WARNING = 30
+
+# Threads per process which make the WebP/JPEG derivatives of the uploaded images after the save
+# 0 makes them in the request of the save, after the commit (apps/baseApp/images.py)
+IMAGE_DERIVATIVE_WORKERS = 1
+
+# 'inline': the Telegram webhook runs the bot before it answers
+# 'queue': the webhook saves the update and answers at once, the bots run in the worker command
+# python manage.py process_telegram_updates (apps/telegramApp/update_queue.py)
+TELEGRAM_WEBHOOK_MODE = 'inline'
+
+# Outbound limits of the Telegram sends as (messages, seconds), shared by all processes through the cache
+# 'global' is per bot token, 'chat' per chat of a bot (apps/telegramApp/bots/rate_limit.py)
+TELEGRAM_RATE_LIMITS = {'global': (25, 1), 'chat': (20, 60)}
+
+# Voice messages transcribed at the same time in a process, and how many more may wait for a thread
+# 0 workers transcribe before the webhook answers (apps/telegramApp/transcription_jobs.py)
+TELEGRAM_VOICE_WORKERS = 2
+TELEGRAM_VOICE_QUEUE = 8
+
+# Transcripts of the voice messages kept for a forwarded message: entries and days without a use
+# (apps/telegramApp/transcript_cache.py)
+TELEGRAM_VOICE_CACHE_ENTRIES = 10000
+TELEGRAM_VOICE_CACHE_DAYS = 180
+
+# OpenAI answers of the dictionary and phrase bots kept in the database: days until they expire and entries
+# (apps/telegramApp/answer_cache.py)
+TELEGRAM_ANSWER_CACHE_DAYS = 30
+TELEGRAM_ANSWER_CACHE_ENTRIES = 20000
+
+# New answers of the dictionary and phrase bots are shown while OpenAI writes them, by edits of the message
+# (apps/telegramApp/bots/streaming.py)
+TELEGRAM_STREAM_ANSWERS = True
+
 # This helps to get the errors even if the DEBUG is False
 DEBUG_PROPAGATE_EXCEPTIONS = True
 
@@ -433,6 +524,24 @@ DEBUG_PROPAGATE_EXCEPTIONS = True
 CRONJOBS = [
     # Run birthday reminders every day at 9:00 AM
     ('0 9 * * *', 'apps.telegramApp.cron.send_automatic_birthday_reminders'),
+
+    # Delete the abandoned wizard states of the Telegram bots every hour
+    ('30 * * * *', 'apps.telegramApp.cron.sweep_abandoned_states'),
+
+    # The image derivatives which were not made after the upload (e.g. the process was restarted)
+    ('*/15 * * * *', 'django.core.management.call_command', ['generate_image_derivatives'], {'workers': 1}),
+
+    # Send the Telegram messages which were rate limited
+    ('* * * * *', 'apps.telegramApp.cron.send_deferred_messages'),
+
+    # Start again the voice transcriptions whose process died
+    ('*/5 * * * *', 'apps.telegramApp.cron.resume_voice_jobs'),
+
+    # Evict the old voice transcripts every night
+    ('15 4 * * *', 'apps.telegramApp.cron.evict_voice_transcripts'),
+
+    # Ask again for the most frequent dictionary and phrase answers before they expire, prune the cache
+    ('45 4 * * *', 'apps.telegramApp.cron.refresh_answer_cache'),
     
     # You can add more scheduled jobs here as needed
     # Format: ('cron schedule', 'path.to.function', ['args'], {kwargs})
@@ -48,3 +48,24 @@ def param_replace(context, **kwargs):
     for k in [k for k, v in d.items() if not v]:
         del d[k]
     return d.urlencode()
+
+
+@register.simple_tag(takes_context=True)
+def cursor_replace(context, cursor):
+    """
+    The ``param_replace`` of the cursor pages: the current parameters with the
+    cursor token of the next or previous page, and without ``page``.
+
+    <a href="?{% cursor_replace page_obj.next_cursor %}">Next</a>
+    """
+    return param_replace(context, cursor=cursor, page='')
+
+
+@register.filter
+def get_item(dictionary, key):
+    """
+    Return the value of ``key`` from a dictionary, e.g. the facet counts:
+
+    {{ facetCounts.region|get_item:region.id }}
+    """
+    return dictionary.get(key, 0)
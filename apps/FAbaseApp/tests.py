@@ -1,3 +1,18 @@
 from django.test import TestCase
+from apps.baseApp.tests import QueryBudgetTestCase
 
 # Create your tests here.
+
+class FAbaseAppQueryBudgetTest(QueryBudgetTestCase):
+
+    def get_budgets(self):
+        return {
+            '/fa/': 18,
+            '/fa/املاک/': 18,
+            '/fa/املاک/?region_select={}&bedroom_select=1&bedroom_select=2&propertyType_select=ویلا'
+            '&sort=price-descending'.format(self.catalog['regions'][1].pk): 20,
+            '/fa/املاک/{}/'.format(self.catalog['assets'][0].pk): 19,
+            '/fa/درباره-ما/': 13,
+            '/fa/سوالات-متداول/همه/': 16,
+            '/fa/FAQsearch/?s=apartment': 17,
+        }
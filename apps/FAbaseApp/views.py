@@ -3,14 +3,11 @@
 ## The extraContent part is also has some customized changes for FA language
 
 # Import models from baseApp
-from apps.baseApp import models
+from apps.baseApp import models, shared_context, facets, search_spec, list_views, detail_cache
 from . import forms
 from django.shortcuts import render
 from django.views import generic
-from django.conf import settings
-# This app has its own blog model
-from apps.blogApp import models as blogAppModel
-from django.db.models import Max, Min, Q
+from django.core.paginator import Paginator
 from django.urls import reverse_lazy, reverse
 
 
@@ -28,46 +25,25 @@ COMPLEX_FEATURES_CATEGORY = {'GENERAL': 'عمومی',
 
 
 # Here is the Extra Context ditionary which is used in get_context_data of Views classes
+# It is built once per language and cached, see baseApp/shared_context.py
 def get_extra_context():
-    extraContext = {
-        'DEBUG_VALUE': settings.DEBUG,
-        'regions': models.Region.objects.filter(regions__complexes__active=True).distinct(),
-        'propertyTypeNames': [obj[1] for obj in ASSET_TYPES],
-        'tagType': set([obj.get_tag_display() for obj in models.Asset.objects.all()]),
-        'bedroomNumbers': models.Bedroom.objects.order_by('number'),
-        'spaceRange': models.Asset.objects.filter(active=True).aggregate(Min('build_area'), Max('build_area')),
-        # ********for later expansion*********
-        # context['priceRangeRent'] = models.Asset.objects.filter(tag__exact='FR').aggregate(Min('price'), Max('price'))
-        'priceRange': models.Asset.objects.filter(active=True).aggregate(Min('price'), Max('price')),
-        # Featured part of the page
-        'featuredProperties': models.Asset.objects.filter(featured=True),
-        # Blog models for FA Posts
-        'blogPosts': blogAppModel.Post.objects.filter(status=True, language='FA', featured=True),
-        # Blog Categories with EN language filter
-        'blogCategories': blogAppModel.PostCategories.objects.filter(category_lang='FA').exclude(pk__in=[24, 27, 30]),
-        # Item for Navbar from Blog CategoryListView
-        'blogCategoriesNav': blogAppModel.PostCategories.objects.filter(category_lang='FA', pk__in=[24, 27, 30]),
-        # Apartments Unqiue names
-        'apartments': models.Complex.objects.filter(hide_name=False),
-        # Default page for FAQ section.
-        'navbar_FAQ': 'all'
-        }
+    extraContext = shared_context.get_shared_context('FA')
+    # Property types are always shown with their FA names
+    extraContext['propertyTypeNames'] = [obj[1] for obj in ASSET_TYPES]
     return extraContext
 
 
 
 # Index View
-class IndexView(generic.ListView):
+class IndexView(list_views.MemoListView):
     context_object_name = 'assets_all'
     template_name = 'FAbaseApp/index.html'
     model = models.Asset
 
-    def get_queryset(self):
-        result = super(IndexView, self).get_queryset()
-
+    def filter_queryset(self, queryset):
         # Filter all inactive assets at the beginning.
-        result = result.filter(active=True)
-        return result
+        # The search box only shows the reference numbers of them
+        return queryset.filter(active=True).only('id')
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -75,132 +51,37 @@ class IndexView(generic.ListView):
         # Append extraContext
         context.update(get_extra_context())
         context['slideContent'] = models.Slide.objects.filter(useFor__exact='HOME', active__exact=True)
+        # Number of active listings per region, bedroom, apartment, ... for the search box
+        context['facetCounts'] = facets.get_facet_counts()
         return context
 
 # Search Box - searchResult.html
-class AssetFilterView(generic.ListView):
+class AssetFilterView(list_views.MemoListView):
     context_object_name = 'assets_filtered'
     model = models.Asset
     template_name = 'FAbaseApp/property_list.html'
     paginate_by = 9
+    select_related = ['complex__region', 'bedroom']
+    count_results = True
 
-    def get_queryset(self):
-        result = super(AssetFilterView, self).get_queryset()
+    def get_search_spec(self):
+        # The GET request is parsed only once per request
+        if not hasattr(self, 'search_spec'):
+            self.search_spec = search_spec.SearchSpec.from_query(self.request.GET, ASSET_TYPES)
+        return self.search_spec
 
-        # Filter all inactive assets at the beginning.
-        result = result.filter(active=True)
-
-        # Get Requests
-        region_query = self.request.GET.getlist('region_select') # value=[list of marked regions]
-        propertyType_query = self.request.GET.getlist('propertyType_select')
-        bedroom_query = self.request.GET.getlist('bedroom_select') # value=[0, 1, 3]
-        tag_query = self.request.GET.get('tag_select') # value='sale'
-        price_query = self.request.GET.getlist('price_select') # value=[minValue, MaxValue]
-        space_query = self.request.GET.getlist('space_select') # value=[minValue, MaxValue]
-        orderby_query = self.request.GET.get('sort')
-        reference_query = self.request.GET.getlist('ref_select')
-        apartment_query = self.request.GET.getlist('apartment_select')
-        installment_query = self.request.GET.get('installment_select')
-
-        # CONVERT some Queries
-        # Convert the property type into model Format ('FL', 'Flat')
-        # in queries you will use short formats i.e. 'FL'
-        edited_propertyType = []
-        for type in propertyType_query:
-            for t in ASSET_TYPES:
-                if type == t[1]:
-                    edited_propertyType.append(t[0])
-                    break
-        propertyType_query = edited_propertyType
-
-        # Process the Reference Codes to match with database pk
-        edited_reference = []
-        for r in reference_query:
-            edited_reference.append(r[6:])
-        reference_query = edited_reference
-
-        # FILTERs based on queries
-        # Regions
-        if not(region_query==None or region_query=='' or region_query==[]):
-            # First build the list of all OR queries
-            ### another method is:
-            ### from functools import reduce
-            ### from operator import or_
-            ### query = reduce(or_, (Q(type__type=t) for t in types))
-            ### projects.filter(query)
-            # You need to build a Q with the first item and add other Qs to the tempQuery
-            tempQuery = Q(complex__region__pk=int(region_query[0]))
-            for regionId in region_query[1:]:
-                tempQuery |= Q(complex__region__pk=int(regionId))
-            result = result.filter(tempQuery)
-
-        # Property Types
-        if not(propertyType_query==[] or propertyType_query=='' or propertyType_query==None):
-            tempQuery = Q(type=propertyType_query[0])
-            for propertytype in propertyType_query[1:]:
-                tempQuery |= Q(type=propertytype)
-            result = result.filter(tempQuery)
-
-        # Apartment Names
-        if not(apartment_query==[] or apartment_query=='' or apartment_query==None):
-            tempQuery = Q(complex__id=int(apartment_query[0]))
-            for apartment in apartment_query[1:]:
-                tempQuery |= Q(complex__id=int(apartment))
-            result = result.filter(tempQuery)
-
-        # Reference Code
-        if not(reference_query==[] or reference_query=='' or reference_query==None):
-            tempQuery = Q(pk=int(reference_query[0]))
-            for ref in reference_query[1:]:
-                tempQuery |= Q(pk=int(ref))
-            # print(tempQuery)
-            result = result.filter(tempQuery)
-
-        # Installment
-        if not(installment_query=='' or installment_query==None):
-            if (installment_query=='1'):
-                result = result.filter(installment__exact=True)
-
-        # Bedrooms
-        if not(bedroom_query=='' or bedroom_query==None or bedroom_query==[]):
-            # You need to build a Q with the first item and add other Qs to the tempQuery
-            tempQuery = Q(bedroom__number=int(bedroom_query[0]))
-            for bedroomNo in bedroom_query[1:]:
-                tempQuery |= Q(bedroom__number=int(bedroomNo))
-            result = result.filter(tempQuery)
-
-        # Tag Deal
-        # Using "Ordering" on the Properties Page will cause this filter to be implemented by Sale or Rent values.
-        # First check if the Queryset is less than 3 items. (only "sort" and "page" request are generated by OrderBy button )
-        if not(tag_query=='' or tag_query==None):
-            if (tag_query=='sale'):
-                result = result.filter(tag__exact='FS')
-            elif (tag_query=='rent'):
-                result = result.filter(tag__exact='FR')
-            else: pass
-
-        # Price
-        if not(price_query=='' or price_query==None or price_query==[]):
-            if not(price_query[0]==''):
-                result = result.filter(price__gte=float(price_query[0]), price__lte=float(price_query[1]))
-
-        # Space Area
-        if not(space_query=='' or space_query==None or space_query==[]):
-            if not(space_query[0]==''):
-                result = result.filter(build_area__gte=float(space_query[0]), build_area__lte=float(space_query[1]))
-
-        # Order By (it should be the last thing in query section of this code)
-        if not(orderby_query=='' or orderby_query==None):
-            if orderby_query == 'price-ascending':
-                result =  result.order_by('price')
-            if orderby_query == 'price-descending':
-                result =  result.order_by('-price')
-            if orderby_query == 'date-newest':
-                result =  result.order_by('-created')
-            if orderby_query == 'date-oldest':
-                result =  result.order_by('created')
-        return result
+    def filter_queryset(self, queryset):
+        # The queryset of the cursor pages, they read the page with the filters of the search
+        return self.get_search_spec().apply(queryset)
 
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        # The numbered pages are slices of the cached result ids, only the Assets of the page are read
+        return Paginator(self.get_search_spec().results(queryset), per_page, orphans=orphans,
+                         allow_empty_first_page=allow_empty_first_page, **kwargs)
+
+    def get_result_count(self):
+        # The number of the cached ids, no COUNT query
+        return len(self.get_search_spec().result_ids())
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -208,67 +89,16 @@ class AssetFilterView(generic.ListView):
         # Append extraContext
         context.update(get_extra_context())
 
-        # result count
-        context['resultCount'] = len(self.get_queryset())
         # An slide picture for Search Result page. This need just one slide >> id= ?
         context['slideContent'] = models.Slide.objects.get(useFor__exact='PROPERTY_SEARCH', active__exact=True)
         context['pageTitle'] = 'املاک'
-        context['assets_all'] = models.Asset.objects.filter(active=True)
+        context['assets_all'] = models.Asset.objects.filter(active=True).only('id')
+        # Number of listings per region, bedroom, apartment, ... for the current search
+        context['facetCounts'] = facets.get_facet_counts(self.get_search_spec().facet_selection())
 
     ####### Filtered Items Part #######
-        # Building a dictionary of GET request with nice words in order to present them in the search result page.
-        # The reason for this line of code is to convert the [1,2,3,4,...] region_select to its real region names from Model
-        if not(self.request.GET.getlist('region_select')==[] or self.request.GET.getlist('region_select')==None):
-            regions_pks = self.request.GET.getlist('region_select')
-            regionRequest = []
-            for pk in regions_pks:
-                regionRequest.append(models.Region.objects.get(pk=pk).name)
-        else: regionRequest = 'no filter'
-
-        # The reason for this line of code is to convert the [0,1,2,3,4,...] room_select to its descrptions from Model
-        if not(self.request.GET.getlist('bedroom_select')==[] or self.request.GET.getlist('bedroom_select')==None):
-            bedroom_codes = self.request.GET.getlist('bedroom_select')
-            bedroomRequest = []
-            for num in bedroom_codes:
-                bedroomRequest.append(models.Bedroom.objects.get(number=num).description_FA)
-        else: bedroomRequest = 'no filter'
-
-        # check if the Price slider is empty
-        if not(self.request.GET.getlist('price_select')==[] or self.request.GET.getlist('price_select')==None):
-            priceRequest = {'min': self.request.GET.getlist('price_select')[0],
-                            'max': self.request.GET.getlist('price_select')[1]}
-        else: priceRequest = 'no filter'
-
-        # check if the Space slider is empty
-        if not(self.request.GET.getlist('space_select')==[] or self.request.GET.getlist('space_select')==None):
-            spaceRequest = {'min': self.request.GET.getlist('space_select')[0],
-                            'max': self.request.GET.getlist('space_select')[1]}
-        else: spaceRequest = 'no filter'
-
-        # Just to check if the request is empty, returns 'no filter'
-        if not(self.request.GET.get('tag_select')==[] or self.request.GET.get('tag_select')==None):
-            deal_codes = self.request.GET.get('tag_select')
-            if deal_codes == 'Sale':
-                dealRequest = 'خرید'
-            else: dealRequest = 'اجاره'
-        else: dealRequest = 'no filter'
-
-        # Just to check if the request is empty, returns 'no filter'
-        if not(self.request.GET.getlist('propertyType_select')==[] or self.request.GET.getlist('propertyType_select')==None):
-            typeRequest = set(self.request.GET.getlist('propertyType_select'))
-        else: typeRequest = 'no filter'
-
-        # Put all the above cleaned Requested items into one dictionary to use in Template context
-        Qdetail_dict = {
-                        'QdealType': dealRequest,
-                        'Qregions': regionRequest,
-                        'QpropertyTypes': typeRequest,
-                        'Qprices': priceRequest,
-                        'Qspace': spaceRequest,
-                        'Qroom': bedroomRequest,
-                        }
-
-        context['Qdetail'] = Qdetail_dict
+        # Building a dictionary of the search with nice words in order to present them in the search result page.
+        context['Qdetail'] = self.get_search_spec().describe('FA', ASSET_TYPES)
 
         # context['test'] = models.Asset.objects.values_list('bedroom', flat=True).distinct().order_by('bedroom')
 
@@ -286,23 +116,25 @@ class AssetSingleView(generic.edit.FormMixin, generic.DetailView):
     def get_success_url(self):
             return reverse('FAbaseApp:propertyView', kwargs={'pk': self.object.pk})
 
+    def get_queryset(self):
+        # The title, the hero section and the sidebar need the complex, region, city and bedroom
+        return super().get_queryset().select_related('complex__region__city', 'bedroom')
+
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
         context = super().get_context_data(**kwargs)
         # Append extraContext
         context.update(get_extra_context())
         # Using the same image as the Asset has for its thumbnail
-        context['slideContent'] = self.get_object()
-        context['assets_all'] = models.Asset.objects.all()
+        context['slideContent'] = self.object
+        context['assets_all'] = models.Asset.objects.all().only('id')
         context['form'] = self.get_form()
-        # Categorize the features to be used in template
-        # create a dictionary of Categories with a list of related features
-        complex_features = {}
-        categories = [i['category'] for i in self.object.complex.features.values('category')]
-        for category in categories:
-            complex_features[COMPLEX_FEATURES_CATEGORY[category]] = [i['features_FA'] for i in self.object.complex.features.values('features_FA').filter(category=category)]
-        # this value is a dictionary itself >>> {'GENERAL': ['Elevator'], 'SPORT': ['Gym', 'Pool'], 'TOP': ['Supermarket']}
-        context['apartment_features'] = complex_features
+        # Pictures, features, near places and the features of the complex for the cached body of the page,
+        # they are loaded only if the body is not in the cache, see baseApp/detail_cache.py
+        # detail.complex_features >>> {'عمومی': ['آسانسور'], 'ورزشی': ['باشگاه', 'استخر']}
+        context['detail'] = detail_cache.AssetDetail(self.object, 'features_FA', COMPLEX_FEATURES_CATEGORY)
+        # The share links are part of the cached body, without the query string of this request
+        context['share_url'] = self.request.build_absolute_uri(self.request.path)
         return context
 
     # Form POST
@@ -342,15 +174,13 @@ class ContactView(generic.edit.FormView):
 
 # FAQ - faq-category.html
 # The FAQ part has only a List of questions per category. There is no detail view for each question.
-class FAQCategoryView(generic.ListView):
+class FAQCategoryView(list_views.MemoListView):
 
     context_object_name = 'questions'
     model = models.FAQ
     template_name = 'FAbaseApp/faq-category.html'
 
-    def get_queryset(self, **kwargs):
-        result = super(FAQCategoryView, self).get_queryset()
-
+    def filter_queryset(self, result):
         # Categories -- For filtering based on the categories
         result= result.filter(language='FA', categories__slug=self.kwargs['category'], active=True).order_by('priorities')
         return result
@@ -368,11 +198,11 @@ class FAQCategoryView(generic.ListView):
         context['all_categories'] = models.FAQCategories.objects.filter(category_lang='FA')
         # Structred Questions - This for making structured data in templates
         # The problem is to use the last Item of queryset without comma
-        currentQueryset = self.get_queryset()
-        currentQuerysetCount = len(currentQueryset)
-        if currentQuerysetCount > 0:
-            context['excludedLastQuestion'] = currentQueryset[:currentQuerysetCount-1]
-            context['lastQuestion'] = currentQueryset[currentQuerysetCount-1]
+        # The questions are already loaded for the page, they are split without another query
+        questions = self.get_rows()
+        if questions:
+            context['excludedLastQuestion'] = questions[:-1]
+            context['lastQuestion'] = questions[-1]
         # This is for Title Tag in the head section of the html
         if self.kwargs['category'] == 'all':
             context['titleTag'] = models.FAQCategories.objects.get(id=6)
@@ -385,20 +215,20 @@ class FAQCategoryView(generic.ListView):
         questions_query = self.get_queryset()
         return render(request, 'FAbaseApp/includes/questions.html', {'questions': questions_query})
 
-class FAQSearch(generic.ListView):
+class FAQSearch(list_views.FullTextSearchView):
     context_object_name = 'questions'
     template_name = 'FAbaseApp/faq-category.html'
     model = models.FAQ
     paginate_by = 15
+    search_kind = 'FAQ'
+    search_language = 'FA'
 
-    def get_queryset(self, **kwargs):
-        result = super(FAQSearch, self).get_queryset()
-
+    def filter_queryset(self, result):
         # Get the GET content >>> name='s'
         keyword = self.request.GET.get('s')
         if not(keyword==None or keyword==''):
-            # Content Search -- For filtering based on the Text Search
-            result= result.filter(Q(question__icontains=keyword) | Q(answer__icontains=keyword), language='FA', active=True).order_by('-created')
+            # Full-text Search -- The best matches first, a page at a time, see FullTextSearchView
+            result= result.filter(language='FA', active=True)
 
         return result
 
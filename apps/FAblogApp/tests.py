@@ -1,3 +1,13 @@
 from django.test import TestCase
+from apps.baseApp.tests import QueryBudgetTestCase
 
 # Create your tests here.
+
+class FAblogAppQueryBudgetTest(QueryBudgetTestCase):
+    budgets = {
+        '/fa/راهنمای-ترکیه/': 16,
+        '/fa/راهنمای-ترکیه/?page=2': 16,
+        '/fa/راهنمای-ترکیه/category/اخبار/': 16,
+        '/fa/راهنمای-ترکیه/اخبار-post-0/': 15,
+        '/fa/راهنمای-ترکیه/search/keyword/?s=hello': 16,
+    }
@@ -9,34 +9,24 @@ from django.views import generic
 from apps.blogApp import models
 # This is for showing properties on blog pages
 from apps.baseApp import models as baseAppModel
-from django.db.models import Q
+from apps.baseApp import shared_context, list_views, fulltext
+from django.db.models import F
 from django.views import generic
-from django.conf import settings
 
 
 
 # Here is the Extra Context ditionary which is used in get_context_data of Views classes
+# It is built once per language and cached, see baseApp/shared_context.py
 def get_extra_context():
-    extraContext = {
-        'DEBUG_VALUE': settings.DEBUG,
-        'featuredProperties': baseAppModel.Asset.objects.filter(featured=True),
-        # All blog categories
-        'blogCategories_All': models.PostCategories.objects.filter(category_lang='FA'),
-        # Blog Categories with EN language filter
-        'blogCategories': models.PostCategories.objects.filter(category_lang='FA').exclude(pk__in=[24, 27, 30]),
-        # Item for Navbar from Blog CategoryListView
-        'blogCategoriesNav': models.PostCategories.objects.filter(category_lang='FA', pk__in=[24, 27, 30]),
-        # Default page for FAQ section.
-        'navbar_FAQ': 'all'
-        }
-    return extraContext
-
-
-class PostList(generic.ListView):
+    return shared_context.get_shared_context('FA')
+
+
+class PostList(list_views.MemoListView):
     context_object_name = 'allPosts'
     queryset = models.Post.objects.filter(language='FA', status=True).order_by('-created_on')
     template_name = 'FAblogApp/blog.html'
     paginate_by = 3
+    prefetch_related = ['categories']
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -50,15 +40,15 @@ class PostList(generic.ListView):
         return context
 
 
-class CategoryListView(generic.ListView):
+class CategoryListView(list_views.MemoListView):
         context_object_name = 'allPosts'
         model = models.Post
         template_name = 'FAblogApp/search_result.html'
         paginate_by = 8
+        select_related = ['author']
+        count_results = True
 
-        def get_queryset(self, **kwargs):
-            result = super(CategoryListView, self).get_queryset()
-
+        def filter_queryset(self, result):
             # Categories -- For filtering based on the categories
             result= result.filter(language='FA', categories__slug=self.kwargs['category'], status=True).order_by('-created_on')
             return result
@@ -73,8 +63,6 @@ class CategoryListView(generic.ListView):
             # This title is different for this view
             context['pageTitle'] = models.PostCategories.objects.get(slug=self.kwargs['category']).category
             context['slideContent'] = models.PostCategories.objects.get(slug=self.kwargs['category'])
-            # result counte
-            context['resultCount'] = len(self.get_queryset())
             return context
 
 
@@ -85,8 +73,9 @@ class PostDetail(generic.DetailView):
 
     def get_object(self, **kwargs):
         singleResult = self.model.objects.get(slug=self.kwargs['slug'], status=True)
-        # To implement save method on the model which adds view count
-        singleResult.save()
+        # Add one view count with a single UPDATE. Calling save() here would send post_save on every visit
+        # and invalidate the cached shared context (see baseApp/signals.py)
+        self.model.objects.filter(pk=singleResult.pk).update(view=F('view') + 1)
         return singleResult
 
     def get_context_data(self, **kwargs):
@@ -97,24 +86,26 @@ class PostDetail(generic.DetailView):
 
         # This view have no pageTitle
         # Get the first PostCategories object of the current post
-        context['slideContent'] = self.get_object().categories.first()
+        context['slideContent'] = self.object.categories.first()
         return context
 
 
-class PostSearch(generic.ListView):
+class PostSearch(list_views.FullTextSearchView):
     context_object_name = 'allPosts'
     template_name = 'FAblogApp/search_result.html'
     model = models.Post
     paginate_by = 8
+    search_kind = 'POST'
+    search_language = 'FA'
+    select_related = ['author']
+    count_results = True
 
-    def get_queryset(self, **kwargs):
-        result = super(PostSearch, self).get_queryset()
-
+    def filter_queryset(self, result):
         # Get the GET content >>> name='s'
         keyword = self.request.GET.get('s')
         if not(keyword==None or keyword==''):
-            # Content Search -- For filtering based on the Text Search
-            result= result.filter(Q(title__icontains=keyword) | Q(content__icontains=keyword), language='FA', status=True).order_by('-created_on')
+            # Full-text Search -- The best matches first, a page at a time, see FullTextSearchView
+            result= result.filter(language='FA', status=True)
 
         return result
 
@@ -127,6 +118,9 @@ class PostSearch(generic.ListView):
         # This title is different for this view
         context['pageTitle'] = 'جستجوی مطالب'
         context['slideContent'] = baseAppModel.Slide.objects.get(useFor__exact='BLOG_SEARCH', active__exact=True)
-        # result counte
-        context['resultCount'] = len(self.get_queryset())
+        # The parts of the posts with the searched words, instead of the short content
+        posts = self.get_rows()
+        snippets = fulltext.snippets('POST', 'FA', self.request.GET.get('s'), [post.pk for post in posts])
+        for post in posts:
+            post.snippet = snippets.get(post.pk)
         return context
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MainAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.baseApp'
+
+    def ready(self):
+        # Connect the cache invalidation signals
+        from . import signals
@@ -0,0 +1,96 @@
+## Render cache of the property detail pages (EN and FA)
+## The body of a detail page (pictures, overview, features, near places, complex and region tabs) is cached as
+## a template fragment ({% cache %} in property_detail.html), per language and per Asset.
+## The key is made of the Asset id, Asset.updated and three change versions:
+## - the Asset version: the Asset, its images or its features changed (Asset.updated is only a date),
+## - the Complex version: the Complex, its distances or its features changed,
+## - the shared version: a Region, Location, Bedroom or a feature name changed, these are used by many pages.
+## The versions are bumped by signals.py. The messages, the contact form and the search sidebar stay dynamic.
+##
+## On a cache hit nothing of AssetDetail is read, so the page needs no queries for the body at all.
+
+from django.core.cache import cache
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils.functional import cached_property
+from . import models, images as image_info
+import uuid
+
+# The fragments are replaced by a new key on every change, the timeout only frees the cache of old keys
+DETAIL_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+SHARED_KEY = 'detail:shared'
+
+
+def asset_key(pk):
+    return 'detail:asset:{}'.format(pk)
+
+
+def complex_key(pk):
+    return 'detail:complex:{}'.format(pk)
+
+
+def bump(key):
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def bump_asset(pk):
+    bump(asset_key(pk))
+
+
+def bump_complex(pk):
+    bump(complex_key(pk))
+
+
+def bump_shared():
+    bump(SHARED_KEY)
+
+
+class AssetDetail():
+    # The data of the page body, every part is read from the database only when the fragment is rendered
+    timeout = DETAIL_CACHE_TIMEOUT
+
+    def __init__(self, asset, feature_field='features', category_names=None):
+        self.asset = asset
+        self.feature_field = feature_field
+        self.category_names = category_names or {}
+
+    @cached_property
+    def version(self):
+        # One cache round trip for the three versions
+        keys = [asset_key(self.asset.pk), complex_key(self.asset.complex_id), SHARED_KEY]
+        versions = cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                versions[key] = uuid.uuid4().hex
+                cache.set(key, versions[key], None)
+        return ':'.join(versions[key] for key in keys)
+
+    @cached_property
+    def loaded(self):
+        prefetch_related_objects([self.asset], 'images', 'features', 'complex__features',
+                                 Prefetch('complex__distances', queryset=models.Distance.objects.select_related('location')))
+        return self.asset
+
+    @cached_property
+    def images(self):
+        pictures = list(self.loaded.images.all())
+        # The sizes of all the pictures with one query
+        image_info.prefetch(picture.image.name for picture in pictures if picture.image)
+        return pictures
+
+    @cached_property
+    def features(self):
+        return list(self.loaded.features.all())
+
+    @cached_property
+    def distances(self):
+        return list(self.loaded.complex.distances.all())
+
+    @cached_property
+    def complex_features(self):
+        # {category: [feature names]} in the order of the features, e.g. {'GENERAL': ['Elevator'], 'SPORT': ['Gym', 'Pool']}
+        grouped = {}
+        for feature in self.loaded.complex.features.all():
+            category = self.category_names.get(feature.category, feature.category)
+            grouped.setdefault(category, []).append(getattr(feature, self.feature_field))
+        return grouped
@@ -0,0 +1,218 @@
+## Facet counts for the property search (how many active listings match each region, complex, type, ...)
+## A compact row per active Asset is kept in memory, so the counts for any filter selection are computed without
+## aggregate queries. The rows are shared through the cache in two parts:
+## - the index, all rows as the database had them when build_index() read them, with the number of the last change
+##   which was made before (the change counter of the cache),
+## - a change per saved or deleted Asset (signals.py): the counter is incremented (atomic, one cache key) and the new
+##   row (None for a removed one) is saved under the number it got. A save never writes the whole index.
+## Every process applies the changes after its copy of the index in their order. After MAX_CHANGES changes, or when
+## a change is lost, one process (LOCK_KEY) builds the index from the database again.
+##
+## A selection is a dictionary with any of these keys:
+## {'region': [ids], 'complex': [ids], 'type': ['FL'], 'tag': 'FS', 'bedroom': [numbers],
+##  'installment': True, 'price': (min, max), 'area': (min, max), 'reference': [pks]}
+
+from django.core.cache import cache
+from . import models
+import uuid
+
+
+INDEX_KEY = 'facets:index'
+VERSION_KEY = 'facets:version'
+CHANGES_KEY = 'facets:changes'
+LOCK_KEY = 'facets:building'
+# Changes which are applied on top of the index before it is built again
+MAX_CHANGES = 500
+# A change lives long enough for every process to apply it
+CHANGE_TTL = 24 * 60 * 60
+LOCK_TTL = 60
+
+# Bucket edges, the last bucket has no upper limit
+PRICE_BUCKETS = [0, 500000, 1000000, 2000000, 5000000, 10000000]
+AREA_BUCKETS = [0, 50, 100, 150, 200, 300]
+
+# Row layout: (pk, region, complex, type, tag, bedroom, installment, price, area)
+PK, REGION, COMPLEX, TYPE, TAG, BEDROOM, INSTALLMENT, PRICE, AREA = range(9)
+
+FACETS = ['region', 'complex', 'type', 'tag', 'bedroom', 'installment', 'price', 'area']
+
+# Rows of this process: the version of the index they come from and the number of the last change applied
+_local_index = {'version': None, 'change': 0, 'rows': None}
+
+
+def asset_row(asset):
+    return (asset.pk, asset.complex.region_id, asset.complex_id, asset.type, asset.tag, asset.bedroom.number,
+            asset.installment, float(asset.price), asset.build_area)
+
+
+def change_key(number):
+    return 'facets:change:{}'.format(number)
+
+
+def last_change():
+    return cache.get(CHANGES_KEY) or 0
+
+
+def build_rows():
+    assets = models.Asset.objects.filter(active=True).order_by().values_list(
+        'pk', 'complex__region_id', 'complex_id', 'type', 'tag', 'bedroom__number', 'installment', 'price', 'build_area')
+    return {row[PK]: row[:PRICE] + (float(row[PRICE]), row[AREA]) for row in assets}
+
+
+def build_index():
+    # The counter is read first. A change after it may already be in the rows, it is applied again anyway
+    # (a change holds the whole row of the Asset, applying it twice is the same as once)
+    cache.add(CHANGES_KEY, 0, None)
+    change = last_change()
+    rows = build_rows()
+    version = uuid.uuid4().hex
+    cache.set(INDEX_KEY, {'version': version, 'change': change, 'rows': rows}, None)
+    cache.set(VERSION_KEY, version, None)
+    return version, change, rows
+
+
+def rebuild():
+    # One process builds the index, the other ones go on with the rows they have
+    if not cache.add(LOCK_KEY, 1, LOCK_TTL):
+        return False
+    try:
+        version, change, rows = build_index()
+    finally:
+        cache.delete(LOCK_KEY)
+    _local_index.update(version=version, change=change, rows=rows)
+    return True
+
+
+def load_index():
+    version = cache.get(VERSION_KEY)
+    index = cache.get(INDEX_KEY) if version is not None else None
+    if index is not None and index['version'] == version:
+        # A copy, the changes are applied to the rows of this process only
+        _local_index.update(version=version, change=index['change'], rows=dict(index['rows']))
+    elif not rebuild() and _local_index['rows'] is None:
+        # Another process is building the index and this one has no rows yet
+        change = last_change()
+        _local_index.update(version=None, change=change, rows=build_rows())
+
+
+def apply_changes(last):
+    first = _local_index['change'] + 1
+    if last < first:
+        return
+    if last - first >= MAX_CHANGES:
+        rebuild()
+        return
+    keys = [change_key(number) for number in range(first, last + 1)]
+    changes = cache.get_many(keys)
+    rows = _local_index['rows']
+    for number, key in enumerate(keys, first):
+        if key not in changes:
+            if any(later in changes for later in keys[number - first + 1:]):
+                # Lost, a later change is there
+                rebuild()
+            # Otherwise it is not saved yet by the process which made it, it is applied on the next lookup
+            return
+        pk, row = changes[key]
+        if row is None:
+            rows.pop(pk, None)
+        else:
+            rows[pk] = row
+        _local_index['change'] = number
+
+
+def get_index():
+    last = last_change()
+    # The counter starts again when the cache lost it, the rows of before are not used then
+    if _local_index['rows'] is None or _local_index['version'] != cache.get(VERSION_KEY) or \
+            last < _local_index['change']:
+        load_index()
+    apply_changes(last)
+    return _local_index['rows']
+
+
+def record_change(pk, row):
+    if cache.add(CHANGES_KEY, 1, None):
+        # A new counter, the numbers of the index are not valid anymore
+        invalidate()
+        number = 1
+    else:
+        number = cache.incr(CHANGES_KEY)
+    cache.set(change_key(number), (pk, row), CHANGE_TTL)
+
+
+def update_asset(asset):
+    # Incremental update for one Asset, inactive assets are not part of the index
+    record_change(asset.pk, asset_row(asset) if asset.active else None)
+
+
+def remove_asset(pk):
+    record_change(pk, None)
+
+
+def invalidate():
+    # A Complex may move to another Region, the whole index is rebuilt on the next lookup
+    cache.delete(VERSION_KEY)
+
+
+def bucket(value, edges):
+    for i in range(len(edges) - 1, -1, -1):
+        if value >= edges[i]:
+            return i
+    return 0
+
+
+def bucket_ranges(edges):
+    return [{'min': edges[i], 'max': edges[i + 1] if i + 1 < len(edges) else None} for i in range(len(edges))]
+
+
+def failed_facets(row, selection):
+    # The list of facets (from the selection) that this row does not match
+    failed = []
+    if selection.get('region') and row[REGION] not in selection['region']:
+        failed.append('region')
+    if selection.get('complex') and row[COMPLEX] not in selection['complex']:
+        failed.append('complex')
+    if selection.get('type') and row[TYPE] not in selection['type']:
+        failed.append('type')
+    if selection.get('tag') and row[TAG] != selection['tag']:
+        failed.append('tag')
+    if selection.get('bedroom') and row[BEDROOM] not in selection['bedroom']:
+        failed.append('bedroom')
+    if selection.get('installment') and not row[INSTALLMENT]:
+        failed.append('installment')
+    if selection.get('price') and not (selection['price'][0] <= row[PRICE] <= selection['price'][1]):
+        failed.append('price')
+    if selection.get('area') and not (selection['area'][0] <= row[AREA] <= selection['area'][1]):
+        failed.append('area')
+    if selection.get('reference') and row[PK] not in selection['reference']:
+        # Reference is only a filter, it is never shown as a facet
+        failed.append('reference')
+    return failed
+
+
+def get_facet_counts(selection=None):
+    """
+    Return the counts of every facet value for the selection.
+    The counts of one facet ignore the selection of that same facet (the usual faceted navigation),
+    so the user can see how many results each other value of a selected facet would give.
+    """
+    selection = selection or {}
+    counts = {facet: {} for facet in FACETS}
+    total = 0
+    for row in get_index().values():
+        failed = failed_facets(row, selection)
+        if len(failed) > 1 or failed == ['reference']:
+            continue
+        values = {'region': row[REGION], 'complex': row[COMPLEX], 'type': row[TYPE], 'tag': row[TAG],
+                  'bedroom': row[BEDROOM], 'installment': row[INSTALLMENT],
+                  'price': bucket(row[PRICE], PRICE_BUCKETS), 'area': bucket(row[AREA], AREA_BUCKETS)}
+        # A row which fails only one facet is still counted for that facet
+        for facet in (failed or FACETS):
+            counts[facet][values[facet]] = counts[facet].get(values[facet], 0) + 1
+        if not failed:
+            total += 1
+    counts['total'] = total
+    counts['priceBuckets'] = [dict(r, count=counts['price'].get(i, 0)) for i, r in enumerate(bucket_ranges(PRICE_BUCKETS))]
+    counts['areaBuckets'] = [dict(r, count=counts['area'].get(i, 0)) for i, r in enumerate(bucket_ranges(AREA_BUCKETS))]
+    return counts
+
@@ -0,0 +1,292 @@
+## Full-text search of the blog posts and the FAQs (EN and FA)
+## Every published Post and active FAQ has a SearchDocument: its title and body as plain text, HTML stripped and
+## normalized, so Arabic and Persian spellings (ي/ی, ك/ک, ZWNJ, digits) find each other.
+## Two backends with the same API:
+## - PostgresBackend: a GIN-indexed tsvector, ts_rank for relevance and ts_headline for the snippets.
+## - PythonBackend: an inverted index in memory with BM25 ranking, used on SQLite (tests, local runs).
+##
+## fulltext.search('POST', 'EN', 'sea view')           >> ordered object ids, the best match first
+## fulltext.search('POST', 'EN', 'sea view', 10, 20)   >> the ids of the 3rd page of 10 (LIMIT/OFFSET)
+## fulltext.count('POST', 'EN', 'sea view')            >> the number of all matches
+## fulltext.snippets('POST', 'EN', 'sea view', ids)   >> {id: html with <mark> around the matches}
+## python manage.py rebuild_search_index
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.utils.functional import cached_property
+from django.utils.html import escape, strip_tags, mark_safe
+from apps.blogApp import models as blogAppModel
+from . import models
+import html
+import math
+import re
+import uuid
+
+
+VERSION_KEY = 'fulltext:version'
+SNIPPET_WORDS = 30
+# A word of the title counts as much as this many words of the body
+TITLE_WEIGHT = 3
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# kind >> (model, title field, body field, published field)
+SOURCES = {'POST': (blogAppModel.Post, 'title', 'content', 'status'),
+           'FAQ': (models.FAQ, 'question', 'answer', 'active')}
+
+# PostgreSQL text search configuration per language, there is no Persian stemmer
+SEARCH_CONFIGS = {'EN': 'english',
+                  'FA': 'simple'}
+
+CHARACTERS = str.maketrans({'ي': 'ی', 'ى': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه', 'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا',
+                            # ZWNJ separates the parts of a word, the other marks and the tatweel are only for display
+                            '\u200c': ' ', '\u200d': '', '\u200e': '', '\u200f': '', '\u0640': '',
+                            **{chr(0x06F0 + i): str(i) for i in range(10)},
+                            **{chr(0x0660 + i): str(i) for i in range(10)}})
+DIACRITICS = re.compile('[\u064B-\u065F\u0670]')
+
+# Matches in the snippets of the database are marked with these, the text is escaped before they become <mark>
+START_SEL, STOP_SEL = '\x02', '\x03'
+
+# Inverted indexes of this process, reused as long as the version in the cache is the same
+_local_index = {'version': None, 'indexes': {}}
+
+
+def normalize(text):
+    # Plain text of the HTML with one spelling of every Persian letter and digit
+    text = strip_tags(re.sub('<', ' <', text or ''))
+    text = DIACRITICS.sub('', html.unescape(text).translate(CHARACTERS))
+    return ' '.join(text.split())
+
+
+def tokenize(text):
+    return re.findall(r'\w+', normalize(text).casefold())
+
+
+def get_backend():
+    return PostgresBackend() if connection.vendor == 'postgresql' else PythonBackend()
+
+
+def bump_version():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def kind_of(instance):
+    for kind, (model, title, body, published) in SOURCES.items():
+        if isinstance(instance, model):
+            return kind
+    return None
+
+
+def build_document(kind, instance):
+    model, title, body, published = SOURCES[kind]
+    return models.SearchDocument(kind=kind, object_id=instance.pk, language=instance.language,
+                                 title=normalize(getattr(instance, title)), body=normalize(getattr(instance, body)))
+
+
+def index_object(instance):
+    # Called on every save, an unpublished object is removed from the search
+    kind = kind_of(instance)
+    model, title, body, published = SOURCES[kind]
+    if not getattr(instance, published):
+        remove_object(kind, instance.pk)
+        return
+    document = build_document(kind, instance)
+    document, created = models.SearchDocument.objects.update_or_create(
+        kind=kind, object_id=instance.pk,
+        defaults={'language': document.language, 'title': document.title, 'body': document.body})
+    get_backend().update_vectors(models.SearchDocument.objects.filter(pk=document.pk))
+    bump_version()
+
+
+def remove_object(kind, pk):
+    if models.SearchDocument.objects.filter(kind=kind, object_id=pk).delete()[0]:
+        bump_version()
+
+
+def rebuild(kinds=None, batch_size=500):
+    # All documents of the kinds from scratch, returns {kind: number of documents}
+    counts = {}
+    for kind in kinds or SOURCES:
+        model, title, body, published = SOURCES[kind]
+        models.SearchDocument.objects.filter(kind=kind).delete()
+        batch = []
+        counts[kind] = 0
+        for instance in model.objects.filter(**{published: True}).order_by('pk').iterator(chunk_size=batch_size):
+            batch.append(build_document(kind, instance))
+            if len(batch) >= batch_size:
+                counts[kind] += len(models.SearchDocument.objects.bulk_create(batch))
+                batch = []
+        counts[kind] += len(models.SearchDocument.objects.bulk_create(batch))
+        get_backend().update_vectors(models.SearchDocument.objects.filter(kind=kind))
+    bump_version()
+    return counts
+
+
+def search(kind, language, text, limit=None, offset=0):
+    # The ids of the matches from offset on, all of them without a limit
+    if not tokenize(text):
+        return []
+    return get_backend().search(kind, language, text, limit, offset)
+
+
+def count(kind, language, text):
+    if not tokenize(text):
+        return 0
+    return get_backend().count(kind, language, text)
+
+
+def snippets(kind, language, text, ids):
+    if not ids or not tokenize(text):
+        return {}
+    return get_backend().snippets(kind, language, text, ids)
+
+
+class SearchResults():
+    # The matches of a search as a sequence for the Paginator.
+    # Its length is the number of all matches, a slice (a page) reads only its ids from the ranking and their
+    # objects from the queryset.
+
+    def __init__(self, kind, language, text, queryset):
+        self.kind = kind
+        self.language = language
+        self.text = text
+        self.queryset = queryset
+
+    @cached_property
+    def total(self):
+        return count(self.kind, self.language, self.text)
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        limit = index.stop - start if index.stop is not None else None
+        ids = search(self.kind, self.language, self.text, limit, start)
+        objects = self.queryset.in_bulk(ids)
+        # In the order of the ranking, an object which is not in the queryset is left out
+        return [objects[pk] for pk in ids if pk in objects]
+
+
+def highlight(text):
+    return mark_safe(escape(text).replace(START_SEL, '<mark>').replace(STOP_SEL, '</mark>'))
+
+
+class PythonBackend():
+
+    def update_vectors(self, documents):
+        # There is no vector column without PostgreSQL
+        pass
+
+    def get_index(self, kind, language):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            bump_version()
+            version = cache.get(VERSION_KEY)
+        if version != _local_index['version']:
+            _local_index['version'] = version
+            _local_index['indexes'] = {}
+        if (kind, language) not in _local_index['indexes']:
+            _local_index['indexes'][kind, language] = self.build_index(kind, language)
+        return _local_index['indexes'][kind, language]
+
+    def build_index(self, kind, language):
+        # term >> {object id: weighted term frequency}
+        postings = {}
+        lengths = {}
+        bodies = {}
+        documents = models.SearchDocument.objects.filter(kind=kind, language=language) \
+            .values_list('object_id', 'title', 'body')
+        for object_id, title, body in documents:
+            terms = {}
+            for term in tokenize(title):
+                terms[term] = terms.get(term, 0) + TITLE_WEIGHT
+            for term in tokenize(body):
+                terms[term] = terms.get(term, 0) + 1
+            for term, frequency in terms.items():
+                postings.setdefault(term, {})[object_id] = frequency
+            lengths[object_id] = sum(terms.values())
+            bodies[object_id] = body
+        average = sum(lengths.values()) / len(lengths) if lengths else 0
+        return {'postings': postings, 'lengths': lengths, 'average': average, 'bodies': bodies}
+
+    def matches(self, index, text):
+        # Every word of the search has to be in the document
+        matches = [index['postings'].get(term, {}) for term in set(tokenize(text))]
+        return matches, set.intersection(*[set(match) for match in matches])
+
+    def count(self, kind, language, text):
+        return len(self.matches(self.get_index(kind, language), text)[1])
+
+    def search(self, kind, language, text, limit, offset):
+        index = self.get_index(kind, language)
+        matches, found = self.matches(index, text)
+        total = len(index['lengths'])
+        scores = {}
+        for match in matches:
+            idf = math.log(1 + (total - len(match) + 0.5) / (len(match) + 0.5))
+            for object_id in found:
+                frequency = match[object_id]
+                norm = K1 * (1 - B + B * index['lengths'][object_id] / index['average'])
+                scores[object_id] = scores.get(object_id, 0) + idf * frequency * (K1 + 1) / (frequency + norm)
+        ranking = sorted(found, key=lambda object_id: (-scores[object_id], -object_id))
+        return ranking[offset:offset + limit if limit is not None else None]
+
+    def snippets(self, kind, language, text, ids):
+        index = self.get_index(kind, language)
+        terms = set(tokenize(text))
+        result = {}
+        for object_id in ids:
+            words = index['bodies'].get(object_id, '').split()
+            matched = [any(term in terms for term in tokenize(word)) for word in words]
+            first = matched.index(True) if True in matched else 0
+            start = max(0, first - SNIPPET_WORDS // 3)
+            window = words[start:start + SNIPPET_WORDS]
+            snippet = ' '.join(START_SEL + word + STOP_SEL if matched[start + i] else word
+                               for i, word in enumerate(window))
+            if start > 0:
+                snippet = '... ' + snippet
+            if start + SNIPPET_WORDS < len(words):
+                snippet += ' ...'
+            result[object_id] = highlight(snippet)
+        return result
+
+
+class PostgresBackend():
+    # django.contrib.postgres needs psycopg2, it is imported only when PostgreSQL is used
+
+    def get_query(self, language, text):
+        from django.contrib.postgres.search import SearchQuery
+        return SearchQuery(normalize(text), config=SEARCH_CONFIGS[language], search_type='websearch')
+
+    def update_vectors(self, documents):
+        from django.contrib.postgres.search import SearchVector
+        for language, config in SEARCH_CONFIGS.items():
+            documents.filter(language=language).update(
+                vector=SearchVector('title', weight='A', config=config) + SearchVector('body', weight='B', config=config))
+
+    def count(self, kind, language, text):
+        return models.SearchDocument.objects.filter(kind=kind, language=language,
+                                                    vector=self.get_query(language, text)).count()
+
+    def search(self, kind, language, text, limit, offset):
+        from django.contrib.postgres.search import SearchRank
+        query = self.get_query(language, text)
+        documents = models.SearchDocument.objects.filter(kind=kind, language=language, vector=query) \
+            .annotate(rank=SearchRank(F('vector'), query)).order_by('-rank', '-object_id')
+        # Only the page is ranked out of the index, LIMIT/OFFSET
+        ids = documents.values_list('object_id', flat=True)
+        return list(ids[offset:offset + limit] if limit is not None else ids[offset:])
+
+    def snippets(self, kind, language, text, ids):
+        from django.contrib.postgres.search import SearchHeadline
+        query = self.get_query(language, text)
+        documents = models.SearchDocument.objects.filter(kind=kind, language=language, object_id__in=ids) \
+            .annotate(snippet=SearchHeadline('body', query, config=SEARCH_CONFIGS[language], start_sel=START_SEL,
+                                             stop_sel=STOP_SEL, max_words=SNIPPET_WORDS, min_words=SNIPPET_WORDS // 2))
+        return {object_id: highlight(snippet) for object_id, snippet in documents.values_list('object_id', 'snippet')}
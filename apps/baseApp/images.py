@@ -0,0 +1,214 @@
+## Responsive derivatives of the uploaded images (listings, listing pictures, slides and blog posts)
+## Every original gets WebP and JPEG copies at fixed widths next to it in MEDIA_ROOT/derivatives/,
+## an ImageInfo row with its size and the widths, and a tiny blurred placeholder.
+## The derivatives of a saved image are made after the commit by a thread of the process (signals.py), the request
+## of the save does not wait for them. Until they are there the original is shown. Old images, and the ones of a
+## process which stopped before, are done by the backfill command (also a cron job):
+## python manage.py generate_image_derivatives --workers 4
+## The info of every image is cached under its own key (info_key()). The first image tag of a page reads the info of
+## all the images of its context with one query (prefetch()), a page never reads the info of other images.
+##
+## In the templates: {% load responsive_images %}
+## {% responsive_image property.image sizes="(max-width: 767px) 100vw, 33vw" alt="Property Image" %}
+## {% image_url slide.image 1920 %}  >> the JPEG derivative for CSS backgrounds
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections
+from django.db.models import Model, QuerySet
+from django.db.models.fields.files import FieldFile
+from PIL import Image, ImageFilter, ImageOps
+from . import models
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = [320, 640, 960, 1280, 1920]
+
+# extension >> (Pillow format, save options, mime type)
+FORMATS = {'webp': ('WEBP', {'quality': 75, 'method': 4}, 'image/webp'),
+           'jpg': ('JPEG', {'quality': 80, 'optimize': True, 'progressive': True}, 'image/jpeg')}
+
+DERIVATIVES_DIR = 'derivatives'
+PLACEHOLDER_WIDTH = 16
+
+# An image without derivatives is looked up again after this, the backfill of another process may have made them
+MISSING_TIMEOUT = 10 * 60
+MISSING = ()
+
+# Threads of this process which make the derivatives of the new uploads
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+
+def derivative_name(name, width, extension):
+    # baseApp/property/photo.jpg >> derivatives/baseApp/property/photo-640w.webp
+    root, ext = os.path.splitext(name)
+    return '{}/{}-{}w.{}'.format(DERIVATIVES_DIR, root, width, extension)
+
+
+def target_widths(width):
+    # The fixed widths smaller than the original, and the original itself (never enlarged)
+    widths = [w for w in WIDTHS if w < width]
+    return widths + [min(width, WIDTHS[-1])]
+
+
+def save_file(name, content):
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(content))
+
+
+def encode(image, extension):
+    file_format, options, mime = FORMATS[extension]
+    output = io.BytesIO()
+    image.save(output, file_format, **options)
+    return output.getvalue()
+
+
+def placeholder(image):
+    small = image.copy()
+    small.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH))
+    small = small.filter(ImageFilter.GaussianBlur(1))
+    return 'data:image/jpeg;base64,' + base64.b64encode(encode(small, 'jpg')).decode('ascii')
+
+
+def render(name):
+    """
+    Create the derivatives of one original and return the fields of its ImageInfo.
+    It touches only the files, so it can run in the processes of the backfill command.
+    """
+    with default_storage.open(name) as file:
+        image = Image.open(file)
+        # Photos of phones are often stored sideways with an EXIF rotation
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGB')
+    width, height = image.size
+    widths = target_widths(width)
+    for target in widths:
+        resized = image if target == width else image.resize((target, max(1, round(height * target / width))),
+                                                             Image.LANCZOS)
+        for extension in FORMATS:
+            save_file(derivative_name(name, target, extension), encode(resized, extension))
+    return {'name': name, 'width': width, 'height': height,
+            'widths': ','.join(str(w) for w in widths), 'placeholder': placeholder(image)}
+
+
+def info_key(name):
+    return 'images:info:{}'.format(hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+
+def as_info(width, height, widths, preview):
+    return (width, height, [int(w) for w in widths.split(',')], preview)
+
+
+def save_info(fields):
+    models.ImageInfo.objects.update_or_create(name=fields['name'], defaults=fields)
+    cache.set(info_key(fields['name']), as_info(fields['width'], fields['height'], fields['widths'],
+                                                fields['placeholder']), None)
+
+
+def process(name, force=False):
+    # Called on every save of an image field, an image is processed only once
+    if not name or (not force and models.ImageInfo.objects.filter(name=name).exists()):
+        return
+    if not default_storage.exists(name):
+        logger.debug('Image %s does not exist, no derivatives', name)
+        return
+    try:
+        save_info(render(name))
+    except (OSError, Image.DecompressionBombError):
+        # A broken upload must not break the save of the listing or post
+        logger.exception('Derivatives of %s failed', name)
+
+
+def workers():
+    return getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 1)
+
+
+def process_task(name):
+    # process() in a thread of the pool, which must not keep its database connection open
+    try:
+        process(name)
+    except Exception:
+        logger.exception('Derivatives of %s failed', name)
+    finally:
+        connections.close_all()
+
+
+def schedule(name):
+    # The derivatives of a saved image in a thread of this process, at once with 0 workers
+    global _pool, _pool_pid
+    if not name:
+        return
+    if workers() <= 0:
+        process(name)
+        return
+    with _lock:
+        # A forked worker process starts its own threads
+        if _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=workers(), thread_name_prefix='images')
+            _pool_pid = os.getpid()
+        _pool.submit(process_task, name)
+
+
+def get_info(name):
+    # (width, height, [widths], placeholder) of an original, None if it has no derivatives (yet)
+    key = info_key(name)
+    info = cache.get(key)
+    if info is None:
+        row = models.ImageInfo.objects.filter(name=name).values_list('width', 'height', 'widths', 'placeholder').first()
+        info = as_info(*row) if row else MISSING
+        cache.set(key, info, None if row else MISSING_TIMEOUT)
+    return info or None
+
+
+def prefetch(names):
+    # The info of many images with one cache read and one query for the ones which are not in the cache
+    keys = {info_key(name): name for name in set(names) if name}
+    cached = cache.get_many(list(keys))
+    missing = {name for key, name in keys.items() if key not in cached}
+    if not missing:
+        return
+    rows = models.ImageInfo.objects.filter(name__in=missing).values_list('name', 'width', 'height', 'widths',
+                                                                         'placeholder')
+    found = {name: as_info(width, height, widths, preview) for name, width, height, widths, preview in rows}
+    cache.set_many({info_key(name): info for name, info in found.items()}, None)
+    cache.set_many({info_key(name): MISSING for name in missing - set(found)}, MISSING_TIMEOUT)
+
+
+def image_names(values):
+    # The image names of the model instances among the values, also in lists and evaluated querysets.
+    # A queryset which was not evaluated yet is not read here.
+    for value in values:
+        if isinstance(value, QuerySet):
+            value = value._result_cache or []
+        items = value if isinstance(value, (list, tuple)) else [value]
+        for item in items:
+            # A deferred image field (only('id')) is not loaded for it
+            image = item.image if isinstance(item, Model) and 'image' in item.__dict__ else None
+            if isinstance(image, FieldFile) and image:
+                yield image.name
+
+
+def srcset(name, widths, extension):
+    return ', '.join('{} {}w'.format(default_storage.url(derivative_name(name, width, extension)), width)
+                     for width in widths)
+
+
+def url(name, width, extension='jpg'):
+    # The smallest derivative at least this wide (or the largest one), the original without derivatives
+    info = get_info(name)
+    if info is None:
+        return default_storage.url(name)
+    widths = info[2]
+    return default_storage.url(derivative_name(name, next((w for w in widths if w >= width), widths[-1]), extension))
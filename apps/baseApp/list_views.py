@@ -0,0 +1,85 @@
+## Base class of the list and search views of baseApp, FAbaseApp, blogApp and FAblogApp
+## A ListView runs get_queryset() for the pagination and then again for every count or "last item" in
+## get_context_data. Here the filtered queryset, its count and the rows of the current page are kept on the
+## view for the whole request, so each of them is evaluated at most once.
+##
+## Subclasses filter in filter_queryset() instead of get_queryset(), and attach their related objects with
+## the select_related / prefetch_related attributes.
+## FullTextSearchView pages the matches of a full-text search (?s=) in the database, see fulltext.py.
+
+from django.core.paginator import Paginator
+from django.views import generic
+from .pagination import CursorPaginationMixin, cached_count
+from . import fulltext
+
+
+class MemoListView(CursorPaginationMixin, generic.ListView):
+    # Related objects of the rows which the templates use, e.g. ['complex__region', 'bedroom']
+    select_related = []
+    prefetch_related = []
+    # Add 'resultCount' (number of all results, not only of the page) to the context
+    count_results = False
+
+    def filter_queryset(self, queryset):
+        return queryset
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            queryset = self.filter_queryset(super().get_queryset())
+            if self.select_related:
+                queryset = queryset.select_related(*self.select_related)
+            if self.prefetch_related:
+                queryset = queryset.prefetch_related(*self.prefetch_related)
+            self._queryset = queryset
+        return self._queryset
+
+    def get_result_count(self):
+        if not hasattr(self, '_result_count'):
+            paginator = getattr(self, '_paginator', None)
+            # The numbered paginator has already counted the same queryset
+            self._result_count = paginator.count if paginator is not None else cached_count(self.get_queryset())
+        return self._result_count
+
+    def paginate_queryset(self, queryset, page_size):
+        self._paginator, self.page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+        return self._paginator, self.page, object_list, is_paginated
+
+    def get_rows(self):
+        # The evaluated rows of the current page (or of the whole list without pagination)
+        if not hasattr(self, '_rows'):
+            page = getattr(self, 'page', None)
+            self._rows = list(page.object_list if page is not None else self.get_queryset())
+            if page is not None:
+                page.object_list = self._rows
+        return self._rows
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # The templates loop over the same list, the page is read from the database only once
+        context['object_list'] = self.get_rows()
+        context_object_name = self.get_context_object_name(self.object_list)
+        if context_object_name:
+            context[context_object_name] = self.get_rows()
+        if self.count_results:
+            context['resultCount'] = self.get_result_count()
+        return context
+
+
+class FullTextSearchView(MemoListView):
+    # The kind and language of the search, e.g. 'POST' and 'EN'
+    search_kind = None
+    search_language = 'EN'
+
+    def get_keyword(self):
+        return self.request.GET.get('s') or ''
+
+    def use_cursor(self, queryset):
+        # The ranking is not a keyset
+        return not self.get_keyword() and super().use_cursor(queryset)
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        # A page of the matches is a LIMIT/OFFSET on the ranking, the number of pages comes from all the matches
+        if not self.get_keyword():
+            return super().get_paginator(queryset, per_page, orphans, allow_empty_first_page, **kwargs)
+        results = fulltext.SearchResults(self.search_kind, self.search_language, self.get_keyword(), queryset)
+        return Paginator(results, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page, **kwargs)
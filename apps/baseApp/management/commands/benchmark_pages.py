@@ -0,0 +1,179 @@
+## End-to-end page benchmark
+## Every named URL pattern of RealEstate/urls.py is requested through the test client.
+## Each view reports the latency (p50/p95), the SQL query count and the peak Python memory as JSON,
+## together with the commit and the size of the catalog, so reports of different commits can be compared.
+## python manage.py generate_catalog --size 10k
+## python manage.py benchmark_pages --repeat 20 --output bench-10k.json
+## python manage.py benchmark_pages --compare bench-10k.json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from django.urls import get_resolver, reverse, URLPattern, URLResolver
+from django.utils import timezone
+from apps.baseApp import models
+from apps.blogApp import models as blogAppModel
+import json
+import math
+import subprocess
+import time
+import tracemalloc
+
+# The admin, the editor uploads and the static files are not part of the site
+SKIPPED_NAMESPACES = ['admin', 'ckeditor_uploader']
+SKIPPED_PREFIXES = ['captain/', 'ckeditor/', 'robots.txt', 'media/', 'static/']
+
+# Query strings of the search pages, a search page without a query shows nothing
+QUERY_STRINGS = {'baseApp:properties': '?tag_select=sale&sort=price-ascending',
+                 'FAbaseApp:properties': '?tag_select=sale&sort=price-ascending',
+                 'baseApp:faq_search': '?s=apartment',
+                 'FAbaseApp:faq_search': '?s=apartment',
+                 'blogApp:search': '?s=sea',
+                 'FAblogApp:search': '?s=sea'}
+
+# Every benchmark gets a clean cache of its own, the cache of the site is never touched
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Requests every page of the site and reports latency, query count and peak memory per view as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10, help='Requests per view after the first (cold) one')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of the console')
+        parser.add_argument('--compare', help='A previous JSON report, print the changes against it')
+        parser.add_argument('--login', help='Username for the pages which need a login (e.g. export-page)')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+        # ALLOWED_HOSTS accepts the test client and emails go to memory
+        setup_test_environment()
+        client = Client()
+        if options['login']:
+            client.force_login(User.objects.get(username=options['login']))
+
+        views = {}
+        with override_settings(CACHES=BENCHMARK_CACHES):
+            for name, url in self.collect_urls():
+                self.stderr.write(name)
+                views[name] = self.measure(client, url, options['repeat'])
+
+        report = {
+            'commit': current_commit(),
+            'created': timezone.now().isoformat(),
+            'repeat': options['repeat'],
+            'dataset': {'assets': models.Asset.objects.count(),
+                        'posts': blogAppModel.Post.objects.count(),
+                        'faqs': models.FAQ.objects.count()},
+            'views': views,
+            }
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
+        if options['compare']:
+            self.compare(report, options['compare'])
+
+    def sample_kwargs(self, namespace, keys):
+        # Real values of the database for the url parameters, None if there is nothing to show
+        language = 'FA' if namespace.startswith('FA') else 'EN'
+        blog = namespace in ['blogApp', 'FAblogApp']
+        kwargs = {}
+        for key in keys:
+            if key == 'pk':
+                value = models.Asset.objects.filter(active=True).values_list('pk', flat=True).first()
+            elif key == 'slug':
+                value = blogAppModel.Post.objects.filter(status=True, language=language).values_list('slug', flat=True).first()
+            elif key == 'category' and blog:
+                value = blogAppModel.PostCategories.objects.filter(category_lang=language, categories__status=True) \
+                    .values_list('slug', flat=True).first()
+            elif key == 'category':
+                value = 'all' if language == 'EN' else 'همه'
+            else:
+                value = None
+            if value is None:
+                return None
+            kwargs[key] = value
+        return kwargs
+
+    def collect_urls(self, patterns=None, namespace='', prefix=''):
+        # [(namespace:name, url)] of every named pattern, in the order of urls.py
+        urls = []
+        for pattern in (get_resolver().url_patterns if patterns is None else patterns):
+            route = prefix + str(pattern.pattern)
+            if any(route.startswith(skipped) for skipped in SKIPPED_PREFIXES):
+                continue
+            if isinstance(pattern, URLResolver):
+                if pattern.namespace in SKIPPED_NAMESPACES:
+                    continue
+                urls += self.collect_urls(pattern.url_patterns, pattern.namespace or namespace, route)
+            elif isinstance(pattern, URLPattern) and pattern.name:
+                name = '{}:{}'.format(namespace, pattern.name) if namespace else pattern.name
+                kwargs = self.sample_kwargs(namespace, pattern.pattern.regex.groupindex.keys())
+                if kwargs is None:
+                    self.stderr.write('{}: no data for the url parameters, skipped'.format(name))
+                    continue
+                urls.append((name, reverse(name, kwargs=kwargs) + QUERY_STRINGS.get(name, '')))
+        return urls
+
+    def measure(self, client, url, repeat):
+        # The first request is measured alone, it fills the caches
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        cold = time.perf_counter() - start
+        cold_queries = len(queries)
+
+        timings = []
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(repeat):
+                start = time.perf_counter()
+                client.get(url)
+                timings.append(time.perf_counter() - start)
+        warm_queries = len(queries) // repeat
+
+        # Memory is measured in a request of its own, tracemalloc slows everything down
+        tracemalloc.start()
+        client.get(url)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {'url': url,
+                'status': response.status_code,
+                'cold_ms': round(cold * 1000, 2),
+                'p50_ms': round(percentile(timings, 50) * 1000, 2),
+                'p95_ms': round(percentile(timings, 95) * 1000, 2),
+                'cold_queries': cold_queries,
+                'queries': warm_queries,
+                'peak_memory_kb': round(peak / 1024, 1)}
+
+    def compare(self, report, path):
+        with open(path) as file:
+            previous = json.load(file)
+        self.stdout.write('Compared with {} ({} assets)'.format(previous.get('commit'), previous['dataset']['assets']))
+        for name, view in report['views'].items():
+            old = previous['views'].get(name)
+            if not old:
+                self.stdout.write('{}: new'.format(name))
+                continue
+            self.stdout.write('{}: p50 {} >> {} ms, p95 {} >> {} ms, queries {} >> {}, memory {} >> {} KB'.format(
+                name, old['p50_ms'], view['p50_ms'], old['p95_ms'], view['p95_ms'],
+                old['queries'], view['queries'], old['peak_memory_kb'], view['peak_memory_kb']))
@@ -0,0 +1,191 @@
+## Synthetic catalog for load testing and benchmarks (see benchmark_pages)
+## Every row is created with bulk_create, so 100k listings take minutes instead of hours.
+## python manage.py generate_catalog --size 10k --seed 1
+## python manage.py generate_catalog --clear
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from apps.baseApp import models, shared_context, facets, fulltext
+from apps.blogApp import models as blogAppModel
+import random
+
+# Every synthetic name starts with this, so the rows can be found and removed again
+PREFIX = 'Synthetic'
+
+SIZES = {'1k': 1000, '10k': 10000, '100k': 100000}
+
+BATCH_SIZE = 2000
+
+WORDS = ['sea', 'view', 'garden', 'pool', 'metro', 'family', 'luxury', 'quiet', 'central', 'new',
+         'investment', 'citizenship', 'balcony', 'park', 'school', 'mall', 'bridge', 'forest', 'lake', 'tower']
+
+
+class Command(BaseCommand):
+    help = 'Creates a synthetic catalog of listings, blog posts and FAQs with bulk_create'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', choices=SIZES.keys(), default='1k', help='Number of listings')
+        parser.add_argument('--assets', type=int, help='Exact number of listings (overrides --size)')
+        parser.add_argument('--seed', type=int, default=1, help='Same seed, same catalog')
+        parser.add_argument('--clear', action='store_true', help='Only remove the synthetic rows of a previous run')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            self.clear()
+            return
+
+        count = options['assets'] or SIZES[options['size']]
+        if count < 1:
+            raise CommandError('The number of listings must be positive')
+        if models.Region.objects.filter(name__startswith=PREFIX).exists():
+            raise CommandError('A synthetic catalog already exists, remove it first with --clear')
+
+        self.random = random.Random(options['seed'])
+        start = timezone.now()
+        with transaction.atomic():
+            self.create_site_rows()
+            complexes = self.create_complexes(count)
+            self.create_assets(count, complexes)
+            self.create_posts(max(50, count // 20))
+            self.create_faqs(max(20, count // 100))
+
+        # bulk_create sends no signals, refresh the caches by hand
+        shared_context.bump_content_version()
+        facets.invalidate()
+        fulltext.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            'Created {} listings in {:.1f} seconds'.format(count, (timezone.now() - start).total_seconds())))
+
+    def clear(self):
+        with transaction.atomic():
+            # Regions, complexes, assets, images, distances and m2m rows are removed by CASCADE
+            models.Country.objects.filter(countries__name__startswith=PREFIX).delete()
+            models.ComplexFeatures.objects.filter(features__startswith=PREFIX).delete()
+            models.AssetFeatures.objects.filter(features__startswith=PREFIX).delete()
+            models.Location.objects.filter(name__startswith=PREFIX).delete()
+            blogAppModel.Post.objects.filter(title__startswith=PREFIX).delete()
+            blogAppModel.PostCategories.objects.filter(category__startswith=PREFIX).delete()
+            models.FAQ.objects.filter(question__startswith=PREFIX).delete()
+            models.FAQCategories.objects.filter(category__startswith=PREFIX).delete()
+            User.objects.filter(username=PREFIX).delete()
+        shared_context.bump_content_version()
+        facets.invalidate()
+        self.stdout.write(self.style.SUCCESS('Synthetic catalog removed'))
+
+    def bulk_create(self, model, objects):
+        created = model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+        if created and created[0].pk is None:
+            # Databases without RETURNING (SQLite) give back no pks, read them back in insert order
+            pks = sorted(model.objects.order_by('-pk').values_list('pk', flat=True)[:len(created)])
+            for obj, pk in zip(created, pks):
+                obj.pk = pk
+        return created
+
+    def sentence(self, words):
+        return ' '.join(self.random.choice(WORDS) for i in range(words))
+
+    def create_site_rows(self):
+        # Rows which the pages expect to exist (slides, bedrooms, the 'all' FAQ categories)
+        for use, name in models.PAGE_CHOICES:
+            if not models.Slide.objects.filter(useFor=use, active=True).exists():
+                models.Slide.objects.create(useFor=use, active=True, image='baseApp/slider/synthetic.jpg')
+        for number in range(6):
+            models.Bedroom.objects.get_or_create(
+                number=number, defaults={'description': '{}+1'.format(number), 'description_FA': '{} خوابه'.format(number)})
+        for pk, name, language in [(1, 'all', 'EN'), (6, 'همه', 'FA')]:
+            if not models.FAQCategories.objects.filter(pk=pk).exists():
+                models.FAQCategories.objects.create(id=pk, category=name, slug=name, category_lang=language)
+
+    def create_complexes(self, count):
+        country = models.Country.objects.create()
+        cities = self.bulk_create(models.City,
+            [models.City(country=country, name='{} City {}'.format(PREFIX, i), name_FA='{} شهر {}'.format(PREFIX, i))
+             for i in range(3)])
+        regions = self.bulk_create(models.Region,
+            [models.Region(city=cities[i % 3], name='{} Region {}'.format(PREFIX, i), description=self.sentence(30))
+             for i in range(max(5, count // 500))])
+        complexes = self.bulk_create(models.Complex,
+            [models.Complex(name='{} Complex {}'.format(PREFIX, i), region=self.random.choice(regions),
+                            age=self.random.randint(0, 20), build_area=self.random.randint(2000, 50000),
+                            hide_name=self.random.random() < 0.1, description=self.sentence(60))
+             for i in range(max(10, count // 20))])
+
+        features = self.bulk_create(models.ComplexFeatures,
+            [models.ComplexFeatures(category=category, features='{} {} {}'.format(PREFIX, category, i))
+             for category, name in models.COMPLEX_FEATURES_CATEGORY for i in range(5)])
+        locations = self.bulk_create(models.Location,
+            [models.Location(name='{} Location {}'.format(PREFIX, i)) for i in range(10)])
+        through = models.Complex.features.through
+        through.objects.bulk_create(
+            [through(complex_id=complex.pk, complexfeatures_id=feature.pk)
+             for complex in complexes for feature in self.random.sample(features, 8)], batch_size=BATCH_SIZE)
+        models.Distance.objects.bulk_create(
+            [models.Distance(complex=complex, location=location, distance=self.random.randint(1, 30),
+                             measure=measure, measure_FA=models.MEASURE_TYPES_FA[measure])
+             for complex in complexes for location, measure in zip(self.random.sample(locations, 3), 'KMS')],
+            batch_size=BATCH_SIZE)
+        return complexes
+
+    def create_assets(self, count, complexes):
+        bedrooms = list(models.Bedroom.objects.all())
+        features = self.bulk_create(models.AssetFeatures,
+            [models.AssetFeatures(features='{} Feature {}'.format(PREFIX, i)) for i in range(12)])
+        types = [code for code, name in models.ASSET_TYPES]
+        today = timezone.now().date()
+        through = models.Asset.features.through
+
+        # Created in chunks, a 100k catalog would not fit in memory with its images and features
+        for first in range(0, count, BATCH_SIZE):
+            assets = []
+            for i in range(first, min(first + BATCH_SIZE, count)):
+                price = self.random.randint(20, 2000) * 10000
+                created = today - timezone.timedelta(days=self.random.randint(0, 1000))
+                assets.append(models.Asset(
+                    complex=self.random.choice(complexes), bedroom=self.random.choice(bedrooms),
+                    type=self.random.choice(types), tag='FS' if self.random.random() < 0.8 else 'FR',
+                    installment=self.random.random() < 0.3, base_price=price, price=price,
+                    floor=self.random.randint(0, 30), build_area=self.random.randint(40, 400),
+                    featured=self.random.random() < 0.01, active=self.random.random() < 0.95,
+                    title='{} {}'.format(PREFIX, self.sentence(3)), description=self.sentence(80),
+                    image='baseApp/property/synthetic.jpg', created=created, updated=created))
+            assets = self.bulk_create(models.Asset, assets)
+            models.AssetImages.objects.bulk_create(
+                [models.AssetImages(asset=asset, image='baseApp/property/synthetic.jpg', display_order=order)
+                 for asset in assets for order in range(4)])
+            through.objects.bulk_create(
+                [through(asset_id=asset.pk, assetfeatures_id=feature.pk)
+                 for asset in assets for feature in self.random.sample(features, 5)])
+            self.stdout.write('{} listings...'.format(first + len(assets)))
+
+    def create_posts(self, count):
+        author, created = User.objects.get_or_create(username=PREFIX)
+        categories = self.bulk_create(blogAppModel.PostCategories,
+            [blogAppModel.PostCategories(category='{} {} {}'.format(PREFIX, language, i), category_lang=language,
+                                         slug='{}-{}-{}'.format(PREFIX, language, i).lower(),
+                                         image='blogApp/categories/synthetic.jpg')
+             for language, name in blogAppModel.LANGUAGE_LIST for i in range(5)])
+        posts = self.bulk_create(blogAppModel.Post,
+            [blogAppModel.Post(author=author, language=language, title='{} {} post {}'.format(PREFIX, language, i),
+                               slug='{}-{}-post-{}'.format(PREFIX, language, i).lower(),
+                               content='<p>{}</p>'.format(self.sentence(300)), shortContent=self.sentence(30),
+                               image='blogApp/post/synthetic.jpg', status=self.random.random() < 0.9,
+                               featured=self.random.random() < 0.05, view=self.random.randint(0, 5000))
+             for language, name in blogAppModel.LANGUAGE_LIST for i in range(count)])
+        through = blogAppModel.Post.categories.through
+        through.objects.bulk_create(
+            [through(post_id=post.pk, postcategories_id=self.random.choice(
+                [c.pk for c in categories if c.category_lang == post.language]))
+             for post in posts], batch_size=BATCH_SIZE)
+
+    def create_faqs(self, count):
+        today = timezone.now().date()
+        faqs = self.bulk_create(models.FAQ,
+            [models.FAQ(language=language, question='{} {} question {} {}?'.format(PREFIX, language, i, self.sentence(4)),
+                        answer='<p>{}</p>'.format(self.sentence(60)), created=today, updated=today)
+             for language, name in models.LANGUAGE_LIST for i in range(count)])
+        all_categories = {'EN': 1, 'FA': 6}
+        models.FAQPriority.objects.bulk_create(
+            [models.FAQPriority(category_id=all_categories[faq.language], question=faq, priority=i)
+             for i, faq in enumerate(faqs)], batch_size=BATCH_SIZE)
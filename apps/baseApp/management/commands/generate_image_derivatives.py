@@ -0,0 +1,58 @@
+## Backfill of the responsive image derivatives (see baseApp/images.py)
+## New uploads get their derivatives after the save. This command makes them for the images which were uploaded
+## before (or whose process stopped first, it is a cron job too), in a pool of processes, one image per task.
+## The database is written only by the main process.
+## python manage.py generate_image_derivatives --workers 4
+## python manage.py generate_image_derivatives --force
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from apps.baseApp import models, images
+from apps.blogApp import models as blogAppModel
+import django
+import os
+
+SOURCES = [models.Asset, models.AssetImages, models.Slide, blogAppModel.Post]
+
+
+class Command(BaseCommand):
+    help = 'Creates the WebP/JPEG derivatives and placeholders of the uploaded images in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes')
+        parser.add_argument('--force', action='store_true', help='Also the images which already have derivatives')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        names = set()
+        for model in SOURCES:
+            names.update(model.objects.exclude(image='').exclude(image=None).values_list('image', flat=True))
+        if not options['force']:
+            names -= set(models.ImageInfo.objects.values_list('name', flat=True))
+        missing = {name for name in names if not default_storage.exists(name)}
+        for name in sorted(missing):
+            self.stderr.write('Missing file: {}'.format(name))
+        names = sorted(names - missing)
+        self.stdout.write('{} images to process with {} workers'.format(len(names), options['workers']))
+
+        start = timezone.now()
+        done = failed = 0
+        # The forked processes must not share the database connection of this one
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+            tasks = {pool.submit(images.render, name): name for name in names}
+            for task in as_completed(tasks):
+                try:
+                    images.save_info(task.result())
+                    done += 1
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write('{}: {}'.format(tasks[task], error))
+                if (done + failed) % 100 == 0:
+                    self.stdout.write('{}/{}'.format(done + failed, len(names)))
+        self.stdout.write(self.style.SUCCESS('{} images done, {} failed in {:.1f} seconds'.format(
+            done, failed, (timezone.now() - start).total_seconds())))
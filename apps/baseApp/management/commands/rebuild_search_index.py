@@ -0,0 +1,31 @@
+## Rebuilds the full-text search documents of the blog posts and the FAQs (see baseApp/fulltext.py)
+## The documents are kept up to date on save, this is for the first deploy, a changed normalization
+## or rows which were written without signals (bulk_create, update()).
+## python manage.py rebuild_search_index
+## python manage.py rebuild_search_index --kind FAQ --batch-size 1000
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from apps.baseApp import fulltext
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search documents of the blog posts and the FAQs in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', choices=fulltext.SOURCES.keys(),
+                            help='Only this kind of documents, may be repeated (default: all)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Documents per INSERT')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        start = timezone.now()
+        # The search keeps the old documents until the new ones are complete
+        with transaction.atomic():
+            counts = fulltext.rebuild(options['kind'], options['batch_size'])
+        for kind, count in counts.items():
+            self.stdout.write('{}: {} documents'.format(kind, count))
+        self.stdout.write(self.style.SUCCESS(
+            'Search index rebuilt in {:.1f} seconds'.format((timezone.now() - start).total_seconds())))
@@ -3,6 +3,11 @@ from django.urls import reverse_lazy, reverse
 from ckeditor_uploader.fields import RichTextUploadingField
 from django.utils import timezone
 from django.utils.html import mark_safe
+try:
+    from django.contrib.postgres.search import SearchVectorField
+except ImportError:
+    # psycopg2 is only installed with PostgreSQL, other databases never use the vector column
+    SearchVectorField = models.TextField
 
 
 # Variables
@@ -308,3 +313,54 @@ class FAQPriority(models.Model):
         verbose_name_plural = "FAQ Priorities"
         db_table = "baseApp_faq_categories"
         ordering = ['priority']
+
+
+# Full-text search, see fulltext.py
+SEARCH_KINDS = [('POST', 'Blog Post'),
+                ('FAQ', 'FAQ')]
+
+# A GIN index on PostgreSQL, other databases get a plain index of the (unused) column
+class SearchVectorIndex(models.Index):
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.vendor == 'postgresql':
+            using = ' USING gin'
+        return super().create_sql(model, schema_editor, using=using, **kwargs)
+
+# The plain text of one published Post or active FAQ, kept up to date by signals.py
+class SearchDocument(models.Model):
+    kind = models.CharField(max_length=10, choices=SEARCH_KINDS)
+    object_id = models.PositiveIntegerField()
+    language = models.CharField(max_length=20, choices=LANGUAGE_LIST, default='EN')
+    # HTML stripped and normalized (Arabic/Persian letters, digits, ZWNJ)
+    title = models.CharField(max_length=300)
+    body = models.TextField(blank=True)
+    # Only filled on PostgreSQL
+    vector = SearchVectorField(null=True, editable=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{} {}: {}'.format(self.kind, self.object_id, self.title)
+
+    class Meta():
+        unique_together = ['kind', 'object_id']
+        indexes = [models.Index(fields=['kind', 'language']),
+                   SearchVectorIndex(fields=['vector'], name='baseApp_search_vector_idx')]
+
+# Size and derivatives of an uploaded image (Asset, AssetImages, Slide, Post), see images.py
+class ImageInfo(models.Model):
+    # The storage name of the original, e.g. baseApp/property/photo.jpg
+    name = models.CharField(max_length=255, unique=True)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    # Widths of the WebP and JPEG derivatives, e.g. "320,640,960"
+    widths = models.CharField(max_length=100)
+    # A tiny blurred JPEG as a data URI, shown until the image is loaded
+    placeholder = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{} ({}x{})'.format(self.name, self.width, self.height)
+
+    class Meta():
+        verbose_name_plural = "Image Info"
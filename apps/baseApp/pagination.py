@@ -0,0 +1,153 @@
+## Pagination helpers for the list and search views
+## - CachedCountPaginator: the usual numbered pages, but the COUNT(*) is cached per query and content version.
+## - CursorPage: keyset (cursor) pagination on the ordering of the queryset (price, created, ... and id).
+##   A page is read with "WHERE (sort, id) > (last row)" instead of OFFSET, so page 1000 costs the same as page 1.
+##   The next/previous tokens are signed and opaque, a changed token is rejected.
+## - CursorPaginationMixin: opt-in cursor mode for a ListView, see CURSOR_PAGINATION in settings.py
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+from . import shared_context
+import hashlib
+
+COUNT_CACHE_TIMEOUT = 60 * 10
+CURSOR_SALT = 'baseApp.pagination.cursor'
+
+
+def cached_count(queryset):
+    # The COUNT(*) of a queryset, shared by every request with the same SQL until the content changes
+    sql, params = queryset.order_by().query.sql_with_params()
+    digest = hashlib.sha1('{}{}'.format(sql, params).encode('utf-8')).hexdigest()
+    key = 'count:{}:{}'.format(shared_context.get_content_version(), digest)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        return cached_count(self.object_list)
+
+
+def keyset_ordering(queryset):
+    # [(field, descending)] of the queryset ordering, always ending with the primary key so every row has one place.
+    # None if the ordering can not be used for a keyset (related fields or expressions).
+    names = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+    ordering = []
+    for name in names:
+        if not isinstance(name, str) or '__' in name or name == '?':
+            return None
+        ordering.append((name.lstrip('-'), name.startswith('-')))
+    pk = queryset.model._meta.pk.name
+    if not any(field in ['pk', pk] for field, descending in ordering):
+        ordering.append((pk, ordering[-1][1] if ordering else False))
+    return ordering
+
+
+def keyset_filter(ordering, values, backwards=False):
+    # (a, b, c) after (x, y, z) is: a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+    query = Q()
+    for i, (field, descending) in enumerate(ordering):
+        lookup = 'lt' if descending != backwards else 'gt'
+        condition = Q(**{'{}__{}'.format(field, lookup): values[i]})
+        for previous, value in zip(ordering[:i], values[:i]):
+            condition &= Q(**{previous[0]: value})
+        query |= condition
+    return query
+
+
+def order_by(ordering, backwards=False):
+    return ['-' + field if descending != backwards else field for field, descending in ordering]
+
+
+def encode_cursor(obj, ordering, direction):
+    # Dates and decimals go into the token as text, the database lookups accept them back as text
+    values = [getattr(obj, field) for field, descending in ordering]
+    values = [value if isinstance(value, (int, str)) or value is None else str(value) for value in values]
+    return signing.dumps({'v': values, 'd': direction, 'o': order_by(ordering)}, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(token, ordering):
+    try:
+        cursor = signing.loads(token, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        raise Http404('Invalid page')
+    # A token of another sort order is not a position in this one
+    if cursor.get('o') != order_by(ordering) or cursor.get('d') not in ['next', 'prev']:
+        raise Http404('Invalid page')
+    return cursor['v'], cursor['d']
+
+
+class CursorPage():
+    # Looks like a Django Page for the templates (object_list, has_next, has_previous, ...)
+    is_cursor = True
+
+    def __init__(self, queryset, per_page, token=None, ordering=None):
+        ordering = ordering or keyset_ordering(queryset)
+        backwards = False
+        result = queryset.order_by(*order_by(ordering))
+        if token:
+            values, direction = decode_cursor(token, ordering)
+            backwards = direction == 'prev'
+            result = result.filter(keyset_filter(ordering, values, backwards))
+            if backwards:
+                result = result.order_by(*order_by(ordering, backwards=True))
+
+        # One more row than the page tells if there is another page, without any COUNT
+        rows = list(result[:per_page + 1])
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+        self.object_list = rows
+        self.has_next_page = more if not backwards else True
+        self.has_previous_page = more if backwards else bool(token)
+        self.next_cursor = encode_cursor(rows[-1], ordering, 'next') if rows and self.has_next_page else None
+        self.previous_cursor = encode_cursor(rows[0], ordering, 'prev') if rows and self.has_previous_page else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+
+
+class CursorPaginationMixin():
+    # For ListViews. Numbered pages (?page=) are the default and keep working;
+    # the cursor mode is used for ?cursor= links, or for every request with CURSOR_PAGINATION = True in settings.py
+    paginator_class = CachedCountPaginator
+
+    def use_cursor(self, queryset):
+        if keyset_ordering(queryset) is None:
+            return False
+        if 'cursor' in self.request.GET:
+            return True
+        return getattr(settings, 'CURSOR_PAGINATION', False) and 'page' not in self.request.GET
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_cursor(queryset):
+            return super().paginate_queryset(queryset, page_size)
+        page = CursorPage(queryset, page_size, self.request.GET.get('cursor'))
+        return (None, page, page.object_list, page.has_other_pages())
+
+    def get_result_count(self):
+        # Number of all results from the cached count, the queryset itself is never loaded for it
+        return cached_count(self.get_queryset())
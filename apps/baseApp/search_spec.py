@@ -0,0 +1,218 @@
+## The property search (AssetFilterView) as one normalized object
+## The GET request is parsed and validated once into a SearchSpec. The spec then:
+##   - compiles into plain __in / range filters for the Asset queryset,
+##   - builds the "Qdetail" summary of the search page with one in_bulk query per model,
+##   - gives a canonical hash, so equivalent searches (reordered or repeated parameters) share
+##     one cached list of result ids. A page of the numbered pagination is a slice of that list,
+##     only the Assets of the page are read (SearchResults).
+
+from django.core.cache import cache
+from . import models, shared_context
+import hashlib
+import json
+
+
+RESULT_CACHE_TIMEOUT = 60 * 60
+
+# sort value >> order_by field
+SORT_FIELDS = {'price-ascending': 'price',
+               'price-descending': '-price',
+               'date-newest': '-created',
+               'date-oldest': 'created'}
+
+# tag_select value >> Asset.tag
+TAG_CODES = {'sale': 'FS',
+             'rent': 'FR'}
+
+# Asset.tag >> the deal name shown on the search page
+DEAL_NAMES = {'EN': {'FS': 'sale', 'FR': 'rent'},
+              'FA': {'FS': 'خرید', 'FR': 'اجاره'}}
+
+
+def int_set(values):
+    # Invalid values are ignored instead of raising a server error
+    result = set()
+    for value in values:
+        try:
+            result.add(int(value))
+        except (TypeError, ValueError):
+            pass
+    return frozenset(result)
+
+
+def float_range(values):
+    # A [min, max] pair of the sliders, None if it is missing or empty
+    try:
+        low, high = float(values[0]), float(values[1])
+    except (IndexError, TypeError, ValueError):
+        return None
+    return (min(low, high), max(low, high))
+
+
+def input_range(values):
+    # The [min, max] pair as the user typed it, for the search summary ("80 to 200", not "80.0 to 200.0")
+    if float_range(values) is None:
+        return None
+    return (values[0], values[1]) if float(values[0]) <= float(values[1]) else (values[1], values[0])
+
+
+class SearchResults():
+    # The cached result ids of a search as a sequence for the Paginator.
+    # Its length is the number of the ids (no COUNT query) and a slice reads only the Assets of that slice.
+
+    def __init__(self, ids, queryset):
+        self.ids = ids
+        self.queryset = queryset
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += len(self.ids)
+            if not 0 <= index < len(self.ids):
+                raise IndexError('search result index out of range')
+            asset = self.queryset.filter(pk=self.ids[index]).first()
+            if asset is None:
+                raise IndexError(f"Asset {self.ids[index]} of the search results was deleted")
+            return asset
+        ids = self.ids[index]
+        assets = self.queryset.in_bulk(ids)
+        # In the order of the search, an Asset which was deleted since is left out
+        return [assets[pk] for pk in ids if pk in assets]
+
+
+class SearchSpec():
+
+    def __init__(self, regions=(), types=(), complexes=(), references=(), bedrooms=(),
+                 installment=False, tag=None, price=None, area=None, sort=None, price_input=None, area_input=None):
+        self.regions = frozenset(regions)
+        self.types = frozenset(types)
+        self.complexes = frozenset(complexes)
+        self.references = frozenset(references)
+        self.bedrooms = frozenset(bedrooms)
+        self.installment = installment
+        self.tag = tag
+        self.price = price
+        self.area = area
+        self.sort = sort
+        # The ranges as they were typed, only for describe()
+        self.price_input = price_input or price
+        self.area_input = area_input or area
+
+    @classmethod
+    def from_query(cls, query, asset_types):
+        # asset_types is the list of ('FL', 'Flat') which the page uses for the propertyType_select names
+        type_codes = {name: code for code, name in asset_types}
+        return cls(
+            regions=int_set(query.getlist('region_select')),
+            types=[type_codes[t] for t in query.getlist('propertyType_select') if t in type_codes],
+            complexes=int_set(query.getlist('apartment_select')),
+            # Reference codes look like 'REF-00123', the pk comes after the first 6 characters
+            references=int_set(ref[6:] for ref in query.getlist('ref_select')),
+            bedrooms=int_set(query.getlist('bedroom_select')),
+            installment=query.get('installment_select') == '1',
+            tag=TAG_CODES.get(query.get('tag_select')),
+            price=float_range(query.getlist('price_select')),
+            area=float_range(query.getlist('space_select')),
+            sort=query.get('sort') if query.get('sort') in SORT_FIELDS else None,
+            price_input=input_range(query.getlist('price_select')),
+            area_input=input_range(query.getlist('space_select')),
+            )
+
+    def filters(self):
+        # Keyword arguments for Asset.objects.filter()
+        filters = {'active': True}
+        if self.regions:
+            filters['complex__region__in'] = sorted(self.regions)
+        if self.types:
+            filters['type__in'] = sorted(self.types)
+        if self.complexes:
+            filters['complex__in'] = sorted(self.complexes)
+        if self.references:
+            filters['pk__in'] = sorted(self.references)
+        if self.installment:
+            filters['installment'] = True
+        if self.bedrooms:
+            filters['bedroom__number__in'] = sorted(self.bedrooms)
+        if self.tag:
+            filters['tag'] = self.tag
+        if self.price:
+            filters['price__gte'], filters['price__lte'] = self.price
+        if self.area:
+            filters['build_area__gte'], filters['build_area__lte'] = self.area
+        return filters
+
+    def apply(self, queryset):
+        result = queryset.filter(**self.filters())
+        if self.sort:
+            result = result.order_by(SORT_FIELDS[self.sort])
+        return result
+
+    def canonical(self):
+        # The same search always gives the same string, whatever the order of the GET parameters
+        return json.dumps({'regions': sorted(self.regions),
+                           'types': sorted(self.types),
+                           'complexes': sorted(self.complexes),
+                           'references': sorted(self.references),
+                           'bedrooms': sorted(self.bedrooms),
+                           'installment': self.installment,
+                           'tag': self.tag,
+                           'price': self.price,
+                           'area': self.area,
+                           'sort': self.sort}, sort_keys=True)
+
+    def cache_key(self):
+        digest = hashlib.sha1(self.canonical().encode('utf-8')).hexdigest()
+        # Any change on the listings changes the content version, so old results are never served
+        return 'search:{}:{}'.format(shared_context.get_content_version(), digest)
+
+    def result_ids(self):
+        # The ordered list of matching Asset ids, shared by every equivalent search
+        key = self.cache_key()
+        ids = cache.get(key)
+        if ids is None:
+            ids = list(self.apply(models.Asset.objects.all()).values_list('pk', flat=True))
+            cache.set(key, ids, RESULT_CACHE_TIMEOUT)
+        return ids
+
+    def results(self, queryset):
+        # The cached ids as a sequence of the Assets of the queryset, for the numbered pages
+        return SearchResults(self.result_ids(), queryset)
+
+    def facet_selection(self):
+        # The selection format of facets.get_facet_counts()
+        return {'region': self.regions,
+                'complex': self.complexes,
+                'type': self.types,
+                'tag': self.tag,
+                'bedroom': self.bedrooms,
+                'installment': self.installment,
+                'price': self.price,
+                'area': self.area,
+                'reference': self.references}
+
+    def describe(self, language='EN', asset_types=models.ASSET_TYPES):
+        # Building a dictionary of the search with nice words in order to present them in the search result page.
+        # Region names and bedroom descriptions come from one in_bulk query each.
+        if self.regions:
+            regions = models.Region.objects.in_bulk(self.regions)
+            regionRequest = [regions[pk].name for pk in sorted(regions)]
+        else: regionRequest = 'no filter'
+
+        if self.bedrooms:
+            bedrooms = models.Bedroom.objects.in_bulk(self.bedrooms, field_name='number')
+            field = 'description_FA' if language == 'FA' else 'description'
+            bedroomRequest = [getattr(bedrooms[num], field) for num in sorted(bedrooms)]
+        else: bedroomRequest = 'no filter'
+
+        type_names = dict(asset_types)
+        return {
+                'QdealType': DEAL_NAMES[language][self.tag] if self.tag else 'no filter',
+                'Qregions': regionRequest,
+                'QpropertyTypes': set(type_names[t] for t in self.types) if self.types else 'no filter',
+                'Qprices': {'min': self.price_input[0], 'max': self.price_input[1]} if self.price else 'no filter',
+                'Qspace': {'min': self.area_input[0], 'max': self.area_input[1]} if self.area else 'no filter',
+                'Qroom': bedroomRequest,
+                }
@@ -0,0 +1,82 @@
+## The navigation/sidebar data which is shared by every public page (regions, bedrooms, price ranges, blog categories, ...)
+## It is built once per language and kept in the cache under a "content version" key.
+## signals.py changes the version whenever one of the related models is saved or deleted,
+## so a cache hit never runs any SQL and a stale payload is never served.
+
+from django.core.cache import cache
+from django.db.models import Max, Min
+from django.conf import settings
+from apps.blogApp import models as blogAppModel
+from . import models
+import uuid
+
+
+CONTENT_VERSION_KEY = 'shared_context:version'
+CACHE_TIMEOUT = 60 * 60 * 24
+
+# Blog categories which are shown directly on the Navbar instead of the Blog dropdown
+NAV_CATEGORY_PKS = {'EN': [14, 28, 29],
+                    'FA': [24, 27, 30]}
+
+
+def get_content_version():
+    # The version is a random token (not a counter) so an evicted version key can never bring an old payload back
+    version = cache.get(CONTENT_VERSION_KEY)
+    if version is None:
+        cache.add(CONTENT_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(CONTENT_VERSION_KEY)
+    return version
+
+
+def bump_content_version():
+    cache.set(CONTENT_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def build_shared_context(language):
+    # Both sliders ranges in one aggregate query
+    ranges = models.Asset.objects.filter(active=True).aggregate(Min('build_area'), Max('build_area'),
+                                                                Min('price'), Max('price'))
+    # Distinct codes instead of loading every Asset just to read its display names
+    type_names = dict(models.ASSET_TYPES)
+    tag_names = dict(models.TAG_CHOICES)
+    asset_types = models.Asset.objects.order_by().values_list('type', flat=True).distinct()
+    asset_tags = models.Asset.objects.order_by().values_list('tag', flat=True).distinct()
+    nav_pks = NAV_CATEGORY_PKS[language]
+    # All querysets are evaluated here, the cached payload must not hit the database when it is used in templates
+    extraContext = {
+        'DEBUG_VALUE': settings.DEBUG,
+        'regions': list(models.Region.objects.filter(regions__complexes__active=True).distinct()),
+        'propertyTypeNames': set(type_names.get(t, t) for t in asset_types),
+        'tagType': set(tag_names.get(t, t) for t in asset_tags),
+        'bedroomNumbers': list(models.Bedroom.objects.order_by('number')),
+        'spaceRange': {'build_area__min': ranges['build_area__min'], 'build_area__max': ranges['build_area__max']},
+        # ********for later expansion*********
+        # context['priceRangeRent'] = models.Asset.objects.filter(tag__exact='FR').aggregate(Min('price'), Max('price'))
+        'priceRange': {'price__min': ranges['price__min'], 'price__max': ranges['price__max']},
+        # Featured part of the page (singlePropertyThumbnail.html uses complex, region and bedroom)
+        'featuredProperties': list(models.Asset.objects.filter(active=True, featured=True)
+                                   .select_related('complex__region', 'bedroom')),
+        # Featured Blog posts of the language
+        'blogPosts': list(blogAppModel.Post.objects.filter(status=True, language=language, featured=True)),
+        # All blog categories
+        'blogCategories_All': list(blogAppModel.PostCategories.objects.filter(category_lang=language)),
+        # Blog Categories for the Blog dropdown
+        'blogCategories': list(blogAppModel.PostCategories.objects.filter(category_lang=language).exclude(pk__in=nav_pks)),
+        # Item for Navbar from Blog CategoryListView
+        'blogCategoriesNav': list(blogAppModel.PostCategories.objects.filter(category_lang=language, pk__in=nav_pks)),
+        # Apartments Unqiue names
+        'apartments': list(models.Complex.objects.filter(hide_name=False)),
+        # Default page for FAQ section.
+        'navbar_FAQ': 'all'
+        }
+    return extraContext
+
+
+def get_shared_context(language):
+    key = 'shared_context:{}:{}'.format(language, get_content_version())
+    extraContext = cache.get(key)
+    if extraContext is None:
+        extraContext = build_shared_context(language)
+        cache.set(key, extraContext, CACHE_TIMEOUT)
+    # Views may add their own items, so never hand out the cached dictionary itself
+    return dict(extraContext)
@@ -0,0 +1,117 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from apps.blogApp import models as blogAppModel
+from . import models, shared_context, facets, fulltext, detail_cache, images
+
+
+# Every change on these models changes the content of the shared context (navbar, sidebar, featured items)
+# and the cached result counts of the list pages (pagination.py)
+CONTENT_MODELS = [models.Asset, models.Region, models.Complex, models.Bedroom, models.FAQ, models.FAQPriority,
+                  blogAppModel.Post, blogAppModel.PostCategories]
+
+CONTENT_RELATIONS = [models.Asset.features.through, models.Complex.features.through,
+                     blogAppModel.Post.categories.through]
+
+
+def content_changed(sender, **kwargs):
+    shared_context.bump_content_version()
+
+
+def content_relation_changed(sender, action, **kwargs):
+    # m2m_changed is sent before and after each change, the content has changed only after it
+    if action.startswith('post_'):
+        shared_context.bump_content_version()
+
+
+for model in CONTENT_MODELS:
+    post_save.connect(content_changed, sender=model, dispatch_uid='content_saved_{}'.format(model.__name__))
+    post_delete.connect(content_changed, sender=model, dispatch_uid='content_deleted_{}'.format(model.__name__))
+
+for relation in CONTENT_RELATIONS:
+    m2m_changed.connect(content_relation_changed, sender=relation,
+                        dispatch_uid='content_relation_{}'.format(relation.__name__))
+
+
+# The facet index is updated one Asset at a time, after the commit (an index which is built from the database in
+# between would not have the row yet)
+def asset_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: facets.update_asset(instance))
+
+
+def asset_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: facets.remove_asset(pk))
+
+
+def facet_source_changed(sender, **kwargs):
+    facets.invalidate()
+
+
+post_save.connect(asset_saved, sender=models.Asset, dispatch_uid='facets_asset_saved')
+post_delete.connect(asset_deleted, sender=models.Asset, dispatch_uid='facets_asset_deleted')
+for model in [models.Complex, models.Region, models.Bedroom]:
+    post_save.connect(facet_source_changed, sender=model, dispatch_uid='facets_saved_{}'.format(model.__name__))
+    post_delete.connect(facet_source_changed, sender=model, dispatch_uid='facets_deleted_{}'.format(model.__name__))
+
+
+# The search document of a Post or FAQ is rebuilt on every save
+def search_source_saved(sender, instance, **kwargs):
+    fulltext.index_object(instance)
+
+
+def search_source_deleted(sender, instance, **kwargs):
+    fulltext.remove_object(fulltext.kind_of(instance), instance.pk)
+
+
+for model in [blogAppModel.Post, models.FAQ]:
+    post_save.connect(search_source_saved, sender=model, dispatch_uid='fulltext_saved_{}'.format(model.__name__))
+    post_delete.connect(search_source_deleted, sender=model, dispatch_uid='fulltext_deleted_{}'.format(model.__name__))
+
+
+# Change versions of the cached detail pages, see detail_cache.py
+def detail_asset_changed(sender, instance, **kwargs):
+    detail_cache.bump_asset(instance.asset_id if isinstance(instance, models.AssetImages) else instance.pk)
+
+
+def detail_complex_changed(sender, instance, **kwargs):
+    detail_cache.bump_complex(instance.complex_id if isinstance(instance, models.Distance) else instance.pk)
+
+
+def detail_shared_changed(sender, **kwargs):
+    detail_cache.bump_shared()
+
+
+def detail_features_changed(sender, instance, action, **kwargs):
+    if not action.startswith('post_'):
+        return
+    # From the other side (feature.asset_set.add()) the instance is the feature, it may be on many pages
+    if isinstance(instance, models.Asset):
+        detail_cache.bump_asset(instance.pk)
+    elif isinstance(instance, models.Complex):
+        detail_cache.bump_complex(instance.pk)
+    else:
+        detail_cache.bump_shared()
+
+
+DETAIL_SOURCES = [(models.Asset, detail_asset_changed), (models.AssetImages, detail_asset_changed),
+                  (models.Complex, detail_complex_changed), (models.Distance, detail_complex_changed)] + \
+                 [(model, detail_shared_changed) for model in [models.Country, models.City, models.Region, models.Location,
+                                                               models.Bedroom, models.AssetFeatures, models.ComplexFeatures]]
+
+for model, receiver in DETAIL_SOURCES:
+    post_save.connect(receiver, sender=model, dispatch_uid='detail_saved_{}'.format(model.__name__))
+    post_delete.connect(receiver, sender=model, dispatch_uid='detail_deleted_{}'.format(model.__name__))
+
+for relation in [models.Asset.features.through, models.Complex.features.through]:
+    m2m_changed.connect(detail_features_changed, sender=relation, dispatch_uid='detail_relation_{}'.format(relation.__name__))
+
+
+# The WebP/JPEG derivatives of a new image are made in a thread after the commit, see images.py
+def image_saved(sender, instance, **kwargs):
+    name = instance.image.name if instance.image else None
+    if name:
+        transaction.on_commit(lambda: images.schedule(name))
+
+
+for model in [models.Asset, models.AssetImages, models.Slide, blogAppModel.Post]:
+    post_save.connect(image_saved, sender=model, dispatch_uid='images_saved_{}'.format(model.__name__))
@@ -0,0 +1,58 @@
+
+# The WebP/JPEG derivatives of baseApp/images.py in the templates
+
+from django import template
+from django.utils.html import format_html
+from apps.baseApp import images
+
+register = template.Library()
+
+
+def prefetch_context(context):
+    # The first image of a page reads the info of all the images of the context at once
+    if getattr(context, 'images_prefetched', False):
+        return
+    context.images_prefetched = True
+    images.prefetch(images.image_names(value for layer in context.dicts for value in layer.values()))
+
+
+@register.simple_tag(takes_context=True)
+def responsive_image(context, image, sizes='100vw', alt='', css_class=''):
+    """
+    A <picture> with the WebP and JPEG derivatives of an ImageField, the browser downloads
+    only the width it needs for ``sizes``. The width and height keep the place of the image
+    while it loads, and the blurred placeholder is shown in that place.
+
+    {% responsive_image property.image sizes="(max-width: 767px) 100vw, 33vw" alt="Property Image" %}
+
+    Images without derivatives (not processed yet) are shown as a plain <img>.
+    """
+    if not image:
+        return ''
+    prefetch_context(context)
+    info = images.get_info(image.name)
+    if info is None:
+        return format_html('<img src="{}" alt="{}" class="{}" loading="lazy">', image.url, alt, css_class)
+    width, height, widths, placeholder = info
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" class="{}" loading="lazy" '
+        'decoding="async" style="height: auto; background-size: cover; background-image: url({});">'
+        '</picture>',
+        images.srcset(image.name, widths, 'webp'), sizes,
+        images.url(image.name, widths[-1]), images.srcset(image.name, widths, 'jpg'), sizes,
+        width, height, alt, css_class, placeholder)
+
+
+@register.simple_tag(takes_context=True)
+def image_url(context, image, width=1920):
+    """
+    The URL of the JPEG derivative for a width, for the CSS backgrounds of the slides:
+
+    <div style="background-image: url({% image_url slide.image 1920 %});">
+    """
+    if not image:
+        return ''
+    prefetch_context(context)
+    return images.url(image.name, int(width))
@@ -1,3 +1,471 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.template import Context, Template
+from django.http import Http404
+from apps.blogApp import models as blogAppModel
+from RealEstate.middleware import query_fingerprint
+from urllib.parse import quote
+import io
+import shutil
+import tempfile
+from PIL import Image
+from . import models, pagination, fulltext, detail_cache, images, facets, search_spec
 
 # Create your tests here.
+
+# Every test uses its own memory cache instead of the file cache of the project
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_catalog(assets=12, posts=6):
+    # A small but complete site: two regions, two complexes, enough listings and posts for more than one page.
+    # The numbers of items can be changed, the query budgets must not depend on them.
+    country = models.Country.objects.create()
+    city = models.City.objects.create(country=country, name='Istanbul', name_FA='استانبول')
+    regions = [models.Region.objects.create(city=city, name='Region {}'.format(i)) for i in range(2)]
+    location = models.Location.objects.create(name='Metro', name_FA='مترو')
+    complexes = []
+    for i, region in enumerate(regions):
+        complex = models.Complex.objects.create(name='Complex {}'.format(i), region=region)
+        for category, name in [('TOP', 'Pool'), ('SPORT', 'Gym')]:
+            feature, created = models.ComplexFeatures.objects.get_or_create(
+                category=category, features=name, defaults={'features_FA': name + ' FA'})
+            complex.features.add(feature)
+        models.Distance.objects.create(location=location, complex=complex)
+        complexes.append(complex)
+    bedrooms = [models.Bedroom.objects.create(number=i, description='{}+1'.format(i), description_FA='{} خوابه'.format(i))
+                for i in range(1, 4)]
+    features = [models.AssetFeatures.objects.create(features='Feature {}'.format(i), features_FA='ویژگی {}'.format(i))
+                for i in range(3)]
+    for use, name in models.PAGE_CHOICES:
+        models.Slide.objects.create(useFor=use, active=True, image='baseApp/slider/slide.jpg')
+
+    catalog = {'regions': regions, 'complexes': complexes, 'bedrooms': bedrooms, 'assets': [], 'posts': []}
+    for i in range(assets):
+        asset = models.Asset.objects.create(complex=complexes[i % 2], bedroom=bedrooms[i % 3], floor=i,
+                                            price=100000 * (i + 1), build_area=80 + i * 10, featured=(i % 3 == 0),
+                                            type=['FL', 'VI'][i % 2], tag=['FS', 'FR'][i % 2],
+                                            image='baseApp/property/asset.jpg')
+        asset.features.set(features)
+        for order in range(3):
+            models.AssetImages.objects.create(asset=asset, image='baseApp/property/image.jpg', display_order=order)
+        catalog['assets'].append(asset)
+
+    # FAQ category 1 and 6 are the 'all' categories of EN and FA
+    for pk, name, language in [(1, 'all', 'EN'), (6, 'همه', 'FA')]:
+        category = models.FAQCategories.objects.create(id=pk, category=name, slug=name, category_lang=language)
+        for i in range(4):
+            question = models.FAQ.objects.create(question='{} question {} apartment'.format(language, i),
+                                                 answer='<p>answer {}</p>'.format(i), language=language)
+            models.FAQPriority.objects.create(category=category, question=question, priority=i)
+
+    author = User.objects.create(username='author')
+    for slug, name, language in [('news', 'News', 'EN'), ('اخبار', 'اخبار', 'FA')]:
+        category = blogAppModel.PostCategories.objects.create(category=name, slug=slug, category_lang=language,
+                                                              image='blogApp/category.jpg')
+        for i in range(posts):
+            post = blogAppModel.Post.objects.create(author=author, title='{} post {}'.format(language, i),
+                                                    slug='{}-post-{}'.format(slug, i), language=language,
+                                                    content='<p>hello world {}</p>'.format(i),
+                                                    status=True, featured=(i < 3), image='blogApp/post.jpg')
+            post.categories.add(category)
+            catalog['posts'].append(post)
+    return catalog
+
+
+@override_settings(CACHES=TEST_CACHES)
+class QueryBudgetTestCase(TestCase):
+    # {url: maximum number of SQL queries} for a request with an empty cache.
+    # A failure here usually means a new N+1 loop (a query per item in a template or a view).
+    budgets = {}
+
+    def setUp(self):
+        cache.clear()
+        self.catalog = self.make_data()
+
+    def make_data(self):
+        return make_catalog()
+
+    def get_budgets(self):
+        return self.budgets
+
+    def request(self, url):
+        # FA urls are not ASCII
+        return self.client.get(quote(url, safe='/?=&'))
+
+    def test_query_budgets(self):
+        for url, budget in self.get_budgets().items():
+            with self.subTest(url=url):
+                cache.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.request(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(queries), budget, '{} ran {} queries (budget {}):\n{}'.format(
+                    url, len(queries), budget, '\n'.join(q['sql'] for q in queries.captured_queries)))
+
+
+class BaseAppQueryBudgetTest(QueryBudgetTestCase):
+
+    def get_budgets(self):
+        return {
+            '/': 18,
+            '/properties/': 18,
+            '/properties/?region_select={}&bedroom_select=1&bedroom_select=2&propertyType_select=Flat'
+            '&sort=price-ascending'.format(self.catalog['regions'][0].pk): 20,
+            '/properties/?page=2': 18,
+            '/properties/{}/'.format(self.catalog['assets'][0].pk): 19,
+            '/about-us/': 13,
+            '/FAQ/all/': 16,
+            '/FAQsearch/?s=apartment': 17,
+            '/RealSiteMap.xml': 35,
+        }
+
+
+@override_settings(CACHES=TEST_CACHES)
+class QueryBudgetMiddlewareTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalog(assets=3, posts=1)
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        response = self.client.get('/properties/')
+        self.assertGreater(int(response['X-Query-Count']), 0)
+        self.assertIn('X-Query-Time-Ms', response)
+        self.assertIn('X-Query-Duplicates', response)
+
+    def test_log_record(self):
+        with self.assertLogs('RealEstate.middleware', level='INFO') as logs:
+            response = self.client.get('/properties/')
+        self.assertNotIn('X-Query-Count', response)
+        self.assertGreater(logs.records[0].query_count, 0)
+
+    def test_fingerprint(self):
+        self.assertEqual(query_fingerprint('SELECT * FROM "a" WHERE "id" IN (1, 2, 3) LIMIT 21'),
+                         query_fingerprint('SELECT * FROM "a" WHERE "id" IN (%s) LIMIT 21'))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CursorPaginationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalog(assets=20, posts=1)
+
+    def walk(self, queryset, per_page):
+        pages = [pagination.CursorPage(queryset, per_page)]
+        while pages[-1].has_next():
+            pages.append(pagination.CursorPage(queryset, per_page, pages[-1].next_cursor))
+        return pages
+
+    def test_same_rows_as_offset_pages(self):
+        for ordering in [['price'], ['-price'], ['-created'], ['created']]:
+            queryset = models.Asset.objects.filter(active=True).order_by(*ordering)
+            pages = self.walk(queryset, 3)
+            self.assertEqual([asset.pk for page in pages for asset in page],
+                             list(queryset.order_by(*ordering, 'pk' if ordering[0][0] != '-' else '-pk')
+                                  .values_list('pk', flat=True)))
+            # Going back from the last page gives the same pages again
+            previous = pagination.CursorPage(queryset, 3, pages[-1].previous_cursor)
+            self.assertEqual(list(previous), list(pages[-2]))
+            self.assertFalse(pages[0].has_previous())
+
+    def test_changed_token(self):
+        first = pagination.CursorPage(models.Asset.objects.order_by('price'), 3)
+        with self.assertRaises(Http404):
+            pagination.CursorPage(models.Asset.objects.order_by('price'), 3, first.next_cursor + 'x')
+        # A token of another sort order
+        with self.assertRaises(Http404):
+            pagination.CursorPage(models.Asset.objects.order_by('-price'), 3, first.next_cursor)
+
+    def test_cursor_links(self):
+        response = self.client.get('/properties/?sort=price-ascending&cursor=')
+        self.assertTrue(response.context['page_obj'].is_cursor)
+        self.assertEqual(response.context['resultCount'], 20)
+        response = self.client.get('/properties/?sort=price-ascending&cursor={}'.format(
+            response.context['page_obj'].next_cursor))
+        self.assertEqual([asset.price for asset in response.context['assets_filtered']],
+                         sorted(asset.price for asset in models.Asset.objects.all())[9:18])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SearchResultPagesTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_catalog(assets=20, posts=1)
+
+    def test_page_reads_only_its_assets(self):
+        url = '/properties/?sort=price-ascending&page=2&space_select=80&space_select=200'
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        expected = list(models.Asset.objects.filter(build_area__lte=200).order_by('price')[9:13])
+        self.assertEqual(response.context['assets_filtered'], expected)
+        self.assertEqual(response.context['resultCount'], 13)
+        asset_queries = [q['sql'] for q in queries.captured_queries if 'FROM "baseApp_asset"' in q['sql']
+                         and '"baseApp_asset"."id" IN' in q['sql']]
+        # The page, by the 4 ids of the page only, and no COUNT
+        self.assertEqual(len(asset_queries), 1)
+        self.assertIn('IN ({})'.format(', '.join(str(asset.pk) for asset in expected)), asset_queries[0])
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql'] and 'baseApp_asset' in q['sql']])
+
+    def test_single_results(self):
+        assets = list(models.Asset.objects.order_by('pk'))
+        results = search_spec.SearchResults([asset.pk for asset in assets], models.Asset.objects.all())
+        self.assertEqual((results[0], results[-1]), (assets[0], assets[-1]))
+        with self.assertRaises(IndexError):
+            results[len(assets)]
+        assets[-1].delete()
+        with self.assertRaises(IndexError):
+            results[-1]
+
+    def test_summary_shows_the_typed_values(self):
+        response = self.client.get('/properties/?space_select=200&space_select=80')
+        self.assertEqual(response.context['Qdetail']['Qspace'], {'min': '80', 'max': '200'})
+        self.assertContains(response, '80 &nbsp to &nbsp 200')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class FacetIndexTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.catalog = make_catalog(assets=6, posts=1)
+        facets._local_index.update(version=None, change=0, rows=None)
+
+    def other_process(self):
+        facets._local_index.update(version=None, change=0, rows=None)
+
+    def test_changes_without_writing_the_index(self):
+        self.assertEqual(facets.get_facet_counts()['total'], 6)
+        index = cache.get(facets.INDEX_KEY)
+        asset = self.catalog['assets'][0]
+        with self.captureOnCommitCallbacks(execute=True):
+            asset.active = False
+            asset.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.catalog['assets'][1].delete()
+        self.assertEqual(facets.get_facet_counts()['total'], 4)
+        # The saves were changes of their own, the index in the cache is the one of before
+        self.assertEqual(cache.get(facets.INDEX_KEY), index)
+        self.other_process()
+        self.assertEqual(facets.get_facet_counts()['total'], 4)
+        self.assertEqual(facets._local_index['change'], 2)
+
+    def test_rebuild(self):
+        facets.get_index()
+        version = cache.get(facets.VERSION_KEY)
+        asset = self.catalog['assets'][0]
+        with self.captureOnCommitCallbacks(execute=True):
+            for price in range(facets.MAX_CHANGES + 1):
+                asset.price = price
+                asset.save()
+        self.assertEqual(facets.get_index()[asset.pk][facets.PRICE], facets.MAX_CHANGES)
+        self.assertNotEqual(cache.get(facets.VERSION_KEY), version)
+        self.assertEqual(cache.get(facets.INDEX_KEY)['change'], facets.MAX_CHANGES + 1)
+
+    def test_lost_change(self):
+        facets.get_index()
+        assets = self.catalog['assets']
+        with self.captureOnCommitCallbacks(execute=True):
+            assets[0].active = False
+            assets[0].save()
+            assets[2].active = False
+            assets[2].save()
+        cache.delete(facets.change_key(1))
+        self.assertEqual(facets.get_facet_counts()['total'], 4)
+        # A change which is not saved yet (the last one) is applied later
+        with self.captureOnCommitCallbacks(execute=True):
+            assets[3].active = False
+            assets[3].save()
+        cache.delete(facets.change_key(3))
+        self.assertEqual(facets.get_facet_counts()['total'], 4)
+        cache.set(facets.change_key(3), (assets[3].pk, None))
+        self.assertEqual(facets.get_facet_counts()['total'], 3)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class FullTextSearchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(username='writer')
+
+    def post(self, title, content, language='EN', status=True):
+        return blogAppModel.Post.objects.create(author=self.author, title=title, slug=title, content=content,
+                                                language=language, status=status)
+
+    def test_normalize(self):
+        self.assertEqual(fulltext.normalize('<p>Sea&nbsp;view</p><p>pool</p>'), 'Sea view pool')
+        # Arabic letters, ZWNJ and Persian digits
+        self.assertEqual(fulltext.tokenize('كيش مي\u200cخواهم ۱۲'), fulltext.tokenize('کیش می خواهم 12'))
+
+    def test_ranking_and_updates(self):
+        body = self.post('Garden flat', '<p>A flat with a sea view and a garden.</p>')
+        title = self.post('Sea view apartments', '<p>Apartments near the coast, sea view from every room.</p>')
+        self.post('Draft sea view', '<p>sea view</p>', status=False)
+        self.assertEqual(fulltext.search('POST', 'EN', 'sea view'), [title.pk, body.pk])
+        self.assertEqual(fulltext.search('POST', 'EN', 'garden'), [body.pk])
+        self.assertEqual(fulltext.search('POST', 'FA', 'sea'), [])
+        # Unpublished and deleted posts leave the search
+        body.status = False
+        body.save()
+        self.assertEqual(fulltext.search('POST', 'EN', 'sea'), [title.pk])
+        title.delete()
+        self.assertEqual(fulltext.search('POST', 'EN', 'sea'), [])
+
+    def test_persian_spellings(self):
+        post = self.post('خانه در كيش', '<p>آپارتمان\u200cهای نزديک دريا</p>', language='FA')
+        self.assertEqual(fulltext.search('POST', 'FA', 'کیش'), [post.pk])
+        self.assertEqual(fulltext.search('POST', 'FA', 'آپارتمان دریا'), [post.pk])
+
+    def test_snippets(self):
+        post = self.post('Coast', '<p>Quiet street. The <b>beach</b> is close & clean.</p>')
+        snippet = fulltext.snippets('POST', 'EN', 'beach', [post.pk])[post.pk]
+        self.assertEqual(snippet, 'Quiet street. The <mark>beach</mark> is close &amp; clean.')
+
+    def test_rebuild(self):
+        post = self.post('Sea', '<p>sea</p>')
+        models.SearchDocument.objects.all().delete()
+        self.assertEqual(fulltext.search('POST', 'EN', 'sea'), [])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(fulltext.search('POST', 'EN', 'sea'), [post.pk])
+
+    def test_search_page(self):
+        make_catalog(assets=1, posts=3)
+        response = self.client.get('/blog/search/keyword/?s=world 2')
+        self.assertEqual([post.title for post in response.context['allPosts']], ['EN post 2'])
+        self.assertEqual(response.context['allPosts'][0].snippet, 'hello <mark>world</mark> <mark>2</mark>')
+
+    def test_search_pages(self):
+        make_catalog(assets=1, posts=20)
+        ranking = fulltext.search('POST', 'EN', 'world')
+        self.assertEqual(len(ranking), 20)
+        self.assertEqual(fulltext.count('POST', 'EN', 'world'), 20)
+        self.assertEqual(fulltext.search('POST', 'EN', 'world', 8, 16), ranking[16:])
+        # The last page has the rest of the matches, every page reads only its own posts
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/blog/search/keyword/?s=world&page=3')
+        self.assertEqual([post.pk for post in response.context['allPosts']], ranking[16:])
+        self.assertEqual(response.context['resultCount'], 20)
+        self.assertEqual(response.context['page_obj'].paginator.num_pages, 3)
+        self.assertIn('IN ({})'.format(', '.join(str(pk) for pk in ranking[16:])),
+                      ' '.join(q['sql'] for q in queries.captured_queries))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DetailRenderCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.asset = make_catalog(assets=2, posts=1)['assets'][0]
+        self.url = '/properties/{}/'.format(self.asset.pk)
+
+    def test_cached_body(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        # Only the Asset and the reference numbers of the sidebar, the body comes from the cache
+        self.assertEqual(len(queries), 2)
+        self.assertContains(response, 'property/image.jpg', count=3)
+        # The contact form is not part of the cache
+        response = self.client.post(self.url, {'name': 'Visitor'})
+        self.assertContains(response, 'property/image.jpg', count=3)
+        self.assertContains(response, 'value="Visitor"')
+
+    def test_changes(self):
+        self.client.get(self.url)
+        models.AssetImages.objects.create(asset=self.asset, image='baseApp/property/new.jpg', display_order=5)
+        self.assertContains(self.client.get(self.url), 'property/new.jpg')
+        distance = self.asset.complex.distances.first()
+        distance.location.name = 'Tram'
+        distance.location.save()
+        self.assertContains(self.client.get(self.url), 'Tram')
+        self.asset.complex.features.add(models.ComplexFeatures.objects.create(category='GENERAL', features='Sauna'))
+        self.assertContains(self.client.get(self.url), 'Sauna')
+        # Another asset of the same complex keeps its cached page
+        other = models.Asset.objects.exclude(pk=self.asset.pk).first()
+        versions = [detail_cache.AssetDetail(asset).version for asset in [self.asset, other]]
+        self.asset.save()
+        self.assertNotEqual(detail_cache.AssetDetail(self.asset).version, versions[0])
+        self.assertEqual(detail_cache.AssetDetail(other).version, versions[1])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ImageDerivativeTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media)
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media)
+
+    def upload(self, width, height):
+        output = io.BytesIO()
+        Image.new('RGB', (width, height), (200, 120, 40)).save(output, 'JPEG')
+        return SimpleUploadedFile('photo.jpg', output.getvalue(), content_type='image/jpeg')
+
+    @override_settings(IMAGE_DERIVATIVE_WORKERS=0)
+    def test_derivatives_on_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            slide = models.Slide.objects.create(useFor='HOME', image=self.upload(1000, 500))
+        info = models.ImageInfo.objects.get(name=slide.image.name)
+        self.assertEqual((info.width, info.height, info.widths), (1000, 500, '320,640,960,1000'))
+        self.assertTrue(info.placeholder.startswith('data:image/jpeg;base64,'))
+        with default_storage.open(images.derivative_name(slide.image.name, 640, 'webp')) as file:
+            self.assertEqual(Image.open(file).size, (640, 320))
+        self.assertTrue(default_storage.exists(images.derivative_name(slide.image.name, 1000, 'jpg')))
+
+        html = Template('{% load responsive_images %}{% responsive_image slide.image sizes="50vw" alt="Slide" %}'
+                        '{% image_url slide.image 700 %}').render(Context({'slide': slide}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('-320w.webp 320w, ', html)
+        self.assertIn('width="1000" height="500"', html)
+        self.assertTrue(html.endswith('-960w.jpg'))
+
+    def test_after_the_save(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            slide = models.Slide.objects.create(useFor='HOME', image=self.upload(400, 300))
+        # Not in the request of the save
+        self.assertFalse(models.ImageInfo.objects.exists())
+        with self.settings(IMAGE_DERIVATIVE_WORKERS=0):
+            for callback in callbacks:
+                callback()
+        self.assertEqual(images.get_info(slide.image.name)[:3], (400, 300, [320, 400]))
+
+    def test_info_of_one_image(self):
+        images.save_info({'name': 'a.jpg', 'width': 10, 'height': 5, 'widths': '10', 'placeholder': ''})
+        models.ImageInfo.objects.create(name='b.jpg', width=20, height=5, widths='20')
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(images.get_info('b.jpg'), (20, 5, [20], ''))
+            self.assertIsNone(images.get_info('c.jpg'))
+            images.get_info('b.jpg')
+            images.get_info('c.jpg')
+        # One query per image, by its name, the other rows are not read
+        self.assertEqual(len(queries), 2)
+        self.assertIn('"baseApp_imageinfo"."name" = ', queries[0]['sql'])
+
+    def test_without_derivatives(self):
+        slide = models.Slide.objects.create(useFor='HOME', image='baseApp/slider/missing.jpg')
+        html = Template('{% load responsive_images %}{% responsive_image slide.image %}').render(Context({'slide': slide}))
+        self.assertEqual(html, '<img src="/media/baseApp/slider/missing.jpg" alt="" class="" loading="lazy">')
+
+    def test_backfill(self):
+        name = default_storage.save('baseApp/slider/old.jpg', self.upload(400, 300))
+        models.Slide.objects.create(useFor='HOME', image=name)
+        models.ImageInfo.objects.all().delete()
+        call_command('generate_image_derivatives', workers=1, stdout=io.StringIO())
+        self.assertEqual(models.ImageInfo.objects.get(name=name).widths, '320,400')
@@ -1,3 +1,13 @@
 from django.test import TestCase
+from apps.baseApp.tests import QueryBudgetTestCase
 
 # Create your tests here.
+
+class BlogAppQueryBudgetTest(QueryBudgetTestCase):
+    budgets = {
+        '/blog/': 16,
+        '/blog/?page=2': 16,
+        '/blog/category/news/': 16,
+        '/blog/news-post-0/': 15,
+        '/blog/search/keyword/?s=hello': 16,
+    }
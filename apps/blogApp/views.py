@@ -2,32 +2,22 @@ from django.shortcuts import render
 from django.views import generic
 from . import models
 from apps.baseApp import models as baseAppModel
-from django.db.models import Q
-from django.conf import settings
+from apps.baseApp import shared_context, list_views, fulltext
+from django.db.models import F
 
 
 # Here is the Extra Context ditionary which is used in get_context_data of Views classes
+# It is built once per language and cached, see baseApp/shared_context.py
 def get_extra_context():
-    extraContext = {
-        'DEBUG_VALUE': settings.DEBUG,
-        'featuredProperties': baseAppModel.Asset.objects.filter(featured=True),
-        # All blog categories
-        'blogCategories_All': models.PostCategories.objects.filter(category_lang='EN'),
-        # Specific Blog Categories with EN language filter
-        'blogCategories': models.PostCategories.objects.filter(category_lang='EN').exclude(pk__in=[14, 28, 29]),
-        # Item for Navbar from Blog CategoryListView
-        'blogCategoriesNav': models.PostCategories.objects.filter(category_lang='EN', pk__in=[14, 28, 29]),
-        # Default page for FAQ section.
-        'navbar_FAQ': 'all'
-        }
-    return extraContext
-
-
-class PostList(generic.ListView):
+    return shared_context.get_shared_context('EN')
+
+
+class PostList(list_views.MemoListView):
     context_object_name = 'allPosts'
     queryset = models.Post.objects.filter(language='EN', status=True).order_by('-created_on')
     template_name = 'blogApp/blog.html'
     paginate_by = 3
+    prefetch_related = ['categories']
 
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
@@ -40,15 +30,15 @@ class PostList(generic.ListView):
 
         return context
 
-class CategoryListView(generic.ListView):
+class CategoryListView(list_views.MemoListView):
     context_object_name = 'allPosts'
     model = models.Post
     template_name = 'blogApp/search_result.html'
     paginate_by = 8
+    select_related = ['author']
+    count_results = True
 
-    def get_queryset(self, **kwargs):
-        result = super(CategoryListView, self).get_queryset()
-
+    def filter_queryset(self, result):
         # Categories -- For filtering based on the categories
         result= result.filter(language='EN', categories__slug=self.kwargs['category'], status=True).order_by('-created_on')
         return result
@@ -63,8 +53,6 @@ class CategoryListView(generic.ListView):
         # This title is different for this view
         context['slideContent'] = models.PostCategories.objects.get(slug=self.kwargs['category'])
         context['pageTitle'] = models.PostCategories.objects.get(slug=self.kwargs['category']).category
-        # result counte
-        context['resultCount'] = len(self.get_queryset())
         return context
 
 class PostDetail(generic.DetailView):
@@ -74,8 +62,9 @@ class PostDetail(generic.DetailView):
 
     def get_object(self, **kwargs):
         singleResult = self.model.objects.get(slug=self.kwargs['slug'], status=True)
-        # To implement save method on the model which adds view count
-        singleResult.save()
+        # Add one view count with a single UPDATE. Calling save() here would send post_save on every visit
+        # and invalidate the cached shared context (see baseApp/signals.py)
+        self.model.objects.filter(pk=singleResult.pk).update(view=F('view') + 1)
         return singleResult
 
     def get_context_data(self, **kwargs):
@@ -86,24 +75,26 @@ class PostDetail(generic.DetailView):
 
         # This view have no pageTitle
         # Get the first PostCategories object of the current post
-        context['slideContent'] = self.get_object().categories.first()
+        context['slideContent'] = self.object.categories.first()
 
         return context
 
-class PostSearch(generic.ListView):
+class PostSearch(list_views.FullTextSearchView):
     context_object_name = 'allPosts'
     template_name = 'blogApp/search_result.html'
     model = models.Post
     paginate_by = 8
+    search_kind = 'POST'
+    search_language = 'EN'
+    select_related = ['author']
+    count_results = True
 
-    def get_queryset(self, **kwargs):
-        result = super(PostSearch, self).get_queryset()
-
+    def filter_queryset(self, result):
         # Get the GET content >>> name='s'
         keyword = self.request.GET.get('s')
         if not(keyword==None or keyword==''):
-            # Content Search -- For filtering based on the Text Search
-            result= result.filter(Q(title__icontains=keyword) | Q(content__icontains=keyword), language='EN', status=True).order_by('-created_on')
+            # Full-text Search -- The best matches first, a page at a time, see FullTextSearchView
+            result= result.filter(language='EN', status=True)
 
         return result
 
@@ -115,7 +106,10 @@ class PostSearch(generic.ListView):
 
         # This title is different for this view
         context['slideContent'] = baseAppModel.Slide.objects.get(useFor__exact='BLOG_SEARCH', active__exact=True)
+        # The parts of the posts with the searched words, instead of the short content
+        posts = self.get_rows()
+        snippets = fulltext.snippets('POST', 'EN', self.request.GET.get('s'), [post.pk for post in posts])
+        for post in posts:
+            post.snippet = snippets.get(post.pk)
         context['pageTitle'] = 'SEARCH'
-        # result counte
-        context['resultCount'] = len(self.get_queryset())
         return context
@@ -1,3 +1,9 @@
 from django.test import TestCase
+from apps.baseApp.tests import QueryBudgetTestCase
 
 # Create your tests here.
+
+class ChatAppQueryBudgetTest(QueryBudgetTestCase):
+    budgets = {
+        '/chat/': 2,
+    }
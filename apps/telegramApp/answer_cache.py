@@ -0,0 +1,146 @@
+## Cache of the OpenAI answers of the DictionaryBot and the PhraseBot
+## A word or topic which was asked before is answered without a call to OpenAI. The key is the question folded to
+## lower case with its whitespace collapsed, the model and the version of the prompt, so "Take  Off" and "take off"
+## share one answer and a new prompt or model does not use the old answers.
+## - LLMAnswer rows in the database, they expire after TELEGRAM_ANSWER_CACHE_DAYS and prune() (cron) deletes the
+##   expired ones and the least recently used above TELEGRAM_ANSWER_CACHE_ENTRIES.
+## - In front of them a small LRU of LOCAL_SIZE answers per process, a repeated question does not even read a row.
+##   LLMAnswer.hits counts the reads of the row, a question asked again in the same process within LOCAL_TTL is not
+##   counted again.
+## - python manage.py warm_answer_cache asks the most frequent questions again before their answers expire.
+##
+## answer = answer_cache.get_or_ask('dictionary', word, MODEL, PROMPT_VERSION, lambda: ask_openai(word))
+
+from collections import OrderedDict
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from datetime import timedelta
+from typing import Callable, List, Optional, Tuple
+from .models import LLMAnswer
+import hashlib
+import os
+import threading
+import time
+
+MAX_DAYS = 30
+MAX_ENTRIES = 20000
+# Longer questions are not looked up again, they are hardly ever asked twice
+MAX_QUESTION = 200
+LOCAL_SIZE = 256
+# An answer of the process is checked against the database again after this, another process may have renewed it
+LOCAL_TTL = 10 * 60
+
+_lock = threading.Lock()
+# key >> (answer, time it was read)
+_local: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+_local_pid = None
+
+
+def normalize(question: str) -> str:
+    return " ".join(question.casefold().split())
+
+
+def answer_key(bot: str, question: str, model: str, prompt_version: int) -> str:
+    return hashlib.sha256(f"{bot}|{model}|{prompt_version}|{normalize(question)}".encode()).hexdigest()
+
+
+def ttl() -> timedelta:
+    return timedelta(days=getattr(settings, 'TELEGRAM_ANSWER_CACHE_DAYS', MAX_DAYS))
+
+
+def local_get(key: str) -> Optional[str]:
+    global _local_pid
+    with _lock:
+        # A forked worker process starts empty
+        if _local_pid != os.getpid():
+            _local.clear()
+            _local_pid = os.getpid()
+        cached = _local.get(key)
+        if cached is None or time.monotonic() - cached[1] > LOCAL_TTL:
+            return None
+        _local.move_to_end(key)
+        return cached[0]
+
+
+def local_set(key: str, answer: str) -> None:
+    with _lock:
+        _local[key] = (answer, time.monotonic())
+        _local.move_to_end(key)
+        while len(_local) > LOCAL_SIZE:
+            _local.popitem(last=False)
+
+
+def clear_local() -> None:
+    with _lock:
+        _local.clear()
+
+
+def lookup(bot: str, question: str, model: str, prompt_version: int) -> Optional[str]:
+    """The answer which was given before, from the process or the database (a hit is counted)."""
+    key = answer_key(bot, question, model, prompt_version)
+    answer = local_get(key)
+    if answer is not None:
+        return answer
+    now = timezone.now()
+    row = LLMAnswer.objects.filter(key=key, expires_at__gt=now).values_list('pk', 'answer').first()
+    if row is None:
+        return None
+    LLMAnswer.objects.filter(pk=row[0]).update(hits=F('hits') + 1, last_used_at=now)
+    local_set(key, row[1])
+    return row[1]
+
+
+def store(bot: str, question: str, model: str, prompt_version: int, answer: str) -> None:
+    """Save an answer of OpenAI, it replaces an expired one of the same question."""
+    key = answer_key(bot, question, model, prompt_version)
+    now = timezone.now()
+    fields = {'answer': answer, 'expires_at': now + ttl(), 'last_used_at': now}
+    if not LLMAnswer.objects.filter(key=key).update(**fields):
+        try:
+            with transaction.atomic():
+                LLMAnswer.objects.create(key=key, bot=bot, question=normalize(question), model=model,
+                                         prompt_version=prompt_version, **fields)
+        except IntegrityError:
+            # Saved by a parallel request
+            LLMAnswer.objects.filter(key=key).update(**fields)
+    local_set(key, answer)
+
+
+def get_or_ask(bot: str, question: str, model: str, prompt_version: int, ask: Callable[[], str]) -> str:
+    """The cached answer of the question, ask() (OpenAI) only when there is none. Errors of ask() are not cached."""
+    if not 0 < len(normalize(question)) <= MAX_QUESTION:
+        return ask()
+    answer = lookup(bot, question, model, prompt_version)
+    if answer is None:
+        answer = ask()
+        if answer:
+            store(bot, question, model, prompt_version, answer)
+    return answer
+
+
+def expires_within(bot: str, question: str, model: str, prompt_version: int, within: timedelta) -> bool:
+    """Whether the question has no answer which is still good after within."""
+    return not LLMAnswer.objects.filter(key=answer_key(bot, question, model, prompt_version),
+                                        expires_at__gt=timezone.now() + within).exists()
+
+
+def frequent(bot: str, model: str, prompt_version: int, limit: int, expiring_within: timedelta) -> List[str]:
+    """The most asked questions of the bot whose answers expire within expiring_within (or have expired)."""
+    return list(LLMAnswer.objects.filter(bot=bot, model=model, prompt_version=prompt_version, hits__gt=0,
+                                         expires_at__lt=timezone.now() + expiring_within)
+                .order_by('-hits', '-last_used_at').values_list('question', flat=True)[:limit])
+
+
+def prune(max_entries: Optional[int] = None) -> int:
+    """Delete the expired answers and the least recently used above max_entries, returns their number."""
+    max_entries = getattr(settings, 'TELEGRAM_ANSWER_CACHE_ENTRIES', MAX_ENTRIES) if max_entries is None \
+        else max_entries
+    deleted, _ = LLMAnswer.objects.filter(expires_at__lte=timezone.now()).delete()
+    while True:
+        over = list(LLMAnswer.objects.order_by('-last_used_at', '-pk')
+                    .values_list('pk', flat=True)[max_entries:max_entries + 1000])
+        if not over:
+            return deleted
+        deleted += LLMAnswer.objects.filter(pk__in=over).delete()[0]
@@ -0,0 +1,91 @@
+## Numbers of the birthday report of a user (BIRTHDAY REPORT of the BirthdayBot), worked out by the database:
+## 1. the age statistics in one aggregate (the ages are not read row by row),
+## 2. the Gregorian month, Persian month and zodiac counts in one GROUP BY, the zodiac sign from day_of_year ranges.
+## The numbers are cached per user under a version token. GlobalBirthday.save()/delete() change the version of the
+## user (forget()), so a user who did not change a birthday gets the report without any SQL. The ages change with
+## the date, the date is part of the cache key.
+##
+## stats = birthday_report.get(user_id)      >> None when the user has no birthdays
+
+from django.core.cache import cache
+from django.db.models import Case, CharField, Count, IntegerField, Max, Min, Q, Sum, Value, When
+from django.db.models.functions import ExtractYear
+from django.utils import timezone
+from datetime import date
+from typing import Any, Dict, Optional
+from .models import GlobalBirthday, ZODIAC_SIGNS, day_of_year
+import uuid
+
+REPORT_TTL = 60 * 60 * 24
+
+
+def version_key(user_id: str) -> str:
+    return f"telegram:report:version:{user_id}"
+
+
+def get_version(user_id: str) -> str:
+    # A random token, not a counter, an evicted version key can never bring an old report back
+    version = cache.get(version_key(user_id))
+    if version is None:
+        cache.add(version_key(user_id), uuid.uuid4().hex, REPORT_TTL)
+        version = cache.get(version_key(user_id))
+    return version
+
+
+def forget(user_id: str) -> None:
+    """The birthdays of the user changed, the next report is worked out again."""
+    cache.set(version_key(user_id), uuid.uuid4().hex, REPORT_TTL)
+
+
+def age_on(birth_date: date, today: date) -> int:
+    return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
+
+
+def zodiac_of_day():
+    """The zodiac sign of day_of_year as a CASE of day ranges, no join and no Python per row."""
+    whens = [When(day_of_year__lte=day_of_year(month, day), then=Value(sign))
+             for sign, month, day in ZODIAC_SIGNS]
+    return Case(*whens, default=Value(ZODIAC_SIGNS[-1][0]), output_field=CharField())
+
+
+def build(user_id: str, today: date) -> Optional[Dict[str, Any]]:
+    """The numbers of the report of a user on a date, in two queries."""
+    birthdays = GlobalBirthday.objects.filter(added_by=user_id).order_by()
+    # The birthdays which are still to come this year, their age is one less than the difference of the years
+    later = Q(birth_date__month__gt=today.month) | Q(birth_date__month=today.month, birth_date__day__gt=today.day)
+    ages = birthdays.aggregate(total=Count('id'), first=Min('birth_date'), last=Max('birth_date'),
+                               years=Sum(ExtractYear('birth_date'), output_field=IntegerField()),
+                               later=Count('id', filter=later))
+    total = ages['total']
+    if not total:
+        return None
+
+    groups = birthdays.annotate(zodiac=zodiac_of_day()) \
+        .values_list('birth_month', 'persian_month', 'zodiac').annotate(count=Count('id'))
+    months, persian_months, zodiac = {}, {}, {}
+    for month, persian_month, sign, count in groups:
+        months[month] = months.get(month, 0) + count
+        persian_months[persian_month] = persian_months.get(persian_month, 0) + count
+        zodiac[sign] = zodiac.get(sign, 0) + count
+    return {
+        'total': total,
+        # The youngest has the latest birth date
+        'youngest': age_on(ages['last'], today),
+        'oldest': age_on(ages['first'], today),
+        'average': (total * today.year - ages['years'] - ages['later']) / total,
+        'months': months,
+        'persian_months': persian_months,
+        'zodiac': sorted(zodiac.items(), key=lambda item: item[1], reverse=True),
+    }
+
+
+def get(user_id: str, today: Optional[date] = None) -> Optional[Dict[str, Any]]:
+    """The report numbers of a user from the cache, worked out when the user's birthdays changed."""
+    today = today or timezone.now().date()
+    key = f"telegram:report:{user_id}:{get_version(user_id)}:{today.isoformat()}"
+    stats = cache.get(key)
+    if stats is None:
+        stats = build(user_id, today)
+        # A user without birthdays is cached too
+        cache.set(key, stats or {}, REPORT_TTL)
+    return stats or None
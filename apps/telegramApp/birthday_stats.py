@@ -0,0 +1,99 @@
+## Statistics of the BirthdayBot for the admins (/stats, VIEW STATISTICS, /users)
+## The figures of every day are kept in one BirthdayBotDailyStats row which is updated as things happen, so the admin
+## views read a handful of precomputed rows instead of counting the tables:
+## - users / birthdays: +1 / -1 when a user or a birthday is saved or deleted (models.py),
+## - active_users: +1 on the first update of a user on the day (seen(), deduplicated in the cache),
+## - reminders_sent: by the reminder job, messages_failed: by BirthdayBot.call() for the refused sends.
+## The row of a day starts from the counted totals, and the reminder job counts them again every day (snapshot()),
+## changes which skip save() (bulk deletes, the admin) do not add up.
+##
+## birthday_stats.add(reminders_sent=10)
+## rows = birthday_stats.history(7)      >> the last 7 days, today first
+## birthday_stats.active_users(30)        >> the users who changed their settings in the last 30 days, one count
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+from .models import BirthdayBotDailyStats, GlobalBirthday, UserBirthdaySettings
+
+# Figures which are totals of the tables, the others are counted on the day
+TOTAL_FIELDS = ['users', 'birthdays']
+ACTIVE_TTL = 60 * 60 * 48
+
+
+def totals() -> Dict[str, int]:
+    """The users and birthdays counted in the tables."""
+    return {'users': UserBirthdaySettings.objects.values('user_id').distinct().count(),
+            'birthdays': GlobalBirthday.objects.count()}
+
+
+def start_day(day: date) -> BirthdayBotDailyStats:
+    """The row of a day, created from the counted totals when it does not exist yet."""
+    try:
+        with transaction.atomic():
+            return BirthdayBotDailyStats.objects.create(day=day, **totals())
+    except IntegrityError:
+        # Created by a parallel update
+        return BirthdayBotDailyStats.objects.get(day=day)
+
+
+def add(day: Optional[date] = None, **counts: int) -> None:
+    """Add to the figures of a day (today), e.g. add(birthdays=1) or add(reminders_sent=25, messages_failed=1)."""
+    day = day or timezone.now().date()
+    changes = {field: F(field) + count for field, count in counts.items() if count}
+    if not changes:
+        return
+    if BirthdayBotDailyStats.objects.filter(day=day).update(updated_at=timezone.now(), **changes):
+        return
+    start_day(day)
+    # The new row has the totals with this change already in them
+    changes = {field: change for field, change in changes.items() if field not in TOTAL_FIELDS}
+    if changes:
+        BirthdayBotDailyStats.objects.filter(day=day).update(updated_at=timezone.now(), **changes)
+
+
+def seen(user_id: str) -> None:
+    """A user sent an update, counted once per day."""
+    day = timezone.now().date()
+    if cache.add(f"telegram:stats:active:{day.isoformat()}:{user_id}", 1, ACTIVE_TTL):
+        add(day, active_users=1)
+
+
+def snapshot(day: Optional[date] = None) -> BirthdayBotDailyStats:
+    """Count the totals of the day again, so that the changes which skipped save() are in them."""
+    day = day or timezone.now().date()
+    stats, _ = BirthdayBotDailyStats.objects.update_or_create(day=day, defaults=totals())
+    return stats
+
+
+def active_users(days: int = 30) -> int:
+    """The settings rows which changed in the last days (the "Active Users (30d)" of /stats)."""
+    return UserBirthdaySettings.objects.filter(updated_at__gte=timezone.now() - timedelta(days=days)).count()
+
+
+def history(days: int = 7) -> List[BirthdayBotDailyStats]:
+    """The rows of the last days, today first (it is created when nothing happened today yet)."""
+    today = timezone.now().date()
+    rows = list(BirthdayBotDailyStats.objects.filter(day__gt=today - timedelta(days=days)).order_by('-day'))
+    if not rows or rows[0].day != today:
+        rows.insert(0, start_day(today))
+    return rows
+
+
+def top_users(limit: int = 5):
+    """The users with the most birthdays and their names, in one query."""
+    name = UserBirthdaySettings.objects.filter(user_id=OuterRef('added_by')).order_by('pk').values('user_name')[:1]
+    return GlobalBirthday.objects.order_by().values('added_by') \
+        .annotate(birthday_count=Count('id'), user_name=Subquery(name)) \
+        .order_by('-birthday_count', 'added_by')[:limit]
+
+
+def with_birthday_counts(users):
+    """The UserBirthdaySettings of the queryset with their birthday_count, counted by the same query."""
+    count = GlobalBirthday.objects.filter(added_by=OuterRef('user_id')).order_by().values('added_by') \
+        .annotate(count=Count('id')).values('count')
+    return users.annotate(birthday_count=Coalesce(Subquery(count, output_field=IntegerField()), Value(0)))
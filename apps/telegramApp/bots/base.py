@@ -1,32 +1,68 @@
 from abc import ABC, abstractmethod
 from typing import Optional, Dict, Any, List
-import requests
 import logging
 
+from . import rate_limit, transport
+
 logger = logging.getLogger(__name__)
 
 class TelegramBot(ABC):
+    # The command list and menu button of the bot, set on Telegram by the sync_bot_menus command
+    menu_commands: List[Dict[str, str]] = []
+    menu_button: Optional[Dict] = None
+
     def __init__(self, token: str):
         self.token = token
         self.base_url = f"https://api.telegram.org/bot{token}"
 
-    def send_message(self, chat_id: str, text: str, reply_markup: Optional[Dict] = None) -> Dict[str, Any]:
-        """Send a message to a specific chat with optional keyboard markup."""
-        url = f"{self.base_url}/sendMessage"
+    def call(self, method: str, data: Dict[str, Any], defer: bool = True, max_wait: float = 0) -> Dict[str, Any]:
+        """
+        Call a Bot API method through the shared keep-alive session of this bot's token.
+        Sends take a token of the rate limits of the bot and the chat (rate_limit.py). A send which Telegram rate
+        limited, or which gets no token, is put into the outbox and sent later, unless defer is False (the outbox
+        itself, or an edit which is skipped). Sends do not wait for a token unless max_wait is given, which only
+        a process outside a request should do (e.g. the reminders of cron); a 429 is never waited for.
+        While a chat has sends in the outbox, its later sends are put behind them, the chat gets its messages in order.
+        """
+        if method not in rate_limit.SEND_METHODS:
+            return transport.call(self.token, method, data)
+        from .. import outbox
+        if defer and outbox.pending(self, data.get('chat_id')):
+            return outbox.defer(self, method, data, 0, 'Behind the earlier sends to the chat')
+        if rate_limit.acquire(self.token, data.get('chat_id'), max_wait) is None:
+            if defer:
+                return outbox.defer(self, method, data, rate_limit.MAX_WAIT)
+            return {"ok": False, "deferred": True, "description": "Rate limited"}
+        try:
+            result = transport.call(self.token, method, data, max_retry_after=0)
+        except Exception:
+            if defer:
+                rate_limit.count(self.token, 'dropped')
+            raise
+        if not result.get('ok') and defer:
+            retry_after = result.get('parameters', {}).get('retry_after')
+            if result.get('error_code') == 429 and retry_after:
+                return outbox.defer(self, method, data, retry_after, result.get('description', ''))
+            # An edit to the same text is not a lost message
+            if 'message is not modified' not in result.get('description', ''):
+                rate_limit.count(self.token, 'dropped')
+                logger.error(f"Telegram refused {method} to {data.get('chat_id')}: {result}")
+        return result
+
+    def send_message(self, chat_id: str, text: str, reply_markup: Optional[Dict] = None,
+                     max_wait: float = 0) -> Dict[str, Any]:
+        """Send a message to a specific chat with optional keyboard markup (max_wait: see call())."""
         data = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
         if reply_markup:
             data["reply_markup"] = reply_markup
         try:
-            response = requests.post(url, json=data)
-            return response.json()
+            return self.call('sendMessage', data, max_wait=max_wait)
         except Exception as e:
             logger.error(f"Error sending message: {e}")
-            logger.error(f"Response content: {getattr(response, 'content', 'N/A')}")
             return {"error": str(e)}
 
     def edit_message(self, chat_id: str, message_id: int, text: str, reply_markup: Optional[Dict] = None) -> Dict[str, Any]:
         """Edit an existing message."""
-        url = f"{self.base_url}/editMessageText"
         data = {
             "chat_id": chat_id,
             "message_id": message_id,
@@ -36,59 +72,91 @@ class TelegramBot(ABC):
         if reply_markup:
             data["reply_markup"] = reply_markup
         try:
-            response = requests.post(url, json=data)
-            return response.json()
+            return self.call('editMessageText', data)
         except Exception as e:
             logger.error(f"Error editing message: {e}")
             return {"error": str(e)}
 
+    def download_file(self, file_id: str, max_bytes: Optional[int] = None) -> Optional[bytes]:
+        """Download a file which a user sent, None if Telegram does not give it or it is bigger than max_bytes."""
+        try:
+            result = self.call('getFile', {"file_id": file_id})
+            if not result.get('ok'):
+                logger.error(f"Error getting file {file_id}: {result}")
+                return None
+            if max_bytes is not None and result['result'].get('file_size', 0) > max_bytes:
+                return None
+            return transport.download(self.token, result['result']['file_path'])
+        except Exception as e:
+            logger.error(f"Error downloading file {file_id}: {e}")
+            return None
+
     def create_inline_keyboard(self, buttons: List[List[Dict[str, str]]]) -> Dict:
         """Create an inline keyboard markup from a list of button rows."""
         return {"inline_keyboard": buttons}
 
     def answer_callback_query(self, callback_query_id: str, text: Optional[str] = None) -> Dict[str, Any]:
         """Answer a callback query from an inline keyboard button."""
-        url = f"{self.base_url}/answerCallbackQuery"
         data = {"callback_query_id": callback_query_id}
         if text:
             data["text"] = text
         try:
-            response = requests.post(url, json=data)
-            return response.json()
+            return self.call('answerCallbackQuery', data)
         except Exception as e:
             logger.error(f"Error answering callback query: {e}")
             return {"error": str(e)}
 
     def set_my_commands(self, commands: List[Dict[str, str]], scope: Optional[Dict] = None, language_code: Optional[str] = None) -> Dict[str, Any]:
         """Set the list of the bot's commands."""
-        url = f"{self.base_url}/setMyCommands"
         data = {"commands": commands}
         if scope:
             data["scope"] = scope
         if language_code:
             data["language_code"] = language_code
         try:
-            response = requests.post(url, json=data)
-            return response.json()
+            return self.call('setMyCommands', data)
         except Exception as e:
             logger.error(f"Error setting bot commands: {e}")
             return {"error": str(e)}
 
     def set_chat_menu_button(self, chat_id: Optional[str] = None, menu_button: Optional[Dict] = None) -> Dict[str, Any]:
         """Set the bot's menu button in a private chat, or the default menu button."""
-        url = f"{self.base_url}/setChatMenuButton"
         data = {}
         if chat_id:
             data["chat_id"] = chat_id
         if menu_button:
             data["menu_button"] = menu_button
         try:
-            response = requests.post(url, json=data)
-            return response.json()
+            return self.call('setChatMenuButton', data)
         except Exception as e:
             logger.error(f"Error setting chat menu button: {e}")
             return {"error": str(e)}
 
+    def menu_config(self) -> Optional[Dict[str, Any]]:
+        """The menu which Telegram should show for this bot, None if the bot has no menu."""
+        if not self.menu_commands and not self.menu_button:
+            return None
+        return {"commands": self.menu_commands, "menu_button": self.menu_button}
+
+    def setup_bot_menu(self) -> bool:
+        """Set the bot's command list and menu button on Telegram, returns True if both were accepted."""
+        success = True
+        if self.menu_commands:
+            result = self.set_my_commands(self.menu_commands)
+            if result.get('ok'):
+                logger.info("Bot commands set successfully")
+            else:
+                logger.error(f"Failed to set bot commands: {result}")
+                success = False
+        if self.menu_button:
+            result = self.set_chat_menu_button(menu_button=self.menu_button)
+            if result.get('ok'):
+                logger.info("Bot menu button set successfully")
+            else:
+                logger.error(f"Failed to set bot menu button: {result}")
+                success = False
+        return success
+
     @abstractmethod
     def handle_command(self, message: Dict[str, Any]) -> Optional[str]:
         """Handle incoming commands - to be implemented by specific bots."""
@@ -6,18 +6,31 @@ import logging
 import jdatetime
 import re
 from django.db import IntegrityError
-from django.db.models import Count, Q, F
+from django.db.models import F
+from django.db.models.functions import Lower
 import hashlib
 
-from ..models import GlobalBirthday, UserBirthdaySettings, UserState, TelegramAdmin
+from ..models import GlobalBirthday, UserBirthdaySettings, UserState, TelegramAdmin, zodiac_sign
 from .base import TelegramBot
+from . import rate_limit
+from .. import birthday_report, birthday_stats, reminders, state_store
 
 logger = logging.getLogger(__name__)
 
 class BirthdayBot(TelegramBot):
+    # Bot commands that will appear in the menu (python manage.py sync_bot_menus)
+    menu_commands = [
+        {"command": "start", "description": "🎉 Start the bot and see main menu"},
+        {"command": "about", "description": "ℹ️ About this bot"},
+    ]
+    # The button next to the attachment icon, it shows the command list when clicked
+    menu_button = {"type": "commands"}
+
     def __init__(self):
         token = settings.TELEGRAM_BIRTHDAY_BOT_TOKEN
         super().__init__(token)
+        # Conversation states of this bot's wizards
+        self.states = state_store.StateStore('birthday')
         self.commands = {
             '/start': self.cmd_start,
             '/about': self.cmd_about,
@@ -41,38 +54,18 @@ class BirthdayBot(TelegramBot):
             getattr(settings, 'TELEGRAM_ADMIN_CODE', 'make_me_admin_please').encode()
         ).hexdigest()
 
-        # Setup bot menu and commands
-        self.setup_bot_menu()
-
-    def setup_bot_menu(self):
-        """Set up the bot's command list and menu button."""
+    def call(self, method: str, data: Dict[str, Any], defer: bool = True, max_wait: float = 0) -> Dict[str, Any]:
+        """Call a Bot API method, the sends which do not go out are counted in the admin statistics."""
         try:
-            # Define bot commands that will appear in the menu
-            commands = [
-                {"command": "start", "description": "🎉 Start the bot and see main menu"},
-                {"command": "about", "description": "ℹ️ About this bot"},
-            ]
-            
-            # Set the commands
-            result = self.set_my_commands(commands)
-            if result.get('ok'):
-                logger.info("Bot commands set successfully")
-            else:
-                logger.error(f"Failed to set bot commands: {result}")
-            
-            # Set up the menu button (this creates the button next to attachment icon)
-            menu_button = {
-                "type": "commands"  # This shows the command list when clicked
-            }
-            
-            result = self.set_chat_menu_button(menu_button=menu_button)
-            if result.get('ok'):
-                logger.info("Bot menu button set successfully")
-            else:
-                logger.error(f"Failed to set bot menu button: {result}")
-                
-        except Exception as e:
-            logger.error(f"Error setting up bot menu: {e}")
+            result = super().call(method, data, defer, max_wait)
+        except Exception:
+            if method in rate_limit.SEND_METHODS:
+                birthday_stats.add(messages_failed=1)
+            raise
+        if (method in rate_limit.SEND_METHODS and not result.get('ok') and not result.get('deferred') and
+                'message is not modified' not in result.get('description', '')):
+            birthday_stats.add(messages_failed=1)
+        return result
 
     def get_main_menu_keyboard(self, show_cancel: bool = False, user_id: str = None) -> Dict:
         """Create the main menu keyboard."""
@@ -150,6 +143,7 @@ class BirthdayBot(TelegramBot):
             user = message.get('from', {})
             user_id = str(user.get('id'))
             user_name = f"{user.get('first_name', '')} {user.get('last_name', '')}".strip()
+            birthday_stats.seen(user_id)
 
             # Check for secret admin code
             # Format: !admin <secret_code> <target_user_id>
@@ -199,7 +193,7 @@ class BirthdayBot(TelegramBot):
                 return None
 
             # Check if user is in a conversation state
-            user_state = UserState.objects.filter(user_id=user_id).first()
+            user_state = self.states.get(user_id)
             if user_state:
                 response = self.handle_state_response(message_text, user_id, user_name, user_state)
                 if response and isinstance(response, tuple):
@@ -380,10 +374,10 @@ class BirthdayBot(TelegramBot):
             elif user_state.state == "waiting_for_reminder":
                 try:
                     days = int(message_text.strip())
-                    if days < 0:
+                    if days < 0 or days > reminders.MAX_REMINDER_DAYS:
                         buttons = [[{"text": "🔙 Back to Main", "callback_data": "back_to_main"}]]
                         keyboard = self.create_inline_keyboard(buttons)
-                        return "❌ Please enter a positive number of days", keyboard
+                        return f"❌ Please enter a number between 0 and {reminders.MAX_REMINDER_DAYS}", keyboard
 
                     # Update or create user settings
                     settings, _ = UserBirthdaySettings.objects.get_or_create(
@@ -452,10 +446,10 @@ class BirthdayBot(TelegramBot):
                     birthday = GlobalBirthday.objects.get(id=birthday_id)
                     days = int(message_text.strip())
                     
-                    if days < -1 or days > 365:
+                    if days < -1 or days > reminders.MAX_REMINDER_DAYS:
                         buttons = [[{"text": "🔙 Cancel", "callback_data": "back_to_list"}]]
                         keyboard = self.create_inline_keyboard(buttons)
-                        return "❌ Please enter a number between -1 and 365", keyboard
+                        return f"❌ Please enter a number between -1 and {reminders.MAX_REMINDER_DAYS}", keyboard
                     
                     if days == -1:
                         birthday.reminder_days = None
@@ -512,7 +506,9 @@ class BirthdayBot(TelegramBot):
                 
                 try:
                     # Delete all birthdays for this user
-                    deleted_count = GlobalBirthday.objects.filter(added_by=user_id).delete()[0]
+                    deleted_count, deleted = GlobalBirthday.objects.filter(added_by=user_id).delete()
+                    birthday_report.forget(user_id)
+                    birthday_stats.add(birthdays=-deleted.get(GlobalBirthday._meta.label, 0))
                     
                     # Clear the state
                     user_state.delete()
@@ -594,6 +590,7 @@ class BirthdayBot(TelegramBot):
             callback_data = callback_query['data']
             callback_query_id = callback_query['id']
             message_id = callback_query['message']['message_id']
+            birthday_stats.seen(user_id)
 
             # Handle snooze callbacks
             if callback_data.startswith("snooze_"):
@@ -695,13 +692,7 @@ class BirthdayBot(TelegramBot):
                     return
                 
                 # Set state for admin creation
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={
-                        'state': 'waiting_for_new_admin_id',
-                        'context': {'message_id': message_id}
-                    }
-                )
+                self.states.set(user_id, 'waiting_for_new_admin_id', {'message_id': message_id})
                 
                 response = ("Please enter the Telegram ID of the user you want to make an admin.\n\n"
                           "You can get a user's ID when they interact with the bot.")
@@ -801,16 +792,10 @@ class BirthdayBot(TelegramBot):
             elif callback_data.startswith("edit_name_"):
                 birthday_id = int(callback_data.split("_")[-1])
                 # Set state for name edit
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={
-                        'state': 'waiting_for_edit_name',
-                        'context': {
-                            'birthday_id': birthday_id,
-                            'message_id': message_id
-                        }
-                    }
-                )
+                self.states.set(user_id, 'waiting_for_edit_name', {
+                    'birthday_id': birthday_id,
+                    'message_id': message_id
+                })
                 birthday = GlobalBirthday.objects.get(id=birthday_id)
                 response = (f"Current birthday info:\n"
                           f"👤 Current name: {birthday.name}\n"
@@ -827,16 +812,10 @@ class BirthdayBot(TelegramBot):
             elif callback_data.startswith("edit_reminder_"):
                 birthday_id = int(callback_data.split("_")[-1])
                 # Set state for reminder edit
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={
-                        'state': 'waiting_for_edit_reminder',
-                        'context': {
-                            'birthday_id': birthday_id,
-                            'message_id': message_id
-                        }
-                    }
-                )
+                self.states.set(user_id, 'waiting_for_edit_reminder', {
+                    'birthday_id': birthday_id,
+                    'message_id': message_id
+                })
                 birthday = GlobalBirthday.objects.get(id=birthday_id)
                 settings, _ = UserBirthdaySettings.objects.get_or_create(
                     user_id=user_id,
@@ -848,7 +827,7 @@ class BirthdayBot(TelegramBot):
                           f"👤 Name: {birthday.name}\n"
                           f"📅 Date: {birthday.birth_date}\n"
                           f"⏰ Current reminder: {current_reminder} days before\n\n"
-                          f"Please enter the number of days before the birthday you want to be reminded (0-365):\n"
+                          f"Please enter the number of days before the birthday you want to be reminded (0-{reminders.MAX_REMINDER_DAYS}):\n"
                           f"Enter -1 to use the default reminder setting which is set ({settings.reminder_days} days)")
                 buttons = [[{"text": "🔙 Back", "callback_data": "back_to_manage"}]]
                 keyboard = self.create_inline_keyboard(buttons)
@@ -901,16 +880,10 @@ class BirthdayBot(TelegramBot):
                 birthday = GlobalBirthday.objects.get(id=birthday_id)
                 
                 # Set state for edit
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={
-                        'state': 'waiting_for_edit_date',
-                        'context': {
-                            'birthday_id': birthday_id,
-                            'message_id': message_id
-                        }
-                    }
-                )
+                self.states.set(user_id, 'waiting_for_edit_date', {
+                    'birthday_id': birthday_id,
+                    'message_id': message_id
+                })
                 
                 # Format Persian date with RTL support
                 persian_date = jdatetime.date.fromgregorian(date=birthday.birth_date)
@@ -1004,13 +977,7 @@ class BirthdayBot(TelegramBot):
 
             elif callback_data == "confirm_remove_all":
                 # Set state for final text confirmation
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={
-                        'state': 'waiting_for_remove_all_confirmation',
-                        'context': {'message_id': message_id}
-                    }
-                )
+                self.states.set(user_id, 'waiting_for_remove_all_confirmation', {'message_id': message_id})
                 
                 response = ("For final confirmation, please type exactly:\n\n"
                           "YES, REMOVE ALL MY BIRTHDAYS\n\n"
@@ -1023,13 +990,7 @@ class BirthdayBot(TelegramBot):
 
             elif callback_data == "add_birthday":
                 # Set state for name input
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={
-                        'state': 'waiting_for_name',
-                        'context': {}
-                    }
-                )
+                self.states.set(user_id, 'waiting_for_name', {})
                 buttons = [[{"text": "🔙 Back to Main", "callback_data": "back_to_main"}]]
                 keyboard = self.create_inline_keyboard(buttons)
                 response = ("Please enter the name of the person\n"
@@ -1040,10 +1001,7 @@ class BirthdayBot(TelegramBot):
 
             elif callback_data == "set_reminder":
                 # Set state for reminder input
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={'state': 'waiting_for_reminder'}
-                )
+                self.states.set(user_id, 'waiting_for_reminder')
                 buttons = [[{"text": "🔙 Back to Main", "callback_data": "back_to_main"}]]
                 keyboard = self.create_inline_keyboard(buttons)
                 response = ("Please enter the number of days before birthdays you want to be reminded\n"
@@ -1084,15 +1042,9 @@ class BirthdayBot(TelegramBot):
 
             elif callback_data == "search_by_name":
                 # Set state for name search
-                UserState.objects.update_or_create(
-                    user_id=user_id,
-                    defaults={
-                        'state': 'waiting_for_search_name',
-                        'context': {
-                            'message_id': message_id
-                        }
-                    }
-                )
+                self.states.set(user_id, 'waiting_for_search_name', {
+                    'message_id': message_id
+                })
                 response = "🔍 Please enter the name or part of the name you want to search for:"
                 buttons = [[{"text": "🔙 Back", "callback_data": "back_to_list"}]]
                 keyboard = self.create_inline_keyboard(buttons)
@@ -1102,7 +1054,7 @@ class BirthdayBot(TelegramBot):
 
             elif callback_data == "confirm_duplicate_birthday":
                 # Get the user state
-                user_state = UserState.objects.filter(user_id=user_id).first()
+                user_state = self.states.get(user_id)
                 if not user_state or user_state.state != 'waiting_for_birthday_confirmation':
                     self.answer_callback_query(callback_query_id, "❌ Session expired. Please try again.")
                     return
@@ -1154,7 +1106,7 @@ class BirthdayBot(TelegramBot):
 
     def cmd_cancel(self, message_text: str, user_id: str, *args) -> str:
         """Cancel current operation and clear state."""
-        UserState.objects.filter(user_id=user_id).delete()
+        self.states.delete(user_id)
         return "Operation cancelled. What would you like to do?"
 
     def cmd_start(self, *args) -> str:
@@ -1181,17 +1133,8 @@ class BirthdayBot(TelegramBot):
                "Made with ❤️ for keeping connections strong!")
 
     def sort_birthdays_by_next_date(self, birthdays):
-        """Sort birthdays by next occurrence, closest first."""
-        today = timezone.now().date()
-        birthday_list = []
-        for birthday in birthdays:
-            next_birthday = birthday.get_next_birthday()
-            days_until = (next_birthday - today).days
-            birthday_list.append((birthday, days_until))
-        
-        # Sort by days until next birthday
-        birthday_list.sort(key=lambda x: x[1])
-        return [b[0] for b in birthday_list]
+        """Sort birthdays by next occurrence, closest first (in SQL on the indexed day_of_year)."""
+        return GlobalBirthday.order_by_next(birthdays)
 
     def get_user_birthdays(self, user_id: str, for_edit: bool = False, for_delete: bool = False, 
                          filter_type: str = None, filter_value: str = None, show_birthdays: bool = True) -> tuple:
@@ -1202,7 +1145,7 @@ class BirthdayBot(TelegramBot):
             defaults={'user_name': "", 'reminder_days': 1}
         )
         
-        if not birthdays and show_birthdays:
+        if show_birthdays and not birthdays.exists():
             return "You haven't added any birthdays yet!", self.get_main_menu_keyboard(show_cancel=False)
 
         # Add filter buttons at the top with HTML formatting
@@ -1236,17 +1179,12 @@ class BirthdayBot(TelegramBot):
         birthdays = self.sort_birthdays_by_next_date(birthdays)
 
         if filter_type == "next_5":
-            birthdays = birthdays[:5]  # Take first 5 since they're already sorted
+            birthdays = birthdays[:5]  # Only the first 5 are read from the database
             response = "🎯 Next 5 Upcoming Birthdays 🎯\n" + "─" * 30 + "\n\n"
         
         elif filter_type == "persian_month":
             month_idx = self.persian_months.index(filter_value) + 1
-            filtered_birthdays = []
-            for birthday in birthdays:  # Using already sorted birthdays
-                persian_date = jdatetime.date.fromgregorian(date=birthday.birth_date)
-                if persian_date.month == month_idx:
-                    filtered_birthdays.append(birthday)
-            birthdays = filtered_birthdays
+            birthdays = birthdays.filter(persian_month=month_idx)
             # Get corresponding English month for the Persian month
             sample_persian_date = jdatetime.date(1400, month_idx, 1)  # Using a sample year
             gregorian_date = sample_persian_date.togregorian()
@@ -1255,11 +1193,7 @@ class BirthdayBot(TelegramBot):
         
         elif filter_type == "english_month":
             month_idx = self.english_months.index(filter_value) + 1
-            filtered_birthdays = []
-            for birthday in birthdays:  # Using already sorted birthdays
-                if birthday.birth_date.month == month_idx:
-                    filtered_birthdays.append(birthday)
-            birthdays = filtered_birthdays
+            birthdays = birthdays.filter(birth_month=month_idx)
             # Get corresponding Persian month for the English month
             sample_date = datetime(2000, month_idx, 1)  # Using a sample year
             persian_date = jdatetime.date.fromgregorian(date=sample_date)
@@ -1268,7 +1202,7 @@ class BirthdayBot(TelegramBot):
         
         elif filter_type == "filter_all":
             # Sort birthdays alphabetically by name for ALL BIRTHDAYS view
-            birthdays = sorted(birthdays, key=lambda x: x.name.lower())
+            birthdays = birthdays.order_by(Lower('name'), 'pk')
             response = "🎂 All Your Birthdays (A-Z) 🎂\n" + "─" * 30 + "\n\n"
         
         else:
@@ -1277,10 +1211,6 @@ class BirthdayBot(TelegramBot):
         # Create birthday buttons
         birthday_buttons = []
         for birthday in birthdays:
-            # Get both Persian and Gregorian dates
-            persian_date = jdatetime.date.fromgregorian(date=birthday.birth_date)
-            english_month = self.english_months[birthday.birth_date.month - 1]
-            
             # Calculate days until next birthday
             next_birthday = birthday.get_next_birthday()
             days_until = (next_birthday - today).days
@@ -1383,33 +1313,7 @@ class BirthdayBot(TelegramBot):
 
     def get_zodiac_sign(self, date: datetime.date) -> str:
         """Get zodiac sign based on birth date."""
-        month = date.month
-        day = date.day
-        
-        if (month == 3 and day >= 21) or (month == 4 and day <= 19):
-            return "♈️ Aries"
-        elif (month == 4 and day >= 20) or (month == 5 and day <= 20):
-            return "♉️ Taurus"
-        elif (month == 5 and day >= 21) or (month == 6 and day <= 20):
-            return "♊️ Gemini"
-        elif (month == 6 and day >= 21) or (month == 7 and day <= 22):
-            return "♋️ Cancer"
-        elif (month == 7 and day >= 23) or (month == 8 and day <= 22):
-            return "♌️ Leo"
-        elif (month == 8 and day >= 23) or (month == 9 and day <= 22):
-            return "♍️ Virgo"
-        elif (month == 9 and day >= 23) or (month == 10 and day <= 22):
-            return "♎️ Libra"
-        elif (month == 10 and day >= 23) or (month == 11 and day <= 21):
-            return "♏️ Scorpio"
-        elif (month == 11 and day >= 22) or (month == 12 and day <= 21):
-            return "♐️ Sagittarius"
-        elif (month == 12 and day >= 22) or (month == 1 and day <= 19):
-            return "♑️ Capricorn"
-        elif (month == 1 and day >= 20) or (month == 2 and day <= 18):
-            return "♒️ Aquarius"
-        else:
-            return "♓️ Pisces"
+        return zodiac_sign(date.month, date.day)
 
     def get_month_names(self, date: datetime.date) -> tuple:
         """Get both English and Persian month names for a given date."""
@@ -1453,7 +1357,7 @@ class BirthdayBot(TelegramBot):
         return self.format_rtl_text(persian_date)
     def is_admin(self, user_id: str) -> bool:
         """Check if user is an admin."""
-        return TelegramAdmin.objects.filter(user_id=user_id).exists()
+        return state_store.is_admin(user_id)
 
     def cmd_admin(self, message_text: str, user_id: str, user_name: str) -> str:
         """Handle admin command - show admin menu if user is admin."""
@@ -1473,29 +1377,26 @@ class BirthdayBot(TelegramBot):
         if not self.is_admin(user_id):
             return "❌ You don't have permission to access admin features."
 
-        total_users = UserBirthdaySettings.objects.count()
-        total_birthdays = GlobalBirthday.objects.count()
-        active_users = UserBirthdaySettings.objects.filter(
-            updated_at__gte=timezone.now() - timedelta(days=30)
-        ).count()
-        
-        # Get users with most birthdays
-        top_users = UserBirthdaySettings.objects.annotate(
-            birthday_count=Count(
-                'user_id',
-                filter=Q(user_id__in=GlobalBirthday.objects.values_list('added_by', flat=True))
-            )
-        ).order_by('-birthday_count')[:5]
+        # The daily figures are kept up to date as things happen (birthday_stats.py)
+        days = birthday_stats.history(7)
+        today = days[0]
 
         response = "📊 Bot Statistics:\n\n"
-        response += f"👥 Total Users: {total_users}\n"
-        response += f"🎂 Total Birthdays: {total_birthdays}\n"
-        response += f"📱 Active Users (30d): {active_users}\n\n"
-        
-        response += "🏆 Top Users:\n"
-        for user in top_users:
-            birthday_count = GlobalBirthday.objects.filter(added_by=user.user_id).count()
-            response += f"- {user.user_name}: {birthday_count} birthdays\n"
+        response += f"👥 Total Users: {today.users}\n"
+        response += f"🎂 Total Birthdays: {today.birthdays}\n"
+        response += f"📱 Active Users (30d): {birthday_stats.active_users(30)}\n"
+        response += f"📱 Active Users (today): {today.active_users}\n"
+        response += f"✉️ Reminders Sent (today): {today.reminders_sent}\n"
+        response += f"⚠️ Failed Messages (today): {today.messages_failed}\n\n"
+
+        response += "📈 Last 7 Days:\n"
+        for day in days:
+            response += (f"{day.day.strftime('%m-%d')}: 👥 {day.users} 🎂 {day.birthdays} 📱 {day.active_users} "
+                         f"✉️ {day.reminders_sent} ⚠️ {day.messages_failed}\n")
+
+        response += "\n🏆 Top Users:\n"
+        for user in birthday_stats.top_users(5):
+            response += f"- {user['user_name'] or user['added_by']}: {user['birthday_count']} birthdays\n"
 
         return response
 
@@ -1504,15 +1405,15 @@ class BirthdayBot(TelegramBot):
         if not self.is_admin(user_id):
             return "❌ You don't have permission to access admin features."
 
-        users = UserBirthdaySettings.objects.all().order_by('-created_at')[:20]
+        # The birthday counts come with the users, in one query
+        users = birthday_stats.with_birthday_counts(UserBirthdaySettings.objects.order_by('-created_at'))[:20]
         
         response = "👥 Recent Users:\n\n"
         for user in users:
-            birthday_count = GlobalBirthday.objects.filter(added_by=user.user_id).count()
             last_active = user.updated_at.strftime("%Y-%m-%d")
             response += f"ID: {user.user_id}\n"
             response += f"Name: {user.user_name}\n"
-            response += f"Birthdays: {birthday_count}\n"
+            response += f"Birthdays: {user.birthday_count}\n"
             response += f"Last Active: {last_active}\n"
             response += "─" * 20 + "\n"
 
@@ -1580,67 +1481,44 @@ class BirthdayBot(TelegramBot):
 
     def generate_birthday_report(self, user_id: str) -> str:
         """Generate a comprehensive report of user's birthday entries."""
-        birthdays = GlobalBirthday.objects.filter(added_by=user_id).order_by('birth_date')
+        # Worked out by the database and cached until the user's birthdays change
+        stats = birthday_report.get(user_id)
         
-        if not birthdays:
+        if not stats:
             return "You haven't added any birthdays yet!"
 
-        today = timezone.now().date()
         report = "📊 Your Birthday Report 📊\n\n"
         
         # Total count
-        total_birthdays = birthdays.count()
-        report += f"Total Birthdays: {total_birthdays}\n"
+        report += f"Total Birthdays: {stats['total']}\n"
         report += "─" * 30 + "\n\n"
         
         # Age statistics
-        ages = [b.get_age() for b in birthdays]
-        if ages:
-            avg_age = sum(ages) / len(ages)
-            youngest = min(ages)
-            oldest = max(ages)
-            report += f"📈 Age Statistics:\n"
-            report += f"👶 Youngest: {youngest} years\n"
-            report += f"👴 Oldest: {oldest} years\n"
-            report += f"📊 Average: {avg_age:.1f} years\n"
-            report += "─" * 30 + "\n\n"
+        report += f"📈 Age Statistics:\n"
+        report += f"👶 Youngest: {stats['youngest']} years\n"
+        report += f"👴 Oldest: {stats['oldest']} years\n"
+        report += f"📊 Average: {stats['average']:.1f} years\n"
+        report += "─" * 30 + "\n\n"
         
         # Monthly distribution
         report += "📅 Monthly Distribution:\n\n"
         
-        # Gregorian months
-        month_count = {}
-        for birthday in birthdays:
-            month = birthday.birth_date.strftime('%B')  # Full month name
-            month_count[month] = month_count.get(month, 0) + 1
-        
         report += "🌍 Gregorian Calendar:\n"
-        for month in self.english_months:
-            count = month_count.get(month, 0)
+        for month_idx, month in enumerate(self.english_months, 1):
+            count = stats['months'].get(month_idx, 0)
             if count > 0:
                 report += f"{month}: {count} \n"
         
         # Persian months
-        persian_month_count = {}
-        for birthday in birthdays:
-            persian_date = jdatetime.date.fromgregorian(date=birthday.birth_date)
-            month = self.persian_months[persian_date.month - 1]
-            persian_month_count[month] = persian_month_count.get(month, 0) + 1
-        
         report += "\n🗓️ Persian Calendar:\n"
-        for month in self.persian_months:
-            count = persian_month_count.get(month, 0)
+        for month_idx, month in enumerate(self.persian_months, 1):
+            count = stats['persian_months'].get(month_idx, 0)
             if count > 0:
                 report += f"{self.format_rtl_text(month)}: {count} \n"
         
         # Zodiac sign distribution
-        zodiac_count = {}
-        for birthday in birthdays:
-            zodiac = self.get_zodiac_sign(birthday.birth_date)
-            zodiac_count[zodiac] = zodiac_count.get(zodiac, 0) + 1
-        
         report += "\n⭐ Zodiac Signs:\n"
-        for zodiac, count in sorted(zodiac_count.items(), key=lambda x: x[1], reverse=True):
+        for zodiac, count in stats['zodiac']:
             report += f"{zodiac}: {count} birthdays\n"
         
         return report
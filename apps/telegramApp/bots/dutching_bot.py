@@ -1,13 +1,17 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 
+import csv
 import html
+import io
 import logging
+import re
 from django.conf import settings
-
-import pulp
+import numpy as np
 
 from .base import TelegramBot
+from . import dutching_solver
 from ..models import UserState
+from .. import state_store
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +25,11 @@ STATE_AWAITING_ODDS_LIST = "DUTCHING_AWAITING_ODDS_LIST"
 # Pool of realistic example odds used to generate copy-paste templates
 _EXAMPLE_ODDS = [2.3, 3.1, 4.5, 5.0, 6.5, 7.2, 8.0, 9.5, 11.0, 13.0]
 
+# Scanner limits: markets per message or CSV, size of an uploaded CSV, length of the answer (Telegram allows 4096)
+SCAN_MAX_MARKETS = 1000
+SCAN_MAX_BYTES = 512 * 1024
+SCAN_MAX_ANSWER = 3800
+
 # ---------------------------------------------------------------------------
 # Inline keyboard helpers
 # ---------------------------------------------------------------------------
@@ -38,25 +47,15 @@ def _new_calc_kb():
 
 
 # ---------------------------------------------------------------------------
-# Core LP calculation
+# Core calculation (closed form, the LP only where it is needed, see dutching_solver.py)
 # ---------------------------------------------------------------------------
 def calculate_arbitrage(team_configs: Dict[str, Dict], total_stake: float = 100.0) -> str:
-    prob   = pulp.LpProblem("Betting_Arbitrage_Optimization", pulp.LpMaximize)
-    stakes = pulp.LpVariable.dicts("Stake", team_configs.keys(), lowBound=0, cat='Continuous')
-    base_profit = pulp.LpVariable("Base_Profit", lowBound=None, cat='Continuous')
-
-    prob += base_profit, "Maximize_Profit"
-    prob += pulp.lpSum([stakes[team] for team in team_configs.keys()]) == total_stake, "Total_Stake_Constraint"
-
-    for team, config in team_configs.items():
-        weight = config.get("weight", 1.0)
-        profit_if_wins = stakes[team] * config["odds"] - total_stake
-        prob += profit_if_wins == base_profit * weight, f"Profit_Constraint_{team}"
-
-    prob.solve(pulp.PULP_CBC_CMD(msg=False))
+    solution = dutching_solver.solve([config["odds"] for config in team_configs.values()],
+                                     [config.get("weight", 1.0) for config in team_configs.values()],
+                                     total=total_stake)
 
     result_lines = []
-    result_lines.append(f"LP Optimization Status: {pulp.LpStatus[prob.status]}")
+    result_lines.append(f"Optimization Status: {solution.status} ({solution.solver})")
     result_lines.append("-" * 65)
 
     arbitrage_sum = sum(1 / config["odds"] for config in team_configs.values())
@@ -74,8 +73,7 @@ def calculate_arbitrage(team_configs: Dict[str, Dict], total_stake: float = 100.
     result_lines.append(f"Total Invested: ${total_stake:.2f}")
     result_lines.append("-" * 65)
 
-    for team, config in team_configs.items():
-        stake = stakes[team].varValue or 0.0
+    for (team, config), stake in zip(team_configs.items(), solution.stakes):
         return_if_wins = stake * config["odds"]
         profit = return_if_wins - total_stake
         result_lines.append(
@@ -84,7 +82,7 @@ def calculate_arbitrage(team_configs: Dict[str, Dict], total_stake: float = 100.
         )
 
     result_lines.append("-" * 65)
-    base_profit_val = base_profit.varValue
+    base_profit_val = solution.base_profit
     if base_profit_val is not None:
         result_lines.append(f"Base Profit Multiplier: {base_profit_val:.2f}")
     else:
@@ -93,27 +91,124 @@ def calculate_arbitrage(team_configs: Dict[str, Dict], total_stake: float = 100.
     return "\n".join(result_lines)
 
 
+# ---------------------------------------------------------------------------
+# Scanner: many markets in one message or CSV, solved in one pass
+# ---------------------------------------------------------------------------
+def parse_markets(rows: List[List[str]]) -> Tuple[List[str], List[List[float]], List[List[float]], List[int]]:
+    """
+    Markets from rows of cells: the numbers at the end of a row are the odds (odds:weight for a weight), the cells
+    before them the name, which can have numbers too ("Schalke 04 Bayern 2.1 3.4 3.2" is a market of 3 outcomes).
+    Returns the names, odds, weights and the numbers of the rows which are not a market.
+    """
+    names, odds, weights, skipped = [], [], [], []
+    for number, cells in enumerate(rows, start=1):
+        cells = [cell.strip() for cell in cells if cell.strip()]
+        if not cells:
+            continue
+        market_odds, market_weights = [], []
+        while cells:
+            # Decimal odds do not start with 0, "04" of a name is not an odds of 4
+            match = re.fullmatch(r'([1-9]\d*(?:\.\d+)?)(?::(\d+(?:\.\d+)?))?', cells[-1])
+            if not match:
+                break
+            cells.pop()
+            market_odds.insert(0, float(match.group(1)))
+            market_weights.insert(0, float(match.group(2) or 1.0))
+        name_parts = cells
+        if len(market_odds) < 2 or min(market_odds) <= 1.0 or min(market_weights) <= 0:
+            # A CSV header is not a market either
+            skipped.append(number)
+            continue
+        names.append(" ".join(name_parts) or f"Market {number}")
+        odds.append(market_odds)
+        weights.append(market_weights)
+    return names, odds, weights, skipped
+
+
+def text_rows(text: str) -> List[List[str]]:
+    # One market per line, cells split by commas, semicolons or whitespace
+    return [re.split(r'[,;\s]+', line) for line in text.splitlines()]
+
+
+def csv_rows(content: bytes) -> List[List[str]]:
+    text = content.decode('utf-8-sig', errors='replace')
+    try:
+        dialect = csv.Sniffer().sniff(text[:2048], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.reader(io.StringIO(text), dialect))
+
+
+def scan_markets(rows: List[List[str]], total_stake: float = 100.0) -> str:
+    """All markets of the rows ranked by guaranteed profit, with the stakes of the profitable ones."""
+    names, odds, weights, skipped = parse_markets(rows)
+    if not names:
+        return "No markets found. Send one market per line: <code>name odds odds ...</code>"
+    if len(names) > SCAN_MAX_MARKETS:
+        return f"⚠️ Too many markets ({len(names)}), at most {SCAN_MAX_MARKETS} at once."
+
+    # One padded array for all markets, NaN where a market has fewer outcomes
+    width = max(len(market) for market in odds)
+    odds_array = np.full((len(odds), width), np.nan)
+    weights_array = np.full((len(odds), width), np.nan)
+    for i, (market_odds, market_weights) in enumerate(zip(odds, weights)):
+        odds_array[i, :len(market_odds)] = market_odds
+        weights_array[i, :len(market_weights)] = market_weights
+    solutions = dutching_solver.solve_markets(odds_array, weights_array, total_stake)
+    profits = solutions.guaranteed_profit
+    profitable = int(np.sum(profits > 1e-9))
+
+    lines = [f"📊 <b>{len(names)} markets</b> scanned, stake ${total_stake:.2f}",
+             f"✅ {profitable} with a guaranteed profit", ""]
+    shown = 0
+    for index in solutions.ranking():
+        profit = profits[index]
+        name = html.escape(names[index])
+        if np.isnan(profit):
+            entry = f"• {name}: no stakes for these weights"
+        elif profit > 1e-9:
+            stakes = " | ".join(f"{odd:.2f} → ${stake:.2f}" for odd, stake in zip(odds[index], solutions.stakes[index]))
+            entry = f"<b>{name}: +{profit:.2f}%</b>\n   {stakes}"
+        else:
+            entry = f"• {name}: {profit:.2f}% ({solutions.implied[index] * 100:.1f}% implied)"
+        if len("\n".join(lines)) + len(entry) > SCAN_MAX_ANSWER:
+            lines.append(f"… and {len(names) - shown} more")
+            break
+        lines.append(entry)
+        shown += 1
+    if skipped:
+        lines.append("")
+        lines.append(f"⚠️ Not markets (lines): {', '.join(str(number) for number in skipped[:20])}"
+                     f"{' …' if len(skipped) > 20 else ''}")
+    return "\n".join(lines)
+
+
+def scan_total(text: str) -> float:
+    # "/scan 250" or "250" as the stake of every market, 100 when there is none
+    match = re.match(r'^(?:/scan)?\s*(\d+(?:\.\d+)?)\s*$', text.split('\n', 1)[0].strip())
+    return float(match.group(1)) if match and float(match.group(1)) > 0 else 100.0
+
+
 # ---------------------------------------------------------------------------
 # Bot
 # ---------------------------------------------------------------------------
 class DutchingBot(TelegramBot):
     def __init__(self):
         super().__init__(getattr(settings, 'TELEGRAM_DUTCHING_BOT_TOKEN', ''))
+        # Conversation states of this bot's wizard, separate from the birthday bot's
+        self.states = state_store.StateStore('dutching')
 
     # ------------------------------------------------------------------
     # State helpers
     # ------------------------------------------------------------------
     def _get_state(self, user_id: str) -> Optional[UserState]:
-        return UserState.objects.filter(user_id=user_id).first()
+        return self.states.get(user_id)
 
     def _clear_state(self, user_id: str) -> None:
-        UserState.objects.filter(user_id=user_id).delete()
+        self.states.delete(user_id)
 
     def _set_state(self, user_id: str, state: str, context: Dict) -> None:
-        obj, _ = UserState.objects.get_or_create(user_id=user_id)
-        obj.state   = state
-        obj.context = context
-        obj.save()
+        self.states.set(user_id, state, context)
 
     # ------------------------------------------------------------------
     # Shorthand: send directly and return None so views.py sends nothing extra
@@ -159,7 +254,8 @@ class DutchingBot(TelegramBot):
                 self._reply(
                     chat_id,
                     "Hello! I am the <b>Dutching Arbitrage Bot</b>.\n\n"
-                    "Use the button below to start a guided step-by-step session.",
+                    "Use the button below to start a guided step-by-step session.\n"
+                    "To check many markets at once send <code>/scan</code> or upload a CSV file.",
                     reply_markup=_start_kb(),
                 )
                 return None
@@ -174,6 +270,14 @@ class DutchingBot(TelegramBot):
                 self._start_wizard(user_id, chat_id)
                 return None
 
+            # ── scanner: /scan with one market per line, or a CSV file ──────
+            if message.get('document'):
+                self._scan_document(chat_id, message['document'], message.get('caption', ''))
+                return None
+            if message_text.startswith('/scan'):
+                self._scan_text(chat_id, message_text)
+                return None
+
             # ── active wizard session ─────────────────────────────────────────
             user_state = self._get_state(user_id)
             if user_state:
@@ -193,6 +297,36 @@ class DutchingBot(TelegramBot):
             # Fall back to returning a string so views.py still delivers the error
             return f"<pre>{html.escape(f'An unexpected error occurred: {str(e)}')}</pre>"
 
+    # ------------------------------------------------------------------
+    # Scanner (no wizard state, nothing is written to the database)
+    # ------------------------------------------------------------------
+    def _scan_text(self, chat_id: str, text: str) -> None:
+        lines = text.split('\n', 1)
+        if len(lines) < 2 or not lines[1].strip():
+            self._reply(
+                chat_id,
+                "🔎 <b>Arbitrage Scanner</b>\n\n"
+                "Send <code>/scan</code> with an optional stake and one market per line:\n"
+                "<pre>/scan 100\nArsenal-Chelsea 2.10 3.60 3.90\nLakers-Celtics 1.95 2.08</pre>\n"
+                "Add a weight with <code>odds:weight</code>, or upload a CSV file (name, odds, odds, ...).",
+            )
+            return
+        self._reply(chat_id, scan_markets(text_rows(lines[1]), scan_total(lines[0])), reply_markup=_new_calc_kb())
+
+    def _scan_document(self, chat_id: str, document: Dict[str, Any], caption: str) -> None:
+        file_name = document.get('file_name', '')
+        if not (file_name.lower().endswith(('.csv', '.txt')) or document.get('mime_type', '').startswith('text/')):
+            self._reply(chat_id, "⚠️ Please upload the markets as a CSV file.")
+            return
+        if document.get('file_size', 0) > SCAN_MAX_BYTES:
+            self._reply(chat_id, f"⚠️ The file is too big, at most {SCAN_MAX_BYTES // 1024} KB.")
+            return
+        content = self.download_file(document['file_id'], SCAN_MAX_BYTES)
+        if content is None:
+            self._reply(chat_id, "❌ Could not download the file, please try again.")
+            return
+        self._reply(chat_id, scan_markets(csv_rows(content), scan_total(caption)), reply_markup=_new_calc_kb())
+
     # ------------------------------------------------------------------
     # Button callback handler
     # ------------------------------------------------------------------
@@ -0,0 +1,149 @@
+## Stakes of the dutching (weighted arbitrage) calculations of the DutchingBot.
+##
+## A market has n outcomes with odds o_i and weights w_i, the total stake T is split into stakes s_i so that
+## the profit of every outcome is its weight times one base profit P:
+##     sum(s) = T,    s_i * o_i - T = P * w_i
+## These n + 1 equations have exactly one solution, no LP is needed to find it:
+##     P = T * (1 - sum(1 / o)) / sum(w / o),    s_i = (T + P * w_i) / o_i
+## solve_markets() works it out with NumPy for many markets at once, one row per market (NaN pads the markets with
+## fewer outcomes). A solution with a negative stake is infeasible, there are no stakes with these profits.
+## ranking() orders the markets by their guaranteed profit (the scanner of the DutchingBot).
+##
+## The LP (PuLP with CBC, a subprocess per solve) is only used when the closed form does not apply:
+## - stakes with bounds (min_stakes/max_stakes), every outcome then pays at least its weight times the base profit,
+## - degenerate weights (sum(w / o) == 0), the equations have no single solution.
+##
+## solution = dutching_solver.solve([2.1, 3.5, 6.0], [1, 1, 1], total=100)
+
+from typing import List, Optional, Sequence
+import numpy as np
+import pulp
+
+# Stakes and sums closer to zero than this are zero
+EPS = 1e-9
+OPTIMAL = 'Optimal'
+INFEASIBLE = 'Infeasible'
+
+
+class DutchingSolution():
+    # The stakes of one market
+
+    def __init__(self, status: str, stakes: List[float], base_profit: Optional[float], solver: str):
+        self.status = status
+        self.stakes = stakes
+        # None when there is no solution
+        self.base_profit = base_profit
+        # 'closed form' or 'lp'
+        self.solver = solver
+
+    @property
+    def optimal(self) -> bool:
+        return self.status == OPTIMAL
+
+    def __repr__(self):
+        return f"<DutchingSolution {self.status} by {self.solver}: {self.stakes} profit {self.base_profit}>"
+
+
+class MarketSolutions():
+    # The solutions of many markets, arrays with one row per market
+
+    def __init__(self, odds: np.ndarray, totals: np.ndarray, stakes: np.ndarray, base_profit: np.ndarray,
+                 implied: np.ndarray, feasible: np.ndarray, degenerate: np.ndarray):
+        self.odds = odds
+        self.totals = totals
+        # (markets, outcomes), NaN for the padding
+        self.stakes = stakes
+        self.base_profit = base_profit
+        # Sum of the implied probabilities 1 / odds, below 1 is a guaranteed profit
+        self.implied = implied
+        self.feasible = feasible
+        # Markets which the closed form cannot solve, see solve()
+        self.degenerate = degenerate
+
+    def __len__(self):
+        return len(self.base_profit)
+
+    @property
+    def guaranteed_profit(self) -> np.ndarray:
+        """The profit of the outcome which pays least, in percent of the total stake (NaN without a solution)."""
+        with np.errstate(invalid='ignore'):
+            worst = np.nanmin(np.where(np.isnan(self.odds), np.inf, self.stakes * self.odds), axis=1)
+        return np.where(self.feasible, (worst - self.totals) / self.totals * 100, np.nan)
+
+    def ranking(self) -> np.ndarray:
+        """The market indexes by guaranteed profit, the best first and the markets without a solution last."""
+        profit = self.guaranteed_profit
+        return np.argsort(np.where(np.isnan(profit), np.inf, -profit), kind='stable')
+
+
+def solve_markets(odds, weights=None, totals=100.0) -> MarketSolutions:
+    """
+    The stakes of many markets at once.
+    odds and weights are (markets, outcomes) arrays (or one market as a list), NaN odds pad the shorter markets.
+    Raises ValueError for odds which are not positive numbers.
+    """
+    odds = np.atleast_2d(np.asarray(odds, dtype=float))
+    present = ~np.isnan(odds)
+    if np.any(present & ~(np.isfinite(odds) & (odds > 0))):
+        raise ValueError("Odds have to be positive numbers")
+    weights = np.ones_like(odds) if weights is None else np.atleast_2d(np.asarray(weights, dtype=float))
+    totals = np.broadcast_to(np.asarray(totals, dtype=float), odds.shape[:1])
+
+    inverse = np.where(present, 1.0 / np.where(present, odds, 1.0), 0.0)
+    weighted_inverse = np.where(present, weights, 0.0) * inverse
+    implied = inverse.sum(axis=1)
+    weighted = weighted_inverse.sum(axis=1)
+    degenerate = np.abs(weighted) < EPS
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        base_profit = totals * (1.0 - implied) / weighted
+    base_profit = np.where(degenerate, np.nan, base_profit)
+    stakes = totals[:, None] * inverse + base_profit[:, None] * weighted_inverse
+    feasible = ~degenerate & np.all(~present | (stakes >= -EPS), axis=1)
+    # -0.0000001 is a rounding error of a zero stake
+    stakes = np.where(present, np.where(np.abs(stakes) < EPS, 0.0, stakes), np.nan)
+    return MarketSolutions(odds, totals, stakes, base_profit, implied, feasible, degenerate)
+
+
+def solve_lp(odds: Sequence[float], weights: Sequence[float], total: float = 100.0,
+             min_stakes: Optional[Sequence[float]] = None, max_stakes: Optional[Sequence[float]] = None,
+             exact: bool = True) -> DutchingSolution:
+    """
+    The stakes of one market as an LP (CBC), maximizing the base profit.
+    With exact=False every outcome pays at least (not exactly) its weight times the base profit.
+    """
+    outcomes = range(len(odds))
+    prob = pulp.LpProblem("Betting_Arbitrage_Optimization", pulp.LpMaximize)
+    stakes = [pulp.LpVariable(f"Stake_{i}", lowBound=min_stakes[i] if min_stakes else 0,
+                              upBound=max_stakes[i] if max_stakes else None, cat='Continuous') for i in outcomes]
+    base_profit = pulp.LpVariable("Base_Profit", lowBound=None, cat='Continuous')
+
+    prob += base_profit, "Maximize_Profit"
+    prob += pulp.lpSum(stakes) == total, "Total_Stake_Constraint"
+    for i in outcomes:
+        profit_if_wins = stakes[i] * odds[i] - total
+        if exact:
+            prob += profit_if_wins == base_profit * weights[i], f"Profit_Constraint_{i}"
+        else:
+            prob += profit_if_wins >= base_profit * weights[i], f"Profit_Constraint_{i}"
+
+    prob.solve(pulp.PULP_CBC_CMD(msg=False))
+    status = pulp.LpStatus[prob.status]
+    if status != OPTIMAL:
+        return DutchingSolution(status, [0.0] * len(odds), None, 'lp')
+    return DutchingSolution(status, [stake.varValue or 0.0 for stake in stakes], base_profit.varValue, 'lp')
+
+
+def solve(odds: Sequence[float], weights: Optional[Sequence[float]] = None, total: float = 100.0,
+          min_stakes: Optional[Sequence[float]] = None, max_stakes: Optional[Sequence[float]] = None) -> DutchingSolution:
+    """The stakes of one market, by the closed form unless the market needs the LP."""
+    weights = list(weights) if weights is not None else [1.0] * len(odds)
+    if min_stakes is not None or max_stakes is not None:
+        return solve_lp(odds, weights, total, min_stakes, max_stakes, exact=False)
+
+    solutions = solve_markets([odds], [weights], total)
+    if solutions.degenerate[0]:
+        return solve_lp(odds, weights, total)
+    if not solutions.feasible[0]:
+        return DutchingSolution(INFEASIBLE, [0.0] * len(odds), None, 'closed form')
+    return DutchingSolution(OPTIMAL, solutions.stakes[0].tolist(), float(solutions.base_profit[0]), 'closed form')
@@ -4,27 +4,44 @@ from django.conf import settings
 import logging
 
 from .base import TelegramBot
+from . import streaming
+from .. import answer_cache
 
 logger = logging.getLogger(__name__)
 
+MODEL = "gpt-5-nano"
+# Change it with the prompt, the cached answers of the old prompt are not used anymore (answer_cache.py)
+PROMPT_VERSION = 1
+
 class PhraseBot(TelegramBot):
     def __init__(self):
         super().__init__(settings.TELEGRAM_TOPIC_BOT_TOKEN)
         self.openai_client = openai.OpenAI(api_key=settings.CHATGPT_API)
 
     def handle_command(self, message: Dict[str, Any]) -> Optional[str]:
+        reply = None
         try:
             message_text = message.get('text', '')
             
             if message_text == '/start':
                 return "Hello, I'm your phrase helper bot!"
             
-            return self._get_phrase_suggestions(message_text)
+            # A new answer is shown in the chat while OpenAI writes it
+            chat_id = str(message.get('chat', {}).get('id', ''))
+            reply = streaming.StreamingReply(self, chat_id) if streaming.enabled() and chat_id else None
+            answer = self._get_phrase_suggestions(message_text, reply)
+            return None if reply is not None and reply.sent else answer
         except Exception as e:
             logger.error(f"Error in PhraseBot: {e}")
-            return f"An error occurred: {str(e)}"
+            # A streamed answer which broke off ends with the error note in its own message
+            return None if reply is not None and reply.sent else f"An error occurred: {str(e)}"
+
+    def _get_phrase_suggestions(self, topic: str, reply: Optional[streaming.StreamingReply] = None) -> str:
+        """The answer given before for the same topic, a new one is asked from OpenAI (and streamed into reply)"""
+        return answer_cache.get_or_ask('phrase', topic, MODEL, PROMPT_VERSION,
+                                       lambda: self._ask_openai(topic, reply))
 
-    def _get_phrase_suggestions(self, topic: str) -> str:
+    def _ask_openai(self, topic: str, reply: Optional[streaming.StreamingReply] = None) -> str:
         system_content = (
             f"I'm looking to enhance my English vocabulary for discussions about {topic}. "
             "Could you provide me with some words or phrases, along with examples of how "
@@ -32,14 +49,18 @@ class PhraseBot(TelegramBot):
         )
 
         response = self.openai_client.chat.completions.create(
-            model="gpt-5-nano",
+            model=MODEL,
             messages=[
                 {"role": "user", "content": topic},
                 {"role": "system", "content": system_content}
             ],
             reasoning_effort="low",
             max_completion_tokens=4000,
+            stream=reply is not None,
         )
+        if reply is not None:
+            # The answer was shown in the chat while it was written
+            return reply.stream(response)
         
         return response.choices[0].message.content
 
@@ -0,0 +1,116 @@
+## Outbound rate limits of the Telegram sends, shared by all processes through the cache.
+##
+## Telegram answers 429 (and the message is lost) when a bot sends more than about 30 messages per second, or too
+## many to one chat. Before a message is sent TelegramBot.call() takes a token from two buckets:
+## - the bucket of the bot token (all chats), TELEGRAM_RATE_LIMITS['global'],
+## - the bucket of the chat, TELEGRAM_RATE_LIMITS['chat'].
+## A bucket holds `count` tokens and is filled up again every `seconds` (a cache counter per time window, cache.incr
+## is atomic with Redis/Memcached, with the file cache the limit is approximate). A send without a token is put into
+## the outbox (outbox.py), only a caller outside a request (cron) waits up to MAX_WAIT for the next window.
+## A 429 of Telegram pauses all sends of the bot for its retry_after.
+##
+## The throttled (had to wait), deferred (put into the outbox) and dropped (failed for good) sends are counted in
+## the cache per bot token, see counters().
+
+from django.conf import settings
+from django.core.cache import cache
+from typing import Dict, Optional, Tuple
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# (count, seconds) of the buckets, TELEGRAM_RATE_LIMITS in settings.py overrides them
+RATE_LIMITS = {'global': (25, 1), 'chat': (20, 60)}
+# Seconds a send outside a request may wait for a token before it goes to the outbox
+MAX_WAIT = 10
+# Methods which send or change a message of a chat
+SEND_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendPhoto', 'sendDocument',
+                'sendVoice', 'sendAudio', 'sendVideo', 'forwardMessage', 'copyMessage'}
+COUNTERS = ['throttled', 'deferred', 'dropped']
+
+
+def bot_key(token: str) -> str:
+    # The token itself is a secret, it is not put into the cache keys
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def limits() -> Dict[str, Tuple[int, float]]:
+    return dict(RATE_LIMITS, **getattr(settings, 'TELEGRAM_RATE_LIMITS', {}))
+
+
+def take(key: str, count: int, seconds: float, now: float) -> float:
+    """Take a token of a bucket, returns 0 or the seconds until the bucket is filled again."""
+    window = int(now // seconds)
+    bucket = f"{key}:{window}"
+    cache.add(bucket, 0, int(seconds) + 60)
+    try:
+        used = cache.incr(bucket)
+    except ValueError:
+        # The window expired between add() and incr()
+        cache.set(bucket, 1, int(seconds) + 60)
+        used = 1
+    if used <= count:
+        return 0
+    return (window + 1) * seconds - now
+
+
+def pause(token: str, seconds: float) -> None:
+    """Stop the sends of the bot in all processes for seconds (retry_after of a 429)."""
+    cache.set(f"telegram:rate:{bot_key(token)}:paused", time.time() + seconds, int(seconds) + 1)
+
+
+def paused_for(token: str, now: float) -> float:
+    until = cache.get(f"telegram:rate:{bot_key(token)}:paused")
+    return max(until - now, 0) if until else 0
+
+
+def acquire(token: str, chat_id: Optional[str] = None, max_wait: float = MAX_WAIT) -> Optional[float]:
+    """
+    Wait until the bot may send to the chat, returns the seconds waited.
+    Returns None (without waiting) when the send would have to wait longer than max_wait.
+    """
+    key = f"telegram:rate:{bot_key(token)}"
+    bucket_limits = limits()
+    # The chat first, a send which the chat does not allow does not use a token of the bot. A token which was taken
+    # is not taken again while the send waits for the next bucket.
+    buckets = [(f"{key}:global", bucket_limits['global'])]
+    if chat_id is not None:
+        buckets.insert(0, (f"{key}:chat:{chat_id}", bucket_limits['chat']))
+    waited = 0.0
+    for bucket, (size, seconds) in buckets:
+        while True:
+            now = time.time()
+            wait = paused_for(token, now) or take(bucket, size, seconds, now)
+            if not wait:
+                break
+            if waited + wait > max_wait:
+                return None
+            time.sleep(wait)
+            waited += wait
+    if waited:
+        count(token, 'throttled')
+    return waited
+
+
+def count(token: str, counter: str) -> None:
+    key = f"telegram:rate:{bot_key(token)}:{counter}"
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def counters(token: str) -> Dict[str, int]:
+    """The throttled, deferred and dropped sends of the bot, of all processes."""
+    keys = {f"telegram:rate:{bot_key(token)}:{counter}": counter for counter in COUNTERS}
+    values = cache.get_many(list(keys))
+    return {counter: values.get(key, 0) for key, counter in keys.items()}
+
+
+def log_counters(token: str, name: str = 'bot') -> None:
+    values = counters(token)
+    logger.info(f"Telegram {name} sends: {values['throttled']} throttled, {values['deferred']} deferred, "
+                f"{values['dropped']} dropped")
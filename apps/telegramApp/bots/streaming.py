@@ -0,0 +1,176 @@
+## Answers of OpenAI shown in the chat while they are written (DictionaryBot, PhraseBot)
+## The completion is asked with stream=True. The first words are sent as a message as soon as they are there, the
+## message is then edited with the text so far, at most once per edit_interval(): the chat limit of rate_limit.py
+## (20 sends a minute by default), the edits are sends of the chat too. A "▌" at the end shows that it is still
+## being written.
+## Telegram allows MAX_MESSAGE characters in a message, a longer answer goes on in a new message, cut at a line break
+## (or a space) before MAX_PART. An edit while streaming which would have to wait is skipped without waiting, the
+## final text of every message is sent for sure (it waits in the outbox when it has to).
+## When the stream breaks off, the messages which were sent end with ERROR_NOTE instead of the cursor (fail()).
+## The time until the first words were visible is counted per process, see metrics().
+##
+## reply = StreamingReply(bot, chat_id)
+## answer = reply.stream(openai_client.chat.completions.create(stream=True, ...))
+
+from django.conf import settings
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from . import rate_limit
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE = 4096
+# Room for the cursor and a line break
+MAX_PART = 4000
+# The first message waits for this many characters, a single word is not worth a message
+FIRST_CHARS = 20
+# Never more often than this, whatever the rate limits allow
+MIN_INTERVAL = 1.0
+CURSOR = " ▌"
+ERROR_NOTE = "\n\n⚠️ The answer was cut off by an error, please ask again."
+
+_lock = threading.Lock()
+# 'first_output' / 'total' >> {'answers', 'total', 'max'} of this process
+_metrics: Dict[str, Dict[str, float]] = {}
+
+
+def enabled() -> bool:
+    return getattr(settings, 'TELEGRAM_STREAM_ANSWERS', True)
+
+
+def edit_interval() -> float:
+    """Seconds between two edits of a streamed message, so that they stay within the limit of the chat."""
+    count, seconds = rate_limit.limits()['chat']
+    return max(MIN_INTERVAL, seconds / count)
+
+
+def record(name: str, seconds: float) -> None:
+    with _lock:
+        stats = _metrics.setdefault(name, {'answers': 0, 'total': 0.0, 'max': 0.0})
+        stats['answers'] += 1
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+
+
+def metrics() -> Dict[str, Dict[str, float]]:
+    """Seconds until the first words of the answers were visible (first_output) and until they were complete."""
+    with _lock:
+        return {name: dict(stats, average=stats['total'] / stats['answers'] if stats['answers'] else 0.0)
+                for name, stats in _metrics.items()}
+
+
+def reset_metrics() -> None:
+    with _lock:
+        _metrics.clear()
+
+
+def split(text: str) -> Tuple[str, str]:
+    """The text which fits into a message and the rest, cut at a line break or a space when there is one."""
+    cut = text.rfind('\n', MAX_PART // 2, MAX_PART)
+    if cut < 0:
+        cut = text.rfind(' ', MAX_PART // 2, MAX_PART)
+    if cut < 0:
+        cut = MAX_PART
+    return text[:cut], text[cut:].lstrip()
+
+
+class StreamingReply():
+    # One answer which is written into the chat while it comes, in as many messages as it needs
+
+    def __init__(self, bot, chat_id: str, interval: Optional[float] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = edit_interval() if interval is None else interval
+        self.text = ''
+        # The text of every message and its message_id (None until it was sent)
+        self.parts: List[str] = ['']
+        self.message_ids: List[Optional[int]] = [None]
+        # The text of the last message as the chat shows it
+        self.shown = ''
+        self.last_edit = 0.0
+        self.started = time.monotonic()
+        self.first_output: Optional[float] = None
+
+    @property
+    def sent(self) -> bool:
+        """Whether the answer is in the chat already (or waits in the outbox), the bot must not send it again."""
+        return self.first_output is not None
+
+    def add(self, text: str) -> None:
+        """The next piece of the answer."""
+        self.text += text
+        self.parts[-1] += text
+        while len(self.parts[-1]) > MAX_PART:
+            head, rest = split(self.parts[-1])
+            self.parts[-1] = head
+            self.show(final=True)
+            self.parts.append(rest)
+            self.message_ids.append(None)
+            self.shown = ''
+        if self.message_ids[-1] is None:
+            if len(self.parts[-1].strip()) >= FIRST_CHARS:
+                self.show()
+        elif time.monotonic() - self.last_edit >= self.interval:
+            self.show()
+
+    def show(self, final: bool = False) -> None:
+        """Send or edit the last message with the text so far, with the cursor until it is final."""
+        text = self.parts[-1] if final else self.parts[-1] + CURSOR
+        if not self.parts[-1].strip() or text == self.shown:
+            return
+        data = {"chat_id": self.chat_id, "text": text}
+        if self.message_ids[-1] is None:
+            method = 'sendMessage'
+        else:
+            method = 'editMessageText'
+            data["message_id"] = self.message_ids[-1]
+        try:
+            # While streaming a send without a rate limit token is skipped at once, the next one has more text
+            result = self.bot.call(method, data, defer=final, max_wait=0)
+        except Exception as e:
+            if final:
+                raise
+            logger.warning(f"Streamed {method} to {self.chat_id} failed: {e}")
+            result = {}
+        self.last_edit = time.monotonic()
+        # A final send which waits in the outbox is sent, the other ones are tried again with more text
+        if not (result.get('ok') or (final and result.get('deferred'))):
+            return
+        if method == 'sendMessage':
+            # A deferred final message has no message_id, it is not edited anymore anyway
+            self.message_ids[-1] = result.get('result', {}).get('message_id', 0)
+        self.shown = text
+        if self.first_output is None:
+            self.first_output = time.monotonic() - self.started
+            record('first_output', self.first_output)
+
+    def stream(self, chunks: Iterable[Any]) -> str:
+        """Show the chunks of an OpenAI chat completion stream, returns the whole answer. Raises when it breaks off."""
+        try:
+            for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    self.add(chunk.choices[0].delta.content)
+        except Exception:
+            self.fail()
+            raise
+        return self.finish()
+
+    def fail(self) -> None:
+        """End the answer which broke off: the last message loses the cursor and gets ERROR_NOTE."""
+        if not self.sent:
+            # Nothing is in the chat, the bot answers with the error itself
+            return
+        self.parts[-1] += ERROR_NOTE
+        try:
+            self.show(final=True)
+        except Exception as e:
+            logger.error(f"Could not end the broken answer to {self.chat_id}: {e}")
+
+    def finish(self) -> str:
+        self.show(final=True)
+        record('total', time.monotonic() - self.started)
+        logger.info(f"Streamed {len(self.text)} characters in {len(self.parts)} messages to {self.chat_id}, first "
+                    f"output after {self.first_output or 0:.2f}s")
+        return self.text
@@ -0,0 +1,162 @@
+## HTTP transport of the Telegram Bot API calls of all bots.
+##
+## Every bot token gets one requests.Session per process, its connections are kept alive and reused, so a reminder
+## run which sends hundreds of messages makes the TLS handshake once instead of once per message.
+## A call has connect/read timeouts and is tried again on connection errors and 5xx answers (exponential backoff with
+## jitter). A read timeout is not tried again, Telegram may have sent the message already. A 429 answer is tried again after the retry_after which Telegram asks for,
+## unless it is longer than max_retry_after (the sends of TelegramBot.call() do not wait, they go to the outbox).
+## A 429 also pauses the other sends of the bot in all processes (rate_limit.py).
+## The latency of every API method is counted per process, see metrics().
+##
+## transport.call(token, 'sendMessage', {'chat_id': chat_id, 'text': text})
+## transport.download(token, file_path)      >> the content of a file, file_path from getFile
+
+from typing import Any, Dict, Optional
+from requests.adapters import HTTPAdapter
+from . import rate_limit
+import logging
+import os
+import random
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.telegram.org/bot{token}/{method}"
+FILE_URL = "https://api.telegram.org/file/bot{token}/{file_path}"
+# (connect, read) seconds
+TIMEOUT = (5, 30)
+# Connections kept open per token, enough for the threads of the update worker
+POOL_SIZE = 10
+# Tries of a call, the first one included
+MAX_TRIES = 3
+# Backoff of the retries on connection errors and 5xx: 0.5, 1, 2 ... seconds with jitter
+RETRY_BASE_DELAY = 0.5
+# A 429 with a longer retry_after is returned to the caller instead of waiting in the request (max_retry_after)
+MAX_RETRY_AFTER = 30
+# Calls slower than this are logged as warnings
+SLOW_CALL = 2.0
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_pid = None
+_lock = threading.Lock()
+# method >> {'calls', 'errors', 'retries', 'total', 'max'} of this process
+_metrics: Dict[str, Dict[str, float]] = {}
+
+
+def get_session(token: str) -> requests.Session:
+    """The keep-alive session of a bot token in this process."""
+    global _sessions_pid
+    with _lock:
+        # A forked worker process must not use the sockets of its parent
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if token not in _sessions:
+            session = requests.Session()
+            # The retries are done by call(), they have to know about retry_after
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+            session.mount('https://', adapter)
+            _sessions[token] = session
+        return _sessions[token]
+
+
+def retry_delay(attempt: int) -> float:
+    return RETRY_BASE_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+def record(method: str, seconds: float, error: bool = False, retries: int = 0) -> None:
+    with _lock:
+        stats = _metrics.setdefault(method, {'calls': 0, 'errors': 0, 'retries': 0, 'total': 0.0, 'max': 0.0})
+        stats['calls'] += 1
+        stats['errors'] += int(error)
+        stats['retries'] += retries
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+    if seconds > SLOW_CALL:
+        logger.warning(f"Slow Telegram call {method}: {seconds:.2f}s ({retries} retries)")
+
+
+def metrics() -> Dict[str, Dict[str, float]]:
+    """The latency of the API methods in this process: calls, errors, retries, average and max seconds."""
+    with _lock:
+        return {method: dict(stats, average=stats['total'] / stats['calls'] if stats['calls'] else 0.0)
+                for method, stats in _metrics.items()}
+
+
+def log_metrics() -> None:
+    """Write the metrics of this process to the log, e.g. at the end of a command."""
+    for method, stats in sorted(metrics().items()):
+        logger.info(f"Telegram {method}: {stats['calls']} calls, {stats['errors']} errors, {stats['retries']} retries, "
+                    f"average {stats['average']:.3f}s, max {stats['max']:.3f}s")
+
+
+def reset_metrics() -> None:
+    with _lock:
+        _metrics.clear()
+
+
+def answer(response: requests.Response) -> Dict[str, Any]:
+    """The JSON answer of Telegram, an ok: false answer when the body is not JSON (e.g. the 502 page of a proxy)."""
+    try:
+        result = response.json()
+    except ValueError:
+        result = None
+    if not isinstance(result, dict):
+        return {'ok': False, 'error_code': response.status_code,
+                'description': f"HTTP {response.status_code}: {response.text[:200]}"}
+    return result
+
+
+def call(token: str, method: str, data: Optional[Dict[str, Any]] = None, timeout=TIMEOUT,
+         max_retry_after: float = MAX_RETRY_AFTER) -> Dict[str, Any]:
+    """
+    Call a Bot API method and return its JSON answer (also for errors which Telegram answers, e.g. ok: false, and
+    for answers which are not JSON, see answer()).
+    Raises the requests exception when the network still fails after the retries.
+    """
+    url = API_URL.format(token=token, method=method)
+    session = get_session(token)
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = session.post(url, json=data or {}, timeout=timeout)
+        except requests.ConnectionError as e:
+            if attempt >= MAX_TRIES:
+                record(method, time.monotonic() - start, error=True, retries=attempt - 1)
+                raise
+            logger.warning(f"Telegram {method} network error, try {attempt}: {e}")
+            time.sleep(retry_delay(attempt))
+            continue
+
+        if response.status_code == 429:
+            retry_after = answer(response).get('parameters', {}).get('retry_after', 1)
+            rate_limit.pause(token, retry_after)
+            if attempt < MAX_TRIES and retry_after <= max_retry_after:
+                logger.warning(f"Telegram {method} rate limited, retry after {retry_after}s")
+                time.sleep(retry_after)
+                continue
+        elif response.status_code >= 500 and attempt < MAX_TRIES:
+            logger.warning(f"Telegram {method} answered {response.status_code}, try {attempt}")
+            time.sleep(retry_delay(attempt))
+            continue
+
+        result = answer(response)
+        record(method, time.monotonic() - start, error=not result.get('ok', False), retries=attempt - 1)
+        return result
+
+
+def download(token: str, file_path: str, timeout=TIMEOUT) -> bytes:
+    """The content of a file which a user sent to the bot, file_path is from getFile. Raises on HTTP errors."""
+    start = time.monotonic()
+    try:
+        response = get_session(token).get(FILE_URL.format(token=token, file_path=file_path), timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException:
+        record('download', time.monotonic() - start, error=True)
+        raise
+    record('download', time.monotonic() - start)
+    return response.content
@@ -1,17 +1,29 @@
-from typing import Optional, Dict, Any
+from typing import Callable, Optional, Dict, Any
 import replicate
-import requests
 import tempfile
 import os
+import time
 from django.conf import settings
 import logging
 import openai
 
 from .base import TelegramBot
+from . import transport
+from .. import transcription_jobs
 
 logger = logging.getLogger(__name__)
 
+WHISPER_MODEL = "vaibhavs10/incredibly-fast-whisper:3ab86df6c8f54c11309d4d1f930ac292bad43ace52d10c80d87eb258b3c9f79c"
+TRANSLATION_MODEL = "gpt-5-nano"
+# Seconds between the looks at a running transcription (and whether the job was cancelled)
+POLL_INTERVAL = 2
+TRANSCRIBE_TIMEOUT = 10 * 60
+
 class VoiceTranscriptionBot(TelegramBot):
+    # The cached transcripts and translations are only used with the models which made them (transcript_cache.py)
+    model_version = WHISPER_MODEL
+    translation_model = TRANSLATION_MODEL
+
     def __init__(self):
         try:
             # Check if token exists
@@ -64,6 +76,8 @@ class VoiceTranscriptionBot(TelegramBot):
             # Handle text commands
             message_text = message.get('text', '')
             
+            if message_text == '/cancel':
+                return self._cancel_jobs(str(message.get('chat', {}).get('id')))
             if message_text == '/start':
                 return (
                     "🎤 Voice Transcription Bot\n\n"
@@ -88,7 +102,8 @@ class VoiceTranscriptionBot(TelegramBot):
                     "• Keep messages under 5 minutes\n\n"
                     "Commands:\n"
                     "/start - Welcome message\n"
-                    "/help - Show this help"
+                    "/help - Show this help\n"
+                    "/cancel - Stop the voice messages being processed"
                 )
             else:
                 return (
@@ -99,13 +114,12 @@ class VoiceTranscriptionBot(TelegramBot):
             logger.error(f"Error in VoiceTranscriptionBot.handle_command: {e}", exc_info=True)
             return f"❌ An error occurred: {str(e)}"
 
-    def _handle_voice_message(self, message: Dict[str, Any]) -> str:
-        """Handle voice message - transcribe directly in Persian and translate to English"""
+    def _handle_voice_message(self, message: Dict[str, Any]) -> Optional[str]:
+        """Start the background job of a voice message, it edits its progress message until the text is there"""
         try:
             voice = message.get('voice', {})
             file_id = voice.get('file_id')
             duration = voice.get('duration', 0)
-            chat_id = str(message.get('chat', {}).get('id'))
             
             if not file_id:
                 return "❌ Could not process the voice message. Please try again."
@@ -114,48 +128,29 @@ class VoiceTranscriptionBot(TelegramBot):
             if duration > 300:  # 5 minutes
                 return "❌ Voice message is too long. Please keep it under 5 minutes."
             
-            # Send processing message
-            self.send_message(chat_id, "🎤 Processing your voice message...")
-            
-            # Process the voice message in Persian
-            transcription = self._process_voice_message(file_id)
-            
-            if transcription:
-                # Send Persian transcription first
-                if len(transcription) > 4000:
-                    truncated_transcription = transcription[:4000] + "... (truncated)"
-                    self.send_message(chat_id, f"{truncated_transcription}")
-                else:
-                    self.send_message(chat_id, f"{transcription}")
-                
-                # Translate to English if OpenAI is available
-                if self.openai_client:
-                    translation = self._translate_to_english(transcription)
-                    
-                    if translation:
-                        if len(translation) > 4000:
-                            translation = translation[:4000] + "... (truncated)"
-                        self.send_message(chat_id, f"{translation}")
-                    else:
-                        self.send_message(chat_id, "❌ Could not translate to English. Translation service is unavailable.")
-                else:
-                    self.send_message(chat_id, "❌ Translation service is not configured.")
-                
-                return None  # We've already sent the messages
-            else:
-                return "❌ Could not transcribe the voice message. Please try again with a clearer recording."
+            # None when the job was started, it sends the messages
+            return transcription_jobs.submit(self, message)
                 
         except Exception as e:
             logger.error(f"Error handling voice message: {e}", exc_info=True)
             return f"❌ Error processing voice message: {str(e)}"
 
+    def _cancel_jobs(self, chat_id: str) -> str:
+        """Cancel the voice messages of the chat which are being processed"""
+        jobs = transcription_jobs.cancel_chat(chat_id)
+        for job in jobs:
+            transcription_jobs.progress(self, job, transcription_jobs.CANCELLED_TEXT, final=True)
+        if not jobs:
+            return "There is no voice message being processed."
+        return f"🚫 Cancelled {len(jobs)} voice message(s)."
+
     def _translate_to_english(self, persian_text: str) -> Optional[str]:
         """Translate Persian text to English using OpenAI GPT"""
         try:
             prompt = f"{persian_text}"
 
             response = self.openai_client.chat.completions.create(
-                model="gpt-5-nano",
+                model=TRANSLATION_MODEL,
                 messages=[
                     {
                         "role": "system",
@@ -183,39 +178,23 @@ class VoiceTranscriptionBot(TelegramBot):
             logger.error(f"Error translating text: {e}", exc_info=True)
             return None
 
-    def _process_voice_message(self, file_id: str) -> Optional[str]:
-        """Process voice message and transcribe in Persian"""
-        try:
-            # Get file info from Telegram
-            file_info = self._get_file_info(file_id)
-            if not file_info or not file_info.get('ok'):
-                logger.error(f"Failed to get file info: {file_info}")
-                return None
-            
-            file_path = file_info['result']['file_path']
-            
-            # Download the voice file
-            voice_url = f"https://api.telegram.org/file/bot{self.token}/{file_path}"
-            
-            # Transcribe using Replicate with Persian language
-            return self._transcribe_audio(voice_url)
-                
-        except Exception as e:
-            logger.error(f"Error processing voice message: {e}", exc_info=True)
-            return None
+    def file_url(self, file_path: str) -> str:
+        """URL of a file which a user sent, file_path is from getFile"""
+        return transport.FILE_URL.format(token=self.token, file_path=file_path)
 
     def _get_file_info(self, file_id: str) -> Optional[Dict[str, Any]]:
         """Get file information from Telegram API"""
         try:
-            url = f"{self.base_url}/getFile"
-            response = requests.post(url, json={"file_id": file_id})
-            return response.json()
+            return self.call('getFile', {"file_id": file_id})
         except Exception as e:
             logger.error(f"Error getting file info: {e}")
             return None
 
-    def _transcribe_audio(self, audio_url: str) -> Optional[str]:
-        """Transcribe audio using Replicate's Whisper model in Persian"""
+    def _transcribe_audio(self, audio_url: str, cancelled: Optional[Callable[[], bool]] = None) -> Optional[str]:
+        """
+        Transcribe audio using Replicate's Whisper model in Persian.
+        cancelled() is asked while the prediction runs, it is cancelled on Replicate and JobCancelled is raised.
+        """
         try:
             input_data = {
                 "task": "transcribe",
@@ -226,11 +205,23 @@ class VoiceTranscriptionBot(TelegramBot):
                 "diarise_audio": False
             }
             
-            # Use the client instance for the new API version
-            output = self.replicate_client.run(
-                "vaibhavs10/incredibly-fast-whisper:3ab86df6c8f54c11309d4d1f930ac292bad43ace52d10c80d87eb258b3c9f79c",
-                input=input_data
-            )
+            # A prediction instead of run(), which would block until it is finished
+            prediction = self.replicate_client.predictions.create(version=WHISPER_MODEL.split(':')[1], input=input_data)
+            deadline = time.monotonic() + TRANSCRIBE_TIMEOUT
+            while prediction.status not in ('succeeded', 'failed', 'canceled'):
+                if cancelled is not None and cancelled():
+                    prediction.cancel()
+                    raise transcription_jobs.JobCancelled()
+                if time.monotonic() > deadline:
+                    prediction.cancel()
+                    logger.error(f"Transcription timed out after {TRANSCRIBE_TIMEOUT} seconds")
+                    return None
+                time.sleep(POLL_INTERVAL)
+                prediction.reload()
+            if prediction.status != 'succeeded':
+                logger.error(f"Transcription {prediction.status}: {prediction.error}")
+                return None
+            output = prediction.output
             
             # Handle new API response format (1.0.7+)
             if isinstance(output, dict) and 'text' in output:
@@ -248,18 +239,33 @@ class VoiceTranscriptionBot(TelegramBot):
                 except:
                     return None
                 
+        except transcription_jobs.JobCancelled:
+            raise
         except Exception as e:
             logger.error(f"Error transcribing audio: {e}", exc_info=True)
             return None
 
     def handle_callback_query(self, callback_query: Dict[str, Any]) -> None:
-        """Handle callback queries (not used in this simplified bot)"""
-        pass
+        """Handle the Cancel button of the progress messages"""
+        data = callback_query.get('data', '')
+        if not data.startswith(transcription_jobs.CANCEL_DATA):
+            self.answer_callback_query(callback_query['id'])
+            return
+        message = callback_query.get('message', {})
+        chat_id = str(message.get('chat', {}).get('id'))
+        try:
+            pk = int(data[len(transcription_jobs.CANCEL_DATA):])
+        except ValueError:
+            pk = None
+        if pk is not None and transcription_jobs.cancel(pk, chat_id):
+            self.answer_callback_query(callback_query['id'], "Cancelled")
+            self.edit_message(chat_id, message.get('message_id'), transcription_jobs.CANCELLED_TEXT)
+        else:
+            self.answer_callback_query(callback_query['id'], "This voice message is already finished")
 
     def send_message(self, chat_id: str, text: str, parse_mode: str = None, reply_markup: str = None):
         """Send a message to a chat"""
         try:
-            url = f"{self.base_url}/sendMessage"
             data = {
                 "chat_id": chat_id,
                 "text": text
@@ -270,8 +276,7 @@ class VoiceTranscriptionBot(TelegramBot):
             if reply_markup:
                 data["reply_markup"] = reply_markup
                 
-            response = requests.post(url, json=data)
-            return response.json()
+            return self.call('sendMessage', data)
         except Exception as e:
             logger.error(f"Error sending message: {e}")
             return None 
\ No newline at end of file
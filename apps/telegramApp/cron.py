@@ -1,5 +1,7 @@
 from apps.telegramApp.management.commands.send_birthday_reminder import Command
 from django.utils import timezone
+from django.core.management import call_command
+from apps.telegramApp import answer_cache, outbox, state_store, transcript_cache, transcription_jobs
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,3 +28,44 @@ def send_automatic_birthday_reminders():
         raise
 
 
+def sweep_abandoned_states():
+    """
+    Delete the conversation states of the bot wizards which were not touched for a day.
+    """
+    deleted = state_store.sweep()
+    logger.info(f"Deleted {deleted} abandoned conversation states")
+
+
+def send_deferred_messages():
+    """
+    Send the messages which Telegram rate limited, when they are due.
+    """
+    counts = outbox.flush()
+    logger.info("Outbox: {sent} sent, {deferred} deferred again, {dropped} dropped".format(**counts))
+
+
+def resume_voice_jobs():
+    """
+    Start again the voice transcriptions whose process died. They run one after the other in this process, at most
+    transcription_jobs.INLINE_RECOVER of them, the others are started by the next runs.
+    """
+    started = transcription_jobs.recover(transcription_jobs.INLINE_RECOVER, inline=True)
+    logger.info(f"Started {started} voice transcriptions again")
+
+
+def evict_voice_transcripts():
+    """
+    Delete the voice transcripts which were not used for long, and the least recently used above the limit.
+    """
+    deleted = transcript_cache.evict()
+    logger.info(f"Evicted {deleted} voice transcripts")
+    transcript_cache.log_metrics()
+
+
+def refresh_answer_cache():
+    """
+    Ask OpenAI again for the most frequent dictionary and phrase answers before they expire, then prune the cache.
+    """
+    call_command('warm_answer_cache')
+    deleted = answer_cache.prune()
+    logger.info(f"Pruned {deleted} cached answers")
@@ -0,0 +1,38 @@
+## Fills the calendar columns (month/day, day_of_year, Persian month/day) of the birthdays which were saved before
+## the columns existed. New and edited birthdays get them on save. Run it once after the migration:
+## python manage.py backfill_birthday_calendar
+## python manage.py backfill_birthday_calendar --all     >> recompute every birthday, not only the empty ones
+
+from django.core.management.base import BaseCommand
+from apps.telegramApp.models import GlobalBirthday
+from apps.telegramApp import birthday_report
+
+
+class Command(BaseCommand):
+    help = 'Fills the calendar columns of the old birthdays'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute the columns of all birthdays')
+        parser.add_argument('--batch', type=int, default=1000, help='Birthdays per bulk update')
+
+    def handle(self, *args, **options):
+        birthdays = GlobalBirthday.objects.order_by('pk')
+        if not options['all']:
+            birthdays = birthdays.filter(day_of_year__isnull=True)
+        batch = []
+        updated = 0
+        users = set()
+        for birthday in birthdays.iterator(chunk_size=options['batch']):
+            birthday.fill_calendar_fields()
+            batch.append(birthday)
+            users.add(birthday.added_by)
+            if len(batch) >= options['batch']:
+                GlobalBirthday.objects.bulk_update(batch, GlobalBirthday.CALENDAR_FIELDS)
+                updated += len(batch)
+                batch = []
+        GlobalBirthday.objects.bulk_update(batch, GlobalBirthday.CALENDAR_FIELDS)
+        updated += len(batch)
+        # bulk_update does not call save(), the reports of these users have to be worked out again
+        for user_id in users:
+            birthday_report.forget(user_id)
+        self.stdout.write(self.style.SUCCESS(f'{updated} birthdays updated'))
@@ -0,0 +1,75 @@
+## Benchmark of the dutching solver (apps/telegramApp/bots/dutching_solver.py)
+## Random markets are solved three ways and the time per market is compared:
+## - lp: the PuLP model with CBC, as calculate_arbitrage() did it on every request before,
+## - closed form: solve() for one market at a time, as the bot does it now,
+## - batch: solve_markets() for all markets in one NumPy call.
+## The largest difference of the stakes against the LP is printed too, it should be below a cent.
+## python manage.py benchmark_dutching
+## python manage.py benchmark_dutching --markets 10000 --outcomes 5 --lp-markets 100
+
+from django.core.management.base import BaseCommand, CommandError
+from apps.telegramApp.bots import dutching_solver
+import json
+import numpy as np
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compares the time per market of the LP, the closed form and the batch dutching solver'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--markets', type=int, default=1000, help='Random markets to solve')
+        parser.add_argument('--outcomes', type=int, default=3, help='Outcomes per market')
+        parser.add_argument('--lp-markets', type=int, default=50,
+                            help='Markets solved by the LP, it starts a CBC process for every one')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if options['markets'] < 1 or options['outcomes'] < 2:
+            raise CommandError('--markets must be at least 1 and --outcomes at least 2')
+        rng = np.random.default_rng(options['seed'])
+        shape = (options['markets'], options['outcomes'])
+        odds = np.round(rng.uniform(1.2, 12.0, shape), 2)
+        weights = np.round(rng.uniform(0.5, 3.0, shape), 1)
+        lp_markets = min(options['lp_markets'], options['markets'])
+
+        start = time.perf_counter()
+        lp = [dutching_solver.solve_lp(odds[i].tolist(), weights[i].tolist()) for i in range(lp_markets)]
+        lp_seconds = (time.perf_counter() - start) / lp_markets
+
+        start = time.perf_counter()
+        closed = [dutching_solver.solve(odds[i].tolist(), weights[i].tolist()) for i in range(options['markets'])]
+        closed_seconds = (time.perf_counter() - start) / options['markets']
+
+        start = time.perf_counter()
+        batch = dutching_solver.solve_markets(odds, weights)
+        batch_seconds = (time.perf_counter() - start) / options['markets']
+
+        # Only the markets which both solved, an infeasible market has no stakes
+        differences = [np.max(np.abs(np.array(lp[i].stakes) - batch.stakes[i])) for i in range(lp_markets)
+                       if lp[i].optimal and batch.feasible[i]]
+        mismatches = sum(lp[i].optimal != bool(batch.feasible[i]) for i in range(lp_markets))
+        report = {
+            'markets': options['markets'],
+            'outcomes': options['outcomes'],
+            'lp_markets': lp_markets,
+            'lp_us': lp_seconds * 1e6,
+            'closed_form_us': closed_seconds * 1e6,
+            'batch_us': batch_seconds * 1e6,
+            'feasible': int(batch.feasible.sum()),
+            'max_stake_difference': float(max(differences, default=0.0)),
+            'status_mismatches': int(mismatches),
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"{report['markets']} markets of {report['outcomes']} outcomes, "
+                          f"{report['feasible']} feasible")
+        self.stdout.write(f"lp:          {report['lp_us']:12.1f} us per market ({lp_markets} markets)")
+        self.stdout.write(f"closed form: {report['closed_form_us']:12.1f} us per market "
+                          f"({report['lp_us'] / report['closed_form_us']:.0f}x)")
+        self.stdout.write(f"batch:       {report['batch_us']:12.3f} us per market "
+                          f"({report['lp_us'] / report['batch_us']:.0f}x)")
+        self.stdout.write(f"Largest stake difference to the LP: {report['max_stake_difference']:.6f}, "
+                          f"{report['status_mismatches']} markets with another status")
@@ -0,0 +1,123 @@
+## Worker of the Telegram update queue (see apps/telegramApp/update_queue.py)
+## Runs the bots for the updates which the webhook saved in queue mode (TELEGRAM_WEBHOOK_MODE = 'queue').
+## Every task of the pool is one chat with its waiting updates, so the updates of a chat keep their order.
+## python manage.py process_telegram_updates --workers 4
+## python manage.py process_telegram_updates --pool process --workers 2
+## python manage.py process_telegram_updates --once      >> process what is waiting and stop (e.g. from cron)
+## It also sends the rate limited messages of the outbox (apps/telegramApp/outbox.py) and starts again the voice
+## transcriptions whose process died (apps/telegramApp/transcription_jobs.py).
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from apps.telegramApp import outbox, transcript_cache, transcription_jobs, update_queue
+from apps.telegramApp.bots import transport
+import django
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Processed updates older than --keep-days are looked for once in this many seconds
+PURGE_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = 'Processes the queued Telegram updates in a pool of threads or processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of chats processed at the same time, 0 runs them in this process')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='Threads for bots which mostly wait for the network, processes for CPU work')
+        parser.add_argument('--max-attempts', type=int, default=update_queue.MAX_ATTEMPTS,
+                            help='Tries of an update before it is marked failed')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds between the looks for new updates')
+        parser.add_argument('--keep-days', type=int, default=7, help='Days to keep the processed updates')
+        parser.add_argument('--once', action='store_true', help='Stop when nothing is waiting anymore')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 0:
+            raise CommandError('--workers must be 0 or more')
+        if options['max_attempts'] < 1:
+            raise CommandError('--max-attempts must be at least 1')
+        self.options = options
+        self.totals = {'done': 0, 'retried': 0, 'failed': 0}
+        self.last_purge = None
+        start = timezone.now()
+
+        if options['workers'] == 0:
+            self.run_inline()
+        else:
+            # The forked processes must not share the database connection of this one
+            connections.close_all()
+            if options['pool'] == 'process':
+                pool = ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup)
+            else:
+                pool = ThreadPoolExecutor(max_workers=options['workers'])
+            try:
+                with pool:
+                    self.run_pool(pool)
+            except KeyboardInterrupt:
+                self.stdout.write('Stopped, the claimed updates are given out again after the lock timeout')
+
+        self.stdout.write(self.style.SUCCESS('{done} updates done, {retried} retried, {failed} failed in {seconds:.1f} seconds'
+                                             .format(seconds=(timezone.now() - start).total_seconds(), **self.totals)))
+        # Only the calls of this process, the process pool keeps its own
+        transport.log_metrics()
+        transcript_cache.log_metrics()
+
+    def add_counts(self, counts):
+        for outcome, count in counts.items():
+            self.totals[outcome] += count
+
+    def housekeeping(self, keep=None):
+        update_queue.recover_stale(keep)
+        counts = outbox.flush()
+        if any(counts.values()):
+            logger.info("Outbox: {sent} sent, {deferred} deferred again, {dropped} dropped".format(**counts))
+        transcription_jobs.recover()
+        now = time.monotonic()
+        if self.last_purge is None or now - self.last_purge > PURGE_INTERVAL:
+            self.last_purge = now
+            deleted = update_queue.purge(self.options['keep_days'])
+            if deleted:
+                logger.info(f"Deleted {deleted} processed updates")
+
+    def run_inline(self):
+        while True:
+            self.housekeeping()
+            claims = update_queue.claim_chats(1)
+            if not claims:
+                if self.options['once']:
+                    return
+                time.sleep(self.options['poll'])
+                continue
+            for claim, chat in claims:
+                self.add_counts(update_queue.process_claim(claim, self.options['max_attempts']))
+
+    def run_pool(self, pool):
+        # future >> (claim, (secret_token, chat_id)) of the chats being processed
+        running = {}
+        while True:
+            self.housekeeping(keep=[claim for claim, chat in running.values()])
+            free = self.options['workers'] - len(running)
+            if free > 0:
+                busy = {chat for claim, chat in running.values()}
+                for claim, chat in update_queue.claim_chats(free, busy):
+                    future = pool.submit(update_queue.process_claim_task, claim, self.options['max_attempts'])
+                    running[future] = (claim, chat)
+            if not running:
+                if self.options['once']:
+                    return
+                time.sleep(self.options['poll'])
+                continue
+            finished, _ = wait(running, timeout=self.options['poll'], return_when=FIRST_COMPLETED)
+            for future in finished:
+                claim, chat = running.pop(future)
+                try:
+                    self.add_counts(future.result())
+                except Exception as e:
+                    # The updates stay claimed and are given out again after the lock timeout
+                    logger.error(f"Worker failed on the updates of chat {chat}: {e}", exc_info=True)
@@ -2,6 +2,8 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from apps.telegramApp.models import GlobalBirthday, UserBirthdaySettings
 from apps.telegramApp.bots.birthday_bot import BirthdayBot
+from apps.telegramApp.bots import rate_limit, transport
+from apps.telegramApp import birthday_stats, reminders
 from datetime import datetime, timedelta
 import logging
 
@@ -13,6 +15,8 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--user_id', type=str, help='Telegram user ID to send reminder to (for manual testing)')
         parser.add_argument('--auto', action='store_true', help='Run automatic reminders for all users')
+        parser.add_argument('--dry-run', action='store_true', help='Only show the reminders which --auto would send')
+        parser.add_argument('--date', type=str, help='Plan the automatic reminders of this date (YYYY-MM-DD)')
 
     def handle(self, *args, **options):
         user_id = options.get('user_id')
@@ -25,9 +29,11 @@ class Command(BaseCommand):
         try:
             # Initialize bot
             bot = BirthdayBot()
+            self.bot = bot
 
             if auto_mode:
-                self.send_automatic_reminders(bot)
+                today = datetime.strptime(options['date'], '%Y-%m-%d').date() if options.get('date') else None
+                self.send_automatic_reminders(bot, today, options.get('dry_run', False))
             else:
                 self.send_manual_reminder(bot, user_id)
 
@@ -35,64 +41,49 @@ class Command(BaseCommand):
             logger.error(f"Error sending birthday reminder: {e}")
             self.stdout.write(self.style.ERROR(f'Error sending birthday reminder: {str(e)}'))
 
-    def send_automatic_reminders(self, bot):
+    def send_automatic_reminders(self, bot, today=None, dry_run=False):
         """Send automatic reminders to all users based on their reminder settings."""
-        today = timezone.now().date()
-        users = UserBirthdaySettings.objects.all()
-        reminders_sent = 0
-        birthday_messages_sent = 0
+        plan = reminders.plan_reminders(today)
+        self.stdout.write(f'{plan.today}: {len(plan.birthday_messages)} birthday messages and '
+                          f'{len(plan.reminders)} reminders due ({plan.scanned} birthdays read)')
+
+        if dry_run:
+            for item in plan:
+                self.stdout.write(f'  {item.kind} to {item.user_id}: {item.birthday.name} on {item.next_birthday} '
+                                  f'(in {item.days_until} days)')
+            return
 
-        for user in users:
+        sender = reminders.RateLimitedSender(bot)
+        sent_reminders = []
+        for item in plan:
             try:
-                # Get all birthdays for this user
-                birthdays = GlobalBirthday.objects.filter(added_by=user.user_id)
-                if not birthdays:
-                    continue
-
-                for birthday in birthdays:
-                    next_birthday = birthday.get_next_birthday()
-                    days_until = (next_birthday - today).days
-                    
-                    # Always send birthday message on the exact date
-                    if days_until == 0:
-                        message = self.format_reminder_message(birthday, days_until)
-                        # No keyboard on birthday message - it's a pure celebration!
-                        bot.send_message(user.user_id, message, None)
-                        birthday_messages_sent += 1
-                        continue  # Skip reminder logic on birthday
-                    
-                    # Handle reminders for upcoming birthdays
-                    reminder_days = birthday.reminder_days or user.reminder_days
-
-                    # Check if reminder should be sent
-                    should_send = (
-                        days_until <= reminder_days and  # Within reminder window
-                        days_until > 0 and  # Not today (handled above)
-                        (not birthday.snoozed_until or birthday.snoozed_until <= today) and  # Not snoozed
-                        (not birthday.last_reminder_sent or  # Never sent before
-                         birthday.last_reminder_sent < next_birthday - timedelta(days=reminder_days))  # Not sent for this occurrence
-                    )
-
-                    if should_send:
-                        # Format and send the reminder
-                        message = self.format_reminder_message(birthday, days_until)
-                        keyboard = self.create_reminder_keyboard(bot, birthday)
-                        bot.send_message(user.user_id, message, keyboard)
-
-                        # Update last reminder sent date
-                        birthday.last_reminder_sent = today
-                        birthday.save()
-                        reminders_sent += 1
-
+                message = self.format_reminder_message(item.birthday, item.days_until, plan.today)
+                if item.kind == reminders.BIRTHDAY:
+                    # No keyboard on birthday message - it's a pure celebration!
+                    sender.send(item.user_id, message, None)
+                else:
+                    keyboard = self.create_reminder_keyboard(bot, item.birthday, item.days_until)
+                    if sender.send(item.user_id, message, keyboard):
+                        sent_reminders.append(item)
             except Exception as e:
-                logger.error(f"Error sending automatic reminder to user {user.user_id}: {e}")
+                logger.error(f"Error sending automatic reminder to user {item.user_id}: {e}")
                 continue
 
+        # Update last reminder sent date of all sent reminders at once
+        reminders.record_sent(sent_reminders, plan.today)
+        # The failed sends are counted by the bot, the totals are counted again once a day
+        birthday_stats.add(reminders_sent=sender.sent + sender.deferred)
+        birthday_stats.snapshot()
+
         self.stdout.write(
             self.style.SUCCESS(
-                f'Automatic job completed. Sent {birthday_messages_sent} birthday messages and {reminders_sent} reminders.'
+                f'Automatic job completed. Sent {sender.sent + sender.deferred - len(sent_reminders)} birthday messages '
+                f'and {len(sent_reminders)} reminders ({sender.deferred} deferred by the rate limits), '
+                f'{sender.failed} failed.'
             )
         )
+        transport.log_metrics()
+        rate_limit.log_counters(bot.token, bot.__class__.__name__)
 
     def send_manual_reminder(self, bot, user_id):
         """Send a manual test reminder for the next birthday."""
@@ -152,9 +143,9 @@ class Command(BaseCommand):
                 )
             )
 
-    def format_reminder_message(self, birthday, days_until):
+    def format_reminder_message(self, birthday, days_until, today=None):
         """Format the reminder message based on the type of notification."""
-        today = timezone.now().date()
+        today = today or timezone.now().date()
         
         # Birthday message (on the day)
         if days_until == 0:
@@ -200,16 +191,15 @@ class Command(BaseCommand):
         message += f"\nPersian date: {birthday.persian_birth_date}"
         
         # Add zodiac sign
-        zodiac = BirthdayBot().get_zodiac_sign(birthday.birth_date)
+        zodiac = self.bot.get_zodiac_sign(birthday.birth_date)
         message += f"\n{zodiac}"
 
         return message
 
-    def create_reminder_keyboard(self, bot, birthday):
+    def create_reminder_keyboard(self, bot, birthday, days_until=None):
         """Create the reminder keyboard with snooze buttons."""
-        today = timezone.now().date()
-        next_birthday = birthday.get_next_birthday()
-        days_until = (next_birthday - today).days
+        if days_until is None:
+            days_until = (birthday.get_next_birthday() - timezone.now().date()).days
         
         buttons = []
         snooze_options = []
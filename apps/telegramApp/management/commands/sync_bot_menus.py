@@ -0,0 +1,61 @@
+## Sets the command lists and menu buttons of the bots on Telegram (menu_commands / menu_button of the bot classes)
+## The bots do not do this on every update anymore. The hash of the menu which was set last is kept in the cache,
+## Telegram is called only for the bots whose menu (or token) changed since then. Run it after every deploy:
+## python manage.py sync_bot_menus
+## python manage.py sync_bot_menus --force      >> set all menus again
+## python manage.py sync_bot_menus --dry-run    >> only show which menus would be set
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from apps.telegramApp.views import BotFactory
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def menu_key(bot_class):
+    return f"telegram:menu:{bot_class.__name__}"
+
+
+def menu_hash(bot):
+    # The token is part of it, a new token (a new bot on Telegram) has no menu yet
+    content = json.dumps({'token': bot.token, 'menu': bot.menu_config()}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class Command(BaseCommand):
+    help = 'Sets the command lists and menu buttons of the Telegram bots which changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Set the menus even if they did not change')
+        parser.add_argument('--dry-run', action='store_true', help='Do not call Telegram')
+
+    def handle(self, *args, **options):
+        changed = failed = 0
+        for secret_token, bot_class in BotFactory.BOT_CLASSES.items():
+            if not bot_class.menu_commands and not bot_class.menu_button:
+                continue
+            try:
+                bot = BotFactory.create_bot(secret_token)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'{bot_class.__name__}: {e}')
+                continue
+            digest = menu_hash(bot)
+            if not options['force'] and cache.get(menu_key(bot_class)) == digest:
+                self.stdout.write(f'{bot_class.__name__}: up to date')
+                continue
+            changed += 1
+            if options['dry_run']:
+                self.stdout.write(f'{bot_class.__name__}: would be set')
+                continue
+            if bot.setup_bot_menu():
+                cache.set(menu_key(bot_class), digest, None)
+                self.stdout.write(f'{bot_class.__name__}: set')
+            else:
+                # Not remembered, the next run tries again
+                failed += 1
+                self.stderr.write(f'{bot_class.__name__}: Telegram did not accept the menu')
+        self.stdout.write(self.style.SUCCESS(f'{changed} menus changed, {failed} failed'))
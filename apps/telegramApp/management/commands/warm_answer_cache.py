@@ -0,0 +1,63 @@
+## Asks OpenAI again for the most frequent questions of the DictionaryBot and the PhraseBot before their cached
+## answers expire (apps/telegramApp/answer_cache.py), so that they never wait for OpenAI.
+## The questions of --file (one per line) are asked when they have no answer yet, e.g. the common words at the start.
+## python manage.py warm_answer_cache
+## python manage.py warm_answer_cache --bot dictionary --file common_words.txt
+## python manage.py warm_answer_cache --dry-run      >> only show which questions would be asked
+
+from django.core.management.base import BaseCommand, CommandError
+from apps.telegramApp import answer_cache
+from apps.telegramApp.bots import dictionary_bot, phrase_bot
+from apps.telegramApp.views import BotFactory
+from datetime import timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+# answer_cache name >> (secret_token of the bot, module with its MODEL and PROMPT_VERSION)
+BOTS = {
+    'dictionary': ('Dictionary', dictionary_bot),
+    'phrase': ('Phrase', phrase_bot),
+}
+
+
+class Command(BaseCommand):
+    help = 'Asks OpenAI again for the most frequent cached questions of the dictionary and phrase bots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bot', choices=list(BOTS), help='Only this bot (both by default)')
+        parser.add_argument('--limit', type=int, default=50, help='Most frequent questions per bot')
+        parser.add_argument('--days', type=float, default=2,
+                            help='Questions whose answers expire within this many days')
+        parser.add_argument('--file', help='More questions, one per line')
+        parser.add_argument('--dry-run', action='store_true', help='Do not call OpenAI')
+
+    def handle(self, *args, **options):
+        if options['file'] and not options['bot']:
+            raise CommandError('--file needs --bot')
+        within = timedelta(days=options['days'])
+        asked = failed = 0
+        for name in [options['bot']] if options['bot'] else list(BOTS):
+            secret_token, module = BOTS[name]
+            questions = answer_cache.frequent(name, module.MODEL, module.PROMPT_VERSION, options['limit'], within)
+            if options['file']:
+                with open(options['file'], encoding='utf-8') as lines:
+                    questions += [line.strip() for line in lines if line.strip() and answer_cache.expires_within(
+                        name, line.strip(), module.MODEL, module.PROMPT_VERSION, within)]
+            if options['dry_run']:
+                for question in questions:
+                    self.stdout.write(f"{name}: {question}")
+                continue
+
+            bot = BotFactory.get_bot(secret_token)
+            for question in dict.fromkeys(questions):
+                try:
+                    answer = bot._ask_openai(question)
+                except Exception as e:
+                    logger.error(f"Could not warm the {name} answer of '{question}': {e}")
+                    failed += 1
+                    continue
+                if answer:
+                    answer_cache.store(name, question, module.MODEL, module.PROMPT_VERSION, answer)
+                    asked += 1
+        self.stdout.write(self.style.SUCCESS(f'{asked} answers warmed, {failed} failed'))
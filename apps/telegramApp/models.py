@@ -1,8 +1,12 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Mod
 from django.utils import timezone
+import calendar
 import jdatetime
 import re
 from datetime import datetime, date, timedelta
+from typing import Optional
 
 # Create your models here.
 
@@ -13,9 +17,43 @@ class TelegramAdmin(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from . import state_store
+        state_store.forget_admins()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        from . import state_store
+        state_store.forget_admins()
+        return result
+
     def __str__(self):
         return f"Admin: {self.user_name}"
 
+# Day of year of a month/day in a leap year, so every birthday has one (29 February is 60, 1 March is 61)
+CALENDAR_YEAR = 2000
+
+# (sign, last month, last day) in the order of the year, Capricorn also takes the end of December
+ZODIAC_SIGNS = [
+    ("♑️ Capricorn", 1, 19), ("♒️ Aquarius", 2, 18), ("♓️ Pisces", 3, 20), ("♈️ Aries", 4, 19),
+    ("♉️ Taurus", 5, 20), ("♊️ Gemini", 6, 20), ("♋️ Cancer", 7, 22), ("♌️ Leo", 8, 22),
+    ("♍️ Virgo", 9, 22), ("♎️ Libra", 10, 22), ("♏️ Scorpio", 11, 21), ("♐️ Sagittarius", 12, 21),
+    ("♑️ Capricorn", 12, 31),
+]
+
+
+def day_of_year(month: int, day: int) -> int:
+    return date(CALENDAR_YEAR, month, day).timetuple().tm_yday
+
+
+def zodiac_sign(month: int, day: int) -> str:
+    for sign, last_month, last_day in ZODIAC_SIGNS:
+        if (month, day) <= (last_month, last_day):
+            return sign
+    return ZODIAC_SIGNS[-1][0]
+
+
 class GlobalBirthday(models.Model):
     """Birthday entries that are private to each user"""
     name = models.CharField(max_length=255)  # Person's name
@@ -26,12 +64,26 @@ class GlobalBirthday(models.Model):
     reminder_days = models.IntegerField(null=True, blank=True)  # Days before birthday to send reminder (null means use default)
     snoozed_until = models.DateField(null=True, blank=True)  # Date until which the reminder is snoozed
     last_reminder_sent = models.DateField(null=True, blank=True)  # Track when the last reminder was sent
+    # Parts of birth_date for the sorting and filtering in SQL, set on save (backfill_birthday_calendar for old rows)
+    birth_month = models.SmallIntegerField(null=True, blank=True)
+    birth_day = models.SmallIntegerField(null=True, blank=True)
+    day_of_year = models.SmallIntegerField(null=True, blank=True)  # 1 - 366, see day_of_year()
+    persian_month = models.SmallIntegerField(null=True, blank=True)
+    persian_day = models.SmallIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Fields which fill_calendar_fields() sets
+    CALENDAR_FIELDS = ['persian_birth_date', 'birth_month', 'birth_day', 'day_of_year', 'persian_month', 'persian_day']
+
     class Meta:
         # Ensure uniqueness based on name, date and added_by combination
         unique_together = ['name', 'birth_date', 'added_by']
+        # The reminder plan of all users (reminders.py), the lists of a user: next birthdays, Gregorian and Persian months
+        indexes = [models.Index(fields=['day_of_year']),
+                   models.Index(fields=['added_by', 'day_of_year']),
+                   models.Index(fields=['added_by', 'birth_month', 'day_of_year']),
+                   models.Index(fields=['added_by', 'persian_month', 'day_of_year'])]
 
     @staticmethod
     def is_persian_date(date_str: str) -> bool:
@@ -76,25 +128,63 @@ class GlobalBirthday(models.Model):
         # If birth_date is a string, parse it first
         if isinstance(self.birth_date, str):
             self.birth_date, self.persian_birth_date = self.parse_date(self.birth_date)
-        # If birth_date is already a date object, just update persian_birth_date
-        elif self.birth_date and not self.persian_birth_date:
-            persian_date = jdatetime.date.fromgregorian(date=self.birth_date)
-            self.persian_birth_date = persian_date.strftime('%Y/%m/%d')
+        self.fill_calendar_fields()
+        adding = self._state.adding
         super().save(*args, **kwargs)
+        # The cached report of the user is worked out again
+        from . import birthday_report, birthday_stats
+        birthday_report.forget(self.added_by)
+        if adding:
+            birthday_stats.add(birthdays=1)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        from . import birthday_report, birthday_stats
+        birthday_report.forget(self.added_by)
+        birthday_stats.add(birthdays=-1)
+        return result
+
+    def fill_calendar_fields(self):
+        """Set the Persian date and the month/day columns from birth_date."""
+        if not self.birth_date:
+            return
+        persian_date = jdatetime.date.fromgregorian(date=self.birth_date)
+        self.persian_birth_date = persian_date.strftime('%Y/%m/%d')
+        self.birth_month = self.birth_date.month
+        self.birth_day = self.birth_date.day
+        self.day_of_year = day_of_year(self.birth_date.month, self.birth_date.day)
+        self.persian_month = persian_date.month
+        self.persian_day = persian_date.day
 
     def get_persian_date(self):
         """Get Persian date string"""
         return self.persian_birth_date
 
-    def get_next_birthday(self) -> date:
-        """Calculate the next occurrence of this birthday."""
-        today = timezone.now().date()
-        birthday_this_year = date(today.year, self.birth_date.month, self.birth_date.day)
-        
+    @staticmethod
+    def occurrence(birth_date: date, year: int) -> date:
+        """The birthday in a year, a 29 February birthday is on 28 February in the other years."""
+        if birth_date.month == 2 and birth_date.day == 29 and not calendar.isleap(year):
+            return date(year, 2, 28)
+        return date(year, birth_date.month, birth_date.day)
+
+    @classmethod
+    def next_occurrence(cls, birth_date: date, today: date) -> date:
+        """The first birthday on or after today."""
+        birthday_this_year = cls.occurrence(birth_date, today.year)
         if birthday_this_year >= today:
             return birthday_this_year
-        else:
-            return date(today.year + 1, self.birth_date.month, self.birth_date.day)
+        return cls.occurrence(birth_date, today.year + 1)
+
+    @staticmethod
+    def order_by_next(queryset, today: Optional[date] = None):
+        """The birthdays of the queryset with days_away, the next one first (sorted by the database)."""
+        today = today or timezone.now().date()
+        offset = 366 - day_of_year(today.month, today.day)
+        return queryset.annotate(days_away=Mod(F('day_of_year') + offset, 366)).order_by('days_away', 'pk')
+
+    def get_next_birthday(self) -> date:
+        """Calculate the next occurrence of this birthday."""
+        return self.next_occurrence(self.birth_date, timezone.now().date())
 
     def get_age(self):
         today = timezone.now().date()
@@ -117,16 +207,176 @@ class UserBirthdaySettings(models.Model):
     class Meta:
         unique_together = ['user_id', 'birthday']  # Each user can only have one setting per birthday
 
+    def save(self, *args, **kwargs):
+        new_user = self._state.adding and not UserBirthdaySettings.objects.filter(user_id=self.user_id).exists()
+        super().save(*args, **kwargs)
+        if new_user:
+            from . import birthday_stats
+            birthday_stats.add(users=1)
+
     def __str__(self):
         return f"Settings for {self.user_name}"
 
+class BirthdayBotDailyStats(models.Model):
+    """Daily figures of the BirthdayBot for the admin statistics, kept up to date by birthday_stats.py"""
+    day = models.DateField(unique=True)
+    users = models.IntegerField(default=0)  # Users with settings at the end of the day
+    birthdays = models.IntegerField(default=0)  # Stored birthdays at the end of the day
+    active_users = models.IntegerField(default=0)  # Users who used the bot on the day
+    reminders_sent = models.IntegerField(default=0)  # Reminders and birthday messages of the reminder job
+    messages_failed = models.IntegerField(default=0)  # Sends which Telegram refused or which did not go out
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Birthday bot on {self.day}: {self.users} users, {self.birthdays} birthdays"
+
 class UserState(models.Model):
-    """Track user conversation state for multi-step interactions"""
-    user_id = models.CharField(max_length=100, unique=True)  # Telegram user ID
+    """Track user conversation state for multi-step interactions (read and written through state_store.py)"""
+    bot = models.CharField(max_length=30, default='')  # Each bot has its own state of a user
+    user_id = models.CharField(max_length=100)  # Telegram user ID
     state = models.CharField(max_length=50)  # Current state in conversation
     context = models.JSONField(default=dict)  # Store any context needed for the state
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        unique_together = ['bot', 'user_id']
+        # The sweeper deletes the abandoned states by their age
+        indexes = [models.Index(fields=['updated_at'])]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Write-through: the cached state is the saved one
+        from . import state_store
+        state_store.remember(self)
+
+    def delete(self, *args, **kwargs):
+        from . import state_store
+        state_store.forget(self.bot, self.user_id)
+        return super().delete(*args, **kwargs)
+
     def __str__(self):
         return f"State for {self.user_id}: {self.state}"
+
+class TelegramUpdate(models.Model):
+    """Webhook updates waiting for the worker (TELEGRAM_WEBHOOK_MODE = 'queue', see update_queue.py)"""
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (PROCESSING, 'Processing'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    secret_token = models.CharField(max_length=50, blank=True)  # Which bot received the update
+    update_id = models.BigIntegerField()  # Telegram's id, increases with every update of a bot
+    chat_id = models.CharField(max_length=100)  # Updates of the same chat are processed in order
+    payload = models.JSONField()  # The update as Telegram sent it
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)  # Not processed before this time (retry backoff)
+    locked_by = models.CharField(max_length=32, blank=True)  # Claim of the worker which processes it
+    locked_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)  # Last error
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # Telegram sends an update again when the webhook did not answer in time
+        unique_together = ['secret_token', 'update_id']
+        indexes = [models.Index(fields=['status', 'available_at']),
+                   models.Index(fields=['secret_token', 'chat_id', 'update_id'])]
+
+    def __str__(self):
+        return f"Update {self.update_id} of {self.secret_token or 'Dictionary'} ({self.status})"
+
+
+class TelegramOutbox(models.Model):
+    """Sends which Telegram rate limited, sent again later by outbox.flush() (see bots/rate_limit.py)"""
+    bot = models.CharField(max_length=50)  # Class name of the bot which sends it
+    chat_id = models.CharField(max_length=100, blank=True)
+    method = models.CharField(max_length=50)  # Bot API method, e.g. sendMessage
+    payload = models.JSONField()  # The data of the call
+    attempts = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)  # Not sent before this time (retry_after)
+    error = models.TextField(blank=True)  # Last answer of Telegram
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['available_at'])]
+
+    def __str__(self):
+        return f"{self.method} of {self.bot} to {self.chat_id}"
+
+
+class VoiceTranscriptionJob(models.Model):
+    """Voice messages transcribed in the background by the VoiceTranscriptionBot (see transcription_jobs.py)"""
+    QUEUED = 'queued'
+    DOWNLOADING = 'downloading'
+    TRANSCRIBING = 'transcribing'
+    TRANSLATING = 'translating'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (DOWNLOADING, 'Downloading'), (TRANSCRIBING, 'Transcribing'),
+                      (TRANSLATING, 'Translating'), (DONE, 'Done'), (FAILED, 'Failed'), (CANCELLED, 'Cancelled')]
+    # The job is not finished in these
+    ACTIVE = [QUEUED, DOWNLOADING, TRANSCRIBING, TRANSLATING]
+
+    chat_id = models.CharField(max_length=100)
+    user_id = models.CharField(max_length=100, blank=True)
+    file_id = models.CharField(max_length=255)
+    file_unique_id = models.CharField(max_length=100, blank=True)  # The same for a forwarded voice message
+    duration = models.IntegerField(default=0)  # Seconds of the voice message
+    message_id = models.BigIntegerField(null=True, blank=True)  # The progress message which the job edits
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    transcription = models.TextField(blank=True)
+    translation = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)  # Last change of the status, a stale job is started again
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'updated_at']), models.Index(fields=['chat_id', 'status'])]
+
+    def __str__(self):
+        return f"Voice message of {self.chat_id} ({self.status})"
+
+
+class VoiceTranscript(models.Model):
+    """Transcriptions and translations of voice messages which were done before (see transcript_cache.py)"""
+    file_unique_id = models.CharField(max_length=100, unique=True)  # Telegram's id of the file, stable when forwarded
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 of the audio
+    model_version = models.CharField(max_length=200)  # The Whisper model which transcribed it
+    translation_model = models.CharField(max_length=100, blank=True)
+    transcription = models.TextField()
+    translation = models.TextField(blank=True)
+    duration = models.IntegerField(default=0)  # Seconds of the voice message
+    transcribe_seconds = models.FloatField(default=0)  # What a hit saves
+    translate_seconds = models.FloatField(default=0)
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)  # The least recently used are evicted
+
+    def __str__(self):
+        return f"Transcript of {self.file_unique_id} ({self.hits} hits)"
+
+
+class LLMAnswer(models.Model):
+    """OpenAI answers of the DictionaryBot and the PhraseBot, asked again only when they expired (answer_cache.py)"""
+    key = models.CharField(max_length=64, unique=True)  # SHA-256 of the bot, model, prompt version and question
+    bot = models.CharField(max_length=50)  # 'dictionary' or 'phrase'
+    question = models.TextField()  # Folded to lower case, the whitespace collapsed
+    model = models.CharField(max_length=100)
+    prompt_version = models.IntegerField(default=1)
+    answer = models.TextField()
+    hits = models.IntegerField(default=0)  # The most asked questions are warmed again before they expire
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)  # The least recently used are pruned
+
+    class Meta:
+        indexes = [models.Index(fields=['bot', 'hits'])]
+
+    def __str__(self):
+        return f"{self.bot} answer to '{self.question[:50]}' ({self.hits} hits)"
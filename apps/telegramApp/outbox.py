@@ -0,0 +1,124 @@
+## Outbox of the Telegram sends which could not go out at once (bots/rate_limit.py)
+## A send is put here instead of being dropped when Telegram answered 429, or when the rate limits had no token for
+## it. flush() sends the rows whose time came, from the queue worker (process_telegram_updates) and from cron
+## (cron.send_deferred_messages).
+## A row is claimed with a conditional UPDATE, two flushes at the same time do not send it twice.
+## The sends to a chat keep their order: while a chat has rows here its new sends are put behind them (pending()),
+## and flush() sends a row only after the earlier rows of its chat.
+
+from django.utils import timezone
+from datetime import timedelta
+from django.core.cache import cache
+from typing import Any, Dict, List, Optional, Tuple
+from .models import TelegramOutbox
+from .bots import rate_limit
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# A claimed row whose flush died is sent again after this
+LEASE = timedelta(minutes=5)
+# Seconds until the next try when Telegram did not say how long to wait (network errors, the own rate limits)
+RETRY_DELAY = 30
+# Seconds a chat is marked to have rows here, longer than a row waits for its tries
+PENDING_TIMEOUT = 24 * 60 * 60
+
+
+def pending_key(bot_name: str, chat_id) -> str:
+    return f"telegram:outbox:{bot_name}:{chat_id}"
+
+
+def pending(bot, chat_id) -> bool:
+    """Whether the chat has sends of the bot in the outbox, only chats marked by defer() are looked up."""
+    if chat_id is None or not cache.get(pending_key(bot.__class__.__name__, chat_id)):
+        return False
+    return TelegramOutbox.objects.filter(bot=bot.__class__.__name__, chat_id=str(chat_id)).exists()
+
+
+def forget_pending(bot_name: str, chat_id: str) -> None:
+    """Unmark a chat whose last row was sent, its sends go out directly again without a lookup."""
+    cache.delete(pending_key(bot_name, chat_id))
+    # A row which defer() added in the meantime marks the chat again, it sets the mark after its insert
+    if TelegramOutbox.objects.filter(bot=bot_name, chat_id=chat_id).exists():
+        cache.set(pending_key(bot_name, chat_id), True, PENDING_TIMEOUT)
+
+
+def defer(bot, method: str, data: Dict[str, Any], delay: float, error: str = '') -> Dict[str, Any]:
+    """Put a send of the bot into the outbox, it is sent in delay seconds. Returns the answer for the caller."""
+    TelegramOutbox.objects.create(bot=bot.__class__.__name__, chat_id=str(data.get('chat_id', '')), method=method,
+                                  payload=data, available_at=timezone.now() + timedelta(seconds=delay), error=error)
+    cache.set(pending_key(bot.__class__.__name__, data.get('chat_id', '')), True, PENDING_TIMEOUT)
+    rate_limit.count(bot.token, 'deferred')
+    logger.warning(f"{bot.__class__.__name__} {method} to {data.get('chat_id')} deferred for {delay:.0f}s")
+    return {'ok': False, 'deferred': True, 'description': f"Rate limited, sent again in {delay:.0f} seconds"}
+
+
+def bot_named(name: str):
+    """The bot of this process with the class name, None for an unknown name."""
+    from .views import BotFactory
+    for secret_token, bot_class in BotFactory.BOT_CLASSES.items():
+        if bot_class.__name__ == name:
+            return BotFactory.get_bot(secret_token)
+    return None
+
+
+def flush(limit: int = 100) -> Dict[str, int]:
+    """Send the rows of the outbox whose time came, returns the numbers of sent, deferred and dropped ones."""
+    counts = {'sent': 0, 'deferred': 0, 'dropped': 0}
+    now = timezone.now()
+    rows = list(TelegramOutbox.objects.filter(available_at__lte=now).order_by('pk')[:limit])
+    # The rows of the chats in the order of the sends, the first one of a chat is sent first
+    queued: Dict[Tuple[str, str], List[int]] = {}
+    for pk, bot_name, chat_id in TelegramOutbox.objects.filter(
+            bot__in={row.bot for row in rows}, chat_id__in={row.chat_id for row in rows}
+    ).order_by('pk').values_list('pk', 'bot', 'chat_id'):
+        queued.setdefault((bot_name, chat_id), []).append(pk)
+
+    for row in rows:
+        chat = queued.setdefault((row.bot, row.chat_id), [row.pk])
+        if chat[0] != row.pk:
+            # An earlier send to the chat is not due yet, or was not sent
+            continue
+        # The claim, another flush which read the same row skips it
+        if not TelegramOutbox.objects.filter(pk=row.pk, available_at=row.available_at).update(available_at=now + LEASE):
+            continue
+        bot = bot_named(row.bot)
+        if bot is None:
+            logger.error(f"Outbox row {row.pk} of unknown bot {row.bot} deleted")
+            row.delete()
+            chat.pop(0)
+            counts['dropped'] += 1
+            continue
+
+        row.attempts += 1
+        try:
+            result = bot.call(row.method, row.payload, defer=False)
+        except Exception as e:
+            result = {'ok': False, 'description': str(e), 'network_error': True}
+        if result.get('ok'):
+            row.delete()
+            chat.pop(0)
+            if not chat:
+                forget_pending(row.bot, row.chat_id)
+            counts['sent'] += 1
+            continue
+
+        retry_after: Optional[float] = result.get('parameters', {}).get('retry_after')
+        retry = retry_after or result.get('deferred') or result.get('network_error')
+        if not retry or row.attempts >= MAX_ATTEMPTS:
+            # Refused for another reason than the rate (e.g. the user blocked the bot), or too many tries
+            logger.error(f"Dropped {row.method} of {row.bot} to {row.chat_id} after {row.attempts} tries: {result}")
+            row.delete()
+            chat.pop(0)
+            if not chat:
+                forget_pending(row.bot, row.chat_id)
+            rate_limit.count(bot.token, 'dropped')
+            counts['dropped'] += 1
+            continue
+        row.available_at = timezone.now() + timedelta(seconds=retry_after or RETRY_DELAY)
+        row.error = str(result.get('description', ''))
+        row.save(update_fields=['attempts', 'available_at', 'error'])
+        cache.set(pending_key(row.bot, row.chat_id), True, PENDING_TIMEOUT)
+        counts['deferred'] += 1
+    return counts
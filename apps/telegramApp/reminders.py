@@ -0,0 +1,162 @@
+## Planner of the daily birthday reminders (send_birthday_reminder --auto, cron.py)
+## The plan of a date is worked out in a few queries, whatever the number of stored birthdays:
+## 1. the longest reminder window of all users and birthdays (at most MAX_REMINDER_DAYS),
+## 2. the birthdays whose day_of_year falls into that window from the date on (and are not snoozed),
+## 3. the default reminder days of their users.
+## The exact rules are applied to these rows only:
+## - on the birthday itself a birthday message is sent,
+## - before it a reminder is sent when it is within the reminder days of the birthday (or of its user), a longer
+##   setting of the days than MAX_REMINDER_DAYS (saved before the bot checked it) counts as MAX_REMINDER_DAYS,
+##   it is not snoozed, and no reminder was sent yet for this occurrence.
+## A 29 February birthday is on 28 February in the other years (GlobalBirthday.occurrence).
+##
+## plan = reminders.plan_reminders(today)     >> inspect plan.items, e.g. for --dry-run
+## RateLimitedSender sends the messages within the rate limits of the bot (bots/rate_limit.py), record_sent() saves
+## last_reminder_sent of the sent reminders in one query.
+
+from django.db.models import Max, Q
+from django.utils import timezone
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+from .models import GlobalBirthday, UserBirthdaySettings, day_of_year
+from .bots import rate_limit
+import calendar
+import logging
+
+logger = logging.getLogger(__name__)
+
+BIRTHDAY = 'birthday'
+REMINDER = 'reminder'
+# The longest reminder window, the birthdays of the whole year are never read for a plan
+MAX_REMINDER_DAYS = 60
+
+
+class ReminderItem():
+    # One message of the plan: a birthday message or a reminder to the user who added the birthday
+
+    def __init__(self, kind: str, birthday: GlobalBirthday, user_id: str, next_birthday: date, days_until: int):
+        self.kind = kind
+        self.birthday = birthday
+        self.user_id = user_id
+        self.next_birthday = next_birthday
+        self.days_until = days_until
+
+    def __repr__(self):
+        return f"<ReminderItem {self.kind} {self.birthday.name} to {self.user_id} in {self.days_until} days>"
+
+
+class ReminderPlan():
+    # The messages of one date, in the order of the users
+
+    def __init__(self, today: date, items: List[ReminderItem], scanned: int):
+        self.today = today
+        self.items = items
+        # Birthdays which were read from the database for the plan
+        self.scanned = scanned
+
+    @property
+    def birthday_messages(self) -> List[ReminderItem]:
+        return [item for item in self.items if item.kind == BIRTHDAY]
+
+    @property
+    def reminders(self) -> List[ReminderItem]:
+        return [item for item in self.items if item.kind == REMINDER]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def day_of_year_ranges(start: date, days: int) -> Q:
+    """A filter on the indexed day_of_year for the birthdays in the days from start on (start included)."""
+    end = start + timedelta(days=days)
+    first = day_of_year(start.month, start.day)
+    last = day_of_year(end.month, end.day)
+    # 29 February birthdays are on 28 February in the other years
+    if (end.month, end.day) == (2, 28) and not calendar.isleap(end.year):
+        last += 1
+    if end.year == start.year:
+        return Q(day_of_year__gte=first, day_of_year__lte=last)
+    # Across the new year
+    return Q(day_of_year__gte=first) | Q(day_of_year__lte=last)
+
+
+def plan_reminders(today: Optional[date] = None, user_id: Optional[str] = None) -> ReminderPlan:
+    """The birthday messages and reminders to send on a date, for all users or one user."""
+    today = today or timezone.now().date()
+    users = UserBirthdaySettings.objects.all()
+    birthdays = GlobalBirthday.objects.all()
+    if user_id:
+        users = users.filter(user_id=user_id)
+        birthdays = birthdays.filter(added_by=user_id)
+
+    window = min(max(users.aggregate(days=Max('reminder_days'))['days'] or 0,
+                     birthdays.aggregate(days=Max('reminder_days'))['days'] or 0), MAX_REMINDER_DAYS)
+    # Snoozed birthdays can still have their birthday message
+    candidates = list(birthdays.filter(day_of_year_ranges(today, window))
+                      .filter(Q(snoozed_until__isnull=True) | Q(snoozed_until__lte=today) | day_of_year_ranges(today, 0))
+                      .order_by('added_by', 'pk'))
+
+    # The first settings row of a user has its default reminder days, like UserBirthdaySettings.objects.get(...)
+    default_days: Dict[str, int] = {}
+    rows = users.filter(user_id__in={birthday.added_by for birthday in candidates}) \
+        .order_by('pk').values_list('user_id', 'reminder_days')
+    for owner, days in rows:
+        default_days.setdefault(owner, days)
+
+    items = []
+    for birthday in candidates:
+        if birthday.added_by not in default_days:
+            # Only users with settings get reminders
+            continue
+        next_birthday = GlobalBirthday.next_occurrence(birthday.birth_date, today)
+        days_until = (next_birthday - today).days
+        if days_until == 0:
+            items.append(ReminderItem(BIRTHDAY, birthday, birthday.added_by, next_birthday, days_until))
+            continue
+        reminder_days = min(birthday.reminder_days or default_days[birthday.added_by], MAX_REMINDER_DAYS)
+        if (days_until <= reminder_days and
+                (not birthday.snoozed_until or birthday.snoozed_until <= today) and
+                (not birthday.last_reminder_sent or
+                 birthday.last_reminder_sent < next_birthday - timedelta(days=reminder_days))):
+            items.append(ReminderItem(REMINDER, birthday, birthday.added_by, next_birthday, days_until))
+    return ReminderPlan(today, items, len(candidates))
+
+
+def record_sent(items: Iterable[ReminderItem], today: date) -> int:
+    """Save the date of the sent reminders in one query, returns the number of birthdays."""
+    birthdays = []
+    for item in items:
+        item.birthday.last_reminder_sent = today
+        birthdays.append(item.birthday)
+    if not birthdays:
+        return 0
+    GlobalBirthday.objects.bulk_update(birthdays, ['last_reminder_sent'], batch_size=500)
+    return len(birthdays)
+
+
+class RateLimitedSender():
+    # Sends the messages of a bot from cron, which may wait for the rate limits that all processes of the bot share
+    # (up to rate_limit.MAX_WAIT per message, a webhook request never waits)
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.sent = 0
+        # Rate limited by Telegram, in the outbox and sent a bit later
+        self.deferred = 0
+        self.failed = 0
+
+    def send(self, chat_id: str, text: str, reply_markup: Optional[Dict] = None) -> bool:
+        """Send a message, returns True when it was sent or will be sent from the outbox."""
+        result = self.bot.send_message(chat_id, text, reply_markup, max_wait=rate_limit.MAX_WAIT)
+        if result and result.get('ok'):
+            self.sent += 1
+            return True
+        if result and result.get('deferred'):
+            self.deferred += 1
+            return True
+        self.failed += 1
+        logger.error(f"Reminder to {chat_id} was not sent: {result}")
+        return False
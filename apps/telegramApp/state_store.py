@@ -0,0 +1,114 @@
+## Conversation states of the bot wizards and the admin list, in the cache in front of the database
+## Every state is written to the database (it survives a restart of the cache) and to the cache at the same time,
+## so the reads of a wizard step come from the cache only. A user without a state is cached as well.
+## The states of each bot are separate (UserState.bot), the birthday and dutching wizards of a user do not mix.
+## States which were not touched for STATE_TTL are abandoned: the cache forgets them by itself and sweep()
+## (cron.py) deletes their rows in one query.
+##
+## states = StateStore('birthday')
+## states.set(user_id, 'waiting_for_name', {'message_id': 1})
+## user_state = states.get(user_id)      >> a UserState, its save() and delete() keep the cache right
+## states.delete(user_id)
+## is_admin(user_id)
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from datetime import timedelta
+from typing import Any, Dict, Optional
+from .models import UserState, TelegramAdmin
+
+STATE_TTL = 60 * 60 * 24
+ADMINS_KEY = 'telegram:admins'
+# Cached for the users who have no state
+NO_STATE = 'none'
+
+
+def state_key(bot: str, user_id: str) -> str:
+    return f"telegram:state:{bot}:{user_id}"
+
+
+def remember(user_state: UserState) -> None:
+    cache.set(state_key(user_state.bot, user_state.user_id),
+              {'pk': user_state.pk, 'state': user_state.state, 'context': user_state.context,
+               'created_at': user_state.created_at, 'updated_at': user_state.updated_at}, STATE_TTL)
+
+
+def forget(bot: str, user_id: str) -> None:
+    cache.set(state_key(bot, user_id), NO_STATE, STATE_TTL)
+
+
+class StateStore():
+    # The states of the users in one bot
+
+    def __init__(self, bot: str):
+        self.bot = bot
+
+    def get(self, user_id: str) -> Optional[UserState]:
+        cached = cache.get(state_key(self.bot, user_id))
+        if cached == NO_STATE:
+            return None
+        if cached is not None:
+            user_state = UserState(id=cached['pk'], bot=self.bot, user_id=user_id, state=cached['state'],
+                                   context=cached['context'], created_at=cached['created_at'],
+                                   updated_at=cached['updated_at'])
+            # It is a row of the database, save() updates it
+            user_state._state.adding = False
+            return user_state
+        user_state = UserState.objects.filter(bot=self.bot, user_id=user_id).first()
+        if user_state is None:
+            forget(self.bot, user_id)
+        else:
+            remember(user_state)
+        return user_state
+
+    def set(self, user_id: str, state: str, context: Optional[Dict[str, Any]] = None) -> UserState:
+        """Start or change the state of a user, one UPDATE (or INSERT for a new state) and no reads."""
+        context = context or {}
+        now = timezone.now()
+        rows = UserState.objects.filter(bot=self.bot, user_id=user_id)
+        if rows.update(state=state, context=context, updated_at=now):
+            cached = cache.get(state_key(self.bot, user_id))
+            if isinstance(cached, dict):
+                cached.update(state=state, context=context, updated_at=now)
+                cache.set(state_key(self.bot, user_id), cached, STATE_TTL)
+                return self.get(user_id)
+            # The row was updated but it is not in the cache, read it once
+            cache.delete(state_key(self.bot, user_id))
+            return self.get(user_id)
+        try:
+            with transaction.atomic():
+                # save() puts it in the cache
+                return UserState.objects.create(bot=self.bot, user_id=user_id, state=state, context=context)
+        except IntegrityError:
+            # Created by a parallel update of the same user
+            rows.update(state=state, context=context, updated_at=now)
+            cache.delete(state_key(self.bot, user_id))
+            return self.get(user_id)
+
+    def delete(self, user_id: str) -> None:
+        UserState.objects.filter(bot=self.bot, user_id=user_id).delete()
+        forget(self.bot, user_id)
+
+
+def admin_ids() -> frozenset:
+    """The user ids of the admins, the admin list is read from the database only after it changed."""
+    admins = cache.get(ADMINS_KEY)
+    if admins is None:
+        admins = frozenset(TelegramAdmin.objects.values_list('user_id', flat=True))
+        cache.set(ADMINS_KEY, admins, None)
+    return admins
+
+
+def is_admin(user_id: str) -> bool:
+    return str(user_id) in admin_ids()
+
+
+def forget_admins() -> None:
+    cache.delete(ADMINS_KEY)
+
+
+def sweep(ttl: int = STATE_TTL) -> int:
+    """Delete the states which were not touched for ttl seconds, returns their number."""
+    deleted, _ = UserState.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+    return deleted
@@ -1,3 +1,1116 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from unittest import mock
+from apps.baseApp.tests import QueryBudgetTestCase, TEST_CACHES
+from .bots import dutching_solver, rate_limit, streaming, transport
+from .bots.dutching_bot import calculate_arbitrage, parse_markets, text_rows
+from . import answer_cache, birthday_report, birthday_stats, cron, outbox, reminders, state_store, transcript_cache, \
+    transcription_jobs
+from .views import BotFactory, process_update
+from .bots.birthday_bot import BirthdayBot
+from .models import GlobalBirthday, UserBirthdaySettings, TelegramAdmin, TelegramUpdate, UserState, \
+    TelegramOutbox, BirthdayBotDailyStats, VoiceTranscript, VoiceTranscriptionJob, LLMAnswer, zodiac_sign
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import date, timedelta
+import io
+import json
+import numpy as np
+import requests
 
 # Create your tests here.
+
+USER_ID = 1000
+ADMIN_ID = 2000
+
+
+def make_update(text=None, callback_data=None, user_id=USER_ID):
+    user = {'id': user_id, 'first_name': 'Test', 'username': 'test'}
+    message = {'message_id': 1, 'chat': {'id': user_id}, 'from': user, 'text': text or ''}
+    if callback_data:
+        return {'callback_query': {'id': '1', 'from': user, 'data': callback_data, 'message': message}}
+    return {'message': message}
+
+
+# Every Telegram API call of the bots returns this instead of going to the network
+def telegram_response(*args, **kwargs):
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {'ok': True, 'result': {'message_id': 1}}
+    return response
+
+
+@mock.patch('requests.Session.post', telegram_response)
+@override_settings(CACHES=TEST_CACHES)
+class TelegramWebhookQueryBudgetTest(QueryBudgetTestCase):
+    # {name: (bot secret token, update, budget)}, the first update of a user on a day counts them as active (1 query)
+    updates = {
+        'birthday start': ('Birthday', make_update('/start'), 2),
+        'birthday about': ('Birthday', make_update('/about'), 3),
+        'birthday report': ('Birthday', make_update(callback_data='birthday_report'), 3),
+        'birthday stats': ('Birthday', make_update(callback_data='view_stats', user_id=ADMIN_ID), 5),
+        'birthday users': ('Birthday', make_update(callback_data='view_users', user_id=ADMIN_ID), 3),
+        'dutching start': ('Dutching', make_update('/start'), 0),
+    }
+
+    def make_data(self):
+        # Ten users with three birthdays each and one admin
+        for user in range(10):
+            UserBirthdaySettings.objects.create(user_id=str(USER_ID + user), user_name='User {}'.format(user))
+            for day in range(1, 4):
+                GlobalBirthday.objects.create(name='Friend {}'.format(day), birth_date='1990-0{}-1{}'.format(day, user % 10),
+                                              added_by=str(USER_ID + user))
+        TelegramAdmin.objects.create(user_id=str(ADMIN_ID), user_name='Admin')
+        return {}
+
+    def get_budgets(self):
+        return {name: budget for name, (token, update, budget) in self.updates.items()}
+
+    def request(self, name):
+        token, update, budget = self.updates[name]
+        return self.client.post('/telegram/', json.dumps(update), content_type='application/json',
+                                HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN=token)
+
+
+@mock.patch('requests.Session.post', telegram_response)
+@override_settings(TELEGRAM_WEBHOOK_MODE='queue', CACHES=TEST_CACHES)
+class TelegramUpdateQueueTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def post(self, update_id, update, token='Birthday'):
+        return self.client.post('/telegram/', json.dumps(dict(update, update_id=update_id)),
+                                content_type='application/json', HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN=token)
+
+    def work(self):
+        call_command('process_telegram_updates', '--once', '--workers', '0', stdout=io.StringIO())
+
+    def test_webhook_only_saves_the_update(self):
+        with mock.patch('apps.telegramApp.views.process_update') as process_update:
+            response = self.post(1, make_update('/start'))
+            # Telegram sends the same update again when it did not get an answer in time
+            self.post(1, make_update('/start'))
+        self.assertEqual(response.status_code, 200)
+        process_update.assert_not_called()
+        update = TelegramUpdate.objects.get()
+        self.assertEqual((update.secret_token, update.chat_id, update.status), ('Birthday', str(USER_ID), 'pending'))
+
+        response = self.client.post('/telegram/', json.dumps({'message': {}}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_worker_keeps_the_order_of_a_chat(self):
+        self.post(3, make_update('/about'))
+        self.post(1, make_update('/start'))
+        self.post(2, make_update('/start', user_id=USER_ID + 1))
+        self.post(4, make_update(callback_data='birthday_report'))
+        processed = []
+        with mock.patch('apps.telegramApp.views.process_update',
+                        lambda token, data: processed.append(data['update_id'])):
+            self.work()
+        self.assertEqual(set(TelegramUpdate.objects.values_list('status', flat=True)), {'done'})
+        own_chat = [update_id for update_id in processed if update_id != 2]
+        self.assertEqual(own_chat, [1, 3, 4])
+
+    def test_worker_retries_with_backoff(self):
+        self.post(1, make_update('/start'))
+        self.post(2, make_update('/about'))
+        with mock.patch('apps.telegramApp.views.process_update', side_effect=RuntimeError('OpenAI is down')):
+            self.work()
+        first, second = TelegramUpdate.objects.order_by('update_id')
+        self.assertEqual((first.status, first.attempts), ('pending', 1))
+        self.assertGreater(first.available_at, first.created_at)
+        self.assertIn('OpenAI is down', first.error)
+        # The next update of the chat waits for the first one
+        self.assertEqual((second.status, second.attempts), ('pending', 0))
+
+        # The backoff is over, the real bots answer this time
+        TelegramUpdate.objects.update(available_at=first.created_at)
+        self.work()
+        self.assertEqual(list(TelegramUpdate.objects.order_by('update_id').values_list('status', 'attempts')),
+                         [('done', 2), ('done', 1)])
+
+    def test_failed_after_max_attempts(self):
+        self.post(1, make_update('/start'))
+        with mock.patch('apps.telegramApp.views.process_update', side_effect=RuntimeError('broken')):
+            call_command('process_telegram_updates', '--once', '--workers', '0', '--max-attempts', '1',
+                         stdout=io.StringIO())
+        self.assertEqual(TelegramUpdate.objects.get().status, 'failed')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TelegramTransportTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        transport.reset_metrics()
+
+    def answer(self, status_code, result):
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = result
+        return response
+
+    @mock.patch('apps.telegramApp.bots.transport.time.sleep')
+    def test_retries_and_metrics(self, sleep):
+        answers = [self.answer(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 3}}),
+                   self.answer(502, {'ok': False}),
+                   self.answer(200, {'ok': True, 'result': {'message_id': 1}})]
+        with mock.patch('requests.Session.post', side_effect=answers) as post:
+            result = transport.call('token', 'sendMessage', {'chat_id': 1, 'text': 'Hi'})
+        self.assertTrue(result['ok'])
+        self.assertEqual(post.call_count, 3)
+        # Telegram's retry_after, then the backoff of the 5xx
+        self.assertEqual(sleep.call_args_list[0], mock.call(3))
+        self.assertEqual(post.call_args.kwargs['timeout'], transport.TIMEOUT)
+        stats = transport.metrics()['sendMessage']
+        self.assertEqual((stats['calls'], stats['retries'], stats['errors']), (1, 2, 0))
+
+    @mock.patch('apps.telegramApp.bots.transport.time.sleep')
+    def test_answers_which_are_not_json(self, sleep):
+        page = mock.Mock(status_code=502, text='<html>502 Bad Gateway</html>')
+        page.json.side_effect = json.JSONDecodeError('Expecting value', '<html>', 0)
+        with mock.patch('requests.Session.post', return_value=page) as post:
+            result = transport.call('token', 'sendMessage', {'chat_id': 1, 'text': 'Hi'})
+        self.assertEqual(post.call_count, transport.MAX_TRIES)
+        self.assertEqual(result, {'ok': False, 'error_code': 502, 'description': 'HTTP 502: <html>502 Bad Gateway</html>'})
+        self.assertEqual(transport.metrics()['sendMessage']['errors'], 1)
+        # A 429 without a JSON body waits a second
+        page.status_code = 429
+        with mock.patch('requests.Session.post', return_value=page):
+            self.assertEqual(transport.call('token', 'sendMessage', {'chat_id': 1})['error_code'], 429)
+        self.assertEqual(sleep.call_args, mock.call(1))
+
+    @mock.patch('apps.telegramApp.bots.transport.time.sleep')
+    def test_one_session_per_token(self, sleep):
+        self.assertIs(transport.get_session('token'), transport.get_session('token'))
+        self.assertIsNot(transport.get_session('token'), transport.get_session('other'))
+        with mock.patch('requests.Session.post', side_effect=requests.ConnectionError('down')) as post:
+            with self.assertRaises(requests.ConnectionError):
+                transport.call('token', 'getFile', {'file_id': 'x'})
+        self.assertEqual(post.call_count, transport.MAX_TRIES)
+        self.assertEqual(transport.metrics()['getFile']['errors'], 1)
+
+
+@override_settings(CACHES=TEST_CACHES, TELEGRAM_RATE_LIMITS={'global': (3, 60), 'chat': (2, 60)})
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bot = BotFactory.get_bot('Birthday')
+
+    def answer(self, status_code, result):
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = result
+        return response
+
+    def test_sends_over_the_limits_are_deferred(self):
+        # In the middle of a 60 second window, a new window would fill the buckets again
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post, \
+                mock.patch('apps.telegramApp.bots.rate_limit.time.time', return_value=1_700_000_010.0):
+            for chat_id in [1, 1, 1, 2, 3]:
+                self.bot.send_message(chat_id, 'Hi')
+        # The third message to chat 1 and the message to chat 3 (over the bot's limit) wait in the outbox
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(sorted(TelegramOutbox.objects.values_list('chat_id', flat=True)), ['1', '3'])
+        self.assertEqual(rate_limit.counters(self.bot.token), {'throttled': 0, 'deferred': 2, 'dropped': 0})
+
+        # Not due yet
+        self.assertEqual(outbox.flush(), {'sent': 0, 'deferred': 0, 'dropped': 0})
+        TelegramOutbox.objects.update(available_at=timezone.now())
+        cache.clear()
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            self.assertEqual(outbox.flush(), {'sent': 2, 'deferred': 0, 'dropped': 0})
+        self.assertEqual(post.call_args.kwargs['json']['text'], 'Hi')
+        self.assertFalse(TelegramOutbox.objects.exists())
+
+    def test_telegram_429_pauses_the_bot(self):
+        answer = self.answer(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                   'parameters': {'retry_after': 120}})
+        with mock.patch('requests.Session.post', return_value=answer) as post:
+            result = self.bot.send_message(1, 'Hi')
+            self.assertTrue(result['deferred'])
+            # The other sends do not try Telegram during the pause
+            self.bot.send_message(2, 'Hi')
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(TelegramOutbox.objects.count(), 2)
+        self.assertGreater(TelegramOutbox.objects.get(chat_id='1').available_at,
+                           timezone.now() + timezone.timedelta(seconds=100))
+
+        # Still rate limited when it is due, it waits again
+        TelegramOutbox.objects.update(available_at=timezone.now())
+        cache.clear()
+        with mock.patch('requests.Session.post', return_value=answer):
+            self.assertEqual(outbox.flush(), {'sent': 0, 'deferred': 2, 'dropped': 0})
+        self.assertEqual(set(TelegramOutbox.objects.values_list('attempts', flat=True)), {1})
+
+    @override_settings(TELEGRAM_RATE_LIMITS={'chat': (20, 60)})
+    @mock.patch('apps.telegramApp.bots.transport.time.sleep')
+    def test_sends_of_a_chat_stay_in_order(self, sleep):
+        limited = self.answer(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                    'parameters': {'retry_after': 5}})
+        with mock.patch('requests.Session.post', return_value=limited) as post:
+            self.assertTrue(self.bot.send_message(1, 'First')['deferred'])
+        # The send does not wait for the retry_after in the request
+        self.assertEqual(post.call_count, 1)
+        sleep.assert_not_called()
+
+        cache.delete(f"telegram:rate:{rate_limit.bot_key(self.bot.token)}:paused")
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            self.assertTrue(self.bot.send_message(1, 'Second')['deferred'])
+            self.assertTrue(self.bot.send_message(2, 'Other chat')['ok'])
+        self.assertEqual([call.kwargs['json']['text'] for call in post.call_args_list], ['Other chat'])
+
+        # The second message is not sent while the first one is still rate limited
+        TelegramOutbox.objects.update(available_at=timezone.now())
+        with mock.patch('requests.Session.post', return_value=limited) as post:
+            self.assertEqual(outbox.flush(), {'sent': 0, 'deferred': 1, 'dropped': 0})
+        self.assertEqual(post.call_args.kwargs['json']['text'], 'First')
+        TelegramOutbox.objects.update(available_at=timezone.now())
+        cache.delete(f"telegram:rate:{rate_limit.bot_key(self.bot.token)}:paused")
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            self.assertEqual(outbox.flush(), {'sent': 2, 'deferred': 0, 'dropped': 0})
+            self.assertEqual([call.kwargs['json']['text'] for call in post.call_args_list], ['First', 'Second'])
+            # Sent at once again when the outbox has nothing of the chat
+            self.assertTrue(self.bot.send_message(1, 'Third')['ok'])
+
+    def test_a_send_takes_one_token_of_the_chat(self):
+        # The bot's bucket is empty once, the send waits for it with the token of the chat which it has
+        with mock.patch('apps.telegramApp.bots.rate_limit.take', side_effect=[0, 0.2, 0]) as take, \
+                mock.patch('apps.telegramApp.bots.rate_limit.time.sleep') as sleep:
+            self.assertEqual(rate_limit.acquire(self.bot.token, 1), 0.2)
+        self.assertEqual([call.args[0].split(':', 3)[-1] for call in take.call_args_list],
+                         ['chat:1', 'global', 'global'])
+        sleep.assert_called_once_with(0.2)
+        self.assertEqual(rate_limit.counters(self.bot.token)['throttled'], 1)
+
+    def test_the_mark_of_a_chat_goes_with_its_last_row(self):
+        with mock.patch('requests.Session.post', side_effect=telegram_response):
+            for chat_id in [1, 1, 1]:
+                self.bot.send_message(chat_id, 'Hi')
+        self.assertTrue(cache.get(outbox.pending_key('BirthdayBot', 1)))
+        TelegramOutbox.objects.update(available_at=timezone.now())
+        with mock.patch('requests.Session.post', side_effect=telegram_response), \
+                override_settings(TELEGRAM_RATE_LIMITS={'chat': (20, 60)}):
+            self.assertEqual(outbox.flush()['sent'], 1)
+        self.assertIsNone(cache.get(outbox.pending_key('BirthdayBot', 1)))
+        # No lookup of the outbox for the next sends to the chat
+        with self.assertNumQueries(0):
+            self.assertFalse(outbox.pending(self.bot, 1))
+
+    def test_refused_sends_are_dropped(self):
+        answer = self.answer(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'})
+        with mock.patch('requests.Session.post', return_value=answer):
+            self.bot.send_message(1, 'Hi')
+        self.assertFalse(TelegramOutbox.objects.exists())
+        self.assertEqual(rate_limit.counters(self.bot.token)['dropped'], 1)
+
+    @override_settings(TELEGRAM_RATE_LIMITS={'chat': (1, 0.2)})
+    def test_short_waits_are_throttled(self):
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            self.bot.send_message(1, 'Hi')
+            # A send in a request does not wait for a token
+            with mock.patch('apps.telegramApp.bots.rate_limit.time.sleep') as sleep:
+                self.assertTrue(self.bot.send_message(1, 'Hi')['deferred'])
+            sleep.assert_not_called()
+            # Cron may wait
+            self.bot.send_message(2, 'Hi')
+            self.bot.send_message(2, 'Hi', max_wait=rate_limit.MAX_WAIT)
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(rate_limit.counters(self.bot.token), {'throttled': 1, 'deferred': 1, 'dropped': 0})
+        # A full bucket is filled again in the next window
+        self.assertEqual(rate_limit.take('telegram:rate:test', 1, 60, 0), 0)
+        self.assertEqual(rate_limit.take('telegram:rate:test', 1, 60, 30), 30)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BotRegistryTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_one_bot_per_process(self):
+        self.assertIs(BotFactory.get_bot('Birthday'), BotFactory.get_bot('Birthday'))
+        # Unknown tokens share the DictionaryBot
+        self.assertIs(BotFactory.get_bot('Unknown'), BotFactory.get_bot('Dictionary'))
+
+    def test_webhook_does_not_set_the_menu(self):
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            self.client.post('/telegram/', json.dumps(make_update('/about')), content_type='application/json',
+                             HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN='Birthday')
+        methods = [call.args[0].rsplit('/', 1)[-1] for call in post.call_args_list]
+        self.assertNotIn('setMyCommands', methods)
+        self.assertNotIn('setChatMenuButton', methods)
+
+    def test_sync_only_when_changed(self):
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            call_command('sync_bot_menus', stdout=io.StringIO())
+            self.assertEqual(post.call_count, 2)
+            call_command('sync_bot_menus', stdout=io.StringIO())
+            self.assertEqual(post.call_count, 2)
+            with mock.patch.object(BotFactory.BOT_CLASSES['Birthday'], 'menu_button', {'type': 'default'}):
+                call_command('sync_bot_menus', stdout=io.StringIO())
+            self.assertEqual(post.call_count, 4)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ReminderPlanTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        UserBirthdaySettings.objects.create(user_id='1', user_name='One', reminder_days=3)
+        UserBirthdaySettings.objects.create(user_id='2', user_name='Two', reminder_days=1)
+
+    def add(self, name, birth_date, user='1', **fields):
+        return GlobalBirthday.objects.create(name=name, birth_date=birth_date, added_by=user, **fields)
+
+    def plan(self, today, **kwargs):
+        return {(item.kind, item.birthday.name, item.days_until) for item in reminders.plan_reminders(today, **kwargs)}
+
+    def test_rules(self):
+        self.add('Today', '1990-03-10')
+        self.add('Soon', '1985-03-12')
+        self.add('Too far', '1985-03-20')
+        self.add('Override', '1985-03-20', reminder_days=10)
+        self.add('Snoozed', '1985-03-11', snoozed_until=date(2023, 3, 11))
+        self.add('Already sent', '1985-03-13', last_reminder_sent=date(2023, 3, 10))
+        self.add('Sent last year', '1985-03-13', last_reminder_sent=date(2022, 3, 10))
+        self.add('Other user', '1985-03-12', user='2')
+        self.add('No settings', '1985-03-10', user='3')
+        self.assertEqual(self.plan(date(2023, 3, 10)), {('birthday', 'Today', 0), ('reminder', 'Soon', 2),
+                                                        ('reminder', 'Override', 10),
+                                                        ('reminder', 'Sent last year', 3)})
+        self.assertEqual(self.plan(date(2023, 3, 11), user_id='2'), {('reminder', 'Other user', 1)})
+
+    def test_february_29(self):
+        self.add('Leap', '2000-02-29')
+        # On 28 February in the other years, and across the new year
+        self.assertEqual(self.plan(date(2023, 2, 28)), {('birthday', 'Leap', 0)})
+        self.assertEqual(self.plan(date(2023, 2, 26)), {('reminder', 'Leap', 2)})
+        self.assertEqual(self.plan(date(2024, 2, 28)), {('reminder', 'Leap', 1)})
+        self.assertEqual(self.plan(date(2024, 2, 29)), {('birthday', 'Leap', 0)})
+        self.add('New year', '1990-01-01')
+        self.assertEqual(self.plan(date(2023, 12, 30)), {('reminder', 'New year', 2)})
+
+    def test_window_is_capped(self):
+        UserBirthdaySettings.objects.filter(user_id='1').update(reminder_days=1000)
+        self.add('In two months', '1990-02-28')
+        self.add('In three months', '1990-03-30')
+        self.add('Tomorrow', '1990-01-01')
+        plan = reminders.plan_reminders(date(2022, 12, 31))
+        self.assertEqual({(item.birthday.name, item.days_until) for item in plan},
+                         {('Tomorrow', 1), ('In two months', 59)})
+        self.assertEqual(plan.scanned, 2)
+        self.assertEqual(str(reminders.day_of_year_ranges(date(2022, 12, 31), 59)),
+                         "(OR: ('day_of_year__gte', 366), ('day_of_year__lte', 60))")
+
+    def test_few_queries_and_bulk_update(self):
+        for day in range(1, 29):
+            self.add('Friend {}'.format(day), '1990-05-{:02d}'.format(day))
+        with self.assertNumQueries(4):
+            plan = reminders.plan_reminders(date(2023, 5, 10))
+        # Only the birthdays in the reminder window are read
+        self.assertEqual(plan.scanned, 4)
+        with self.assertNumQueries(1):
+            reminders.record_sent(plan.reminders, plan.today)
+        self.assertEqual(GlobalBirthday.objects.filter(last_reminder_sent=date(2023, 5, 10)).count(), 3)
+
+    def test_command(self):
+        self.add('Soon', '1985-03-12')
+        output = io.StringIO()
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            call_command('send_birthday_reminder', '--auto', '--dry-run', '--date', '2023-03-10', stdout=output)
+            self.assertEqual(post.call_count, 0)
+            self.assertIn('reminder to 1: Soon', output.getvalue())
+            with mock.patch('apps.telegramApp.reminders.timezone.now', return_value=timezone.datetime(2023, 3, 10)):
+                call_command('send_birthday_reminder', '--auto', stdout=io.StringIO())
+            self.assertEqual(post.call_count, 1)
+        self.assertEqual(GlobalBirthday.objects.get().last_reminder_sent, date(2023, 3, 10))
+        self.assertEqual(BirthdayBotDailyStats.objects.get(day=date(2023, 3, 10)).reminders_sent, 1)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BirthdayCalendarTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for name, birth_date in [('Nowruz', '1990-03-21'), ('Leap', '2000-02-29'), ('Winter', '1985-12-25'),
+                                 ('Spring', '1995-04-02'), ('Autumn', '1980-10-01')]:
+            GlobalBirthday.objects.create(name=name, birth_date=birth_date, added_by='1')
+
+    def test_columns(self):
+        leap = GlobalBirthday.objects.get(name='Leap')
+        self.assertEqual((leap.birth_month, leap.birth_day, leap.day_of_year), (2, 29, 60))
+        self.assertEqual((leap.persian_month, leap.persian_day, leap.persian_birth_date), (12, 10, '1378/12/10'))
+        nowruz = GlobalBirthday.objects.get(name='Nowruz')
+        self.assertEqual((nowruz.persian_month, nowruz.persian_day), (1, 1))
+
+        # The backfill fills the rows which were saved without the columns
+        GlobalBirthday.objects.update(day_of_year=None, persian_month=None)
+        call_command('backfill_birthday_calendar', stdout=io.StringIO())
+        self.assertFalse(GlobalBirthday.objects.filter(persian_month=None).exists())
+        self.assertEqual(GlobalBirthday.objects.get(name='Leap').day_of_year, 60)
+
+    def test_sorted_and_filtered_by_the_database(self):
+        ordered = GlobalBirthday.order_by_next(GlobalBirthday.objects.all(), date(2023, 3, 22))
+        self.assertEqual([birthday.name for birthday in ordered], ['Spring', 'Autumn', 'Winter', 'Leap', 'Nowruz'])
+        bot = BirthdayBot()
+        UserBirthdaySettings.objects.create(user_id='1', user_name='One')
+        with mock.patch('requests.Session.post', side_effect=telegram_response):
+            # The settings, whether there are birthdays, and the birthdays of the month
+            with self.assertNumQueries(3):
+                response, keyboard = bot.get_user_birthdays('1', filter_type='persian_month',
+                                                            filter_value=bot.persian_months[0])
+        names = [row[0]['text'] for row in keyboard['inline_keyboard'] if row[0]['callback_data'].startswith('manage_id_')]
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].startswith('Nowruz') or names[1].startswith('Nowruz'))
+
+    def test_report_distributions(self):
+        report = BirthdayBot().generate_birthday_report('1')
+        self.assertIn('February: 1', report)
+        self.assertIn('♓️ Pisces: 1 birthdays', report)
+        self.assertIn('♈️ Aries: 2 birthdays', report)
+
+    def test_report_numbers_from_the_database(self):
+        today = date(2024, 3, 21)
+        stats = birthday_report.build('1', today)
+        ages = [birthday_report.age_on(birthday.birth_date, today) for birthday in GlobalBirthday.objects.all()]
+        self.assertEqual((stats['total'], stats['youngest'], stats['oldest']), (5, min(ages), max(ages)))
+        self.assertAlmostEqual(stats['average'], sum(ages) / len(ages))
+        self.assertEqual((stats['months'][3], stats['persian_months'][1]), (1, 2))
+        # The CASE of day ranges agrees with zodiac_sign()
+        signs = dict(GlobalBirthday.objects.annotate(zodiac=birthday_report.zodiac_of_day())
+                     .values_list('name', 'zodiac'))
+        self.assertEqual(signs, {birthday.name: zodiac_sign(birthday.birth_month, birthday.birth_day)
+                                 for birthday in GlobalBirthday.objects.all()})
+        self.assertIsNone(birthday_report.build('2', today))
+
+    def test_report_cached_until_the_birthdays_change(self):
+        with self.assertNumQueries(2):
+            birthday_report.get('1')
+        with self.assertNumQueries(0):
+            birthday_report.get('1')
+        # The birthdays of another user do not matter
+        GlobalBirthday.objects.create(name='Other', birth_date='2001-01-01', added_by='2')
+        with self.assertNumQueries(0):
+            self.assertEqual(birthday_report.get('1')['total'], 5)
+        GlobalBirthday.objects.create(name='New', birth_date='2010-01-01', added_by='1')
+        self.assertEqual(birthday_report.get('1')['youngest'], birthday_report.age_on(date(2010, 1, 1),
+                                                                                     timezone.now().date()))
+        GlobalBirthday.objects.get(name='New').delete()
+        self.assertEqual(birthday_report.get('1')['total'], 5)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BirthdayStatsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        UserBirthdaySettings.objects.create(user_id='1', user_name='One')
+        GlobalBirthday.objects.create(name='A', birth_date='1990-01-01', added_by='1')
+
+    def today(self):
+        return BirthdayBotDailyStats.objects.get(day=timezone.now().date())
+
+    def test_counted_as_it_happens(self):
+        stats = self.today()
+        self.assertEqual((stats.users, stats.birthdays), (1, 1))
+        UserBirthdaySettings.objects.create(user_id='2', user_name='Two')
+        # A second settings row of a user is not a new user
+        UserBirthdaySettings.objects.create(user_id='2', user_name='Two',
+                                            birthday=GlobalBirthday.objects.create(name='B', birth_date='1991-01-01',
+                                                                                   added_by='2'))
+        GlobalBirthday.objects.get(name='A').delete()
+        birthday_stats.seen('1')
+        birthday_stats.seen('1')
+        stats = self.today()
+        self.assertEqual((stats.users, stats.birthdays, stats.active_users), (2, 1, 1))
+
+        # Changes which skip save() are corrected by the daily snapshot
+        GlobalBirthday.objects.filter(name='B').delete()
+        self.assertEqual(birthday_stats.snapshot().birthdays, 0)
+
+    def test_failed_sends_and_admin_figures(self):
+        bot = BirthdayBot()
+        refused = mock.Mock(status_code=400)
+        refused.json.return_value = {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}
+        with mock.patch('requests.Session.post', return_value=refused):
+            bot.send_message('1', 'Hi')
+            # Not a send
+            bot.answer_callback_query('1')
+        self.assertEqual(self.today().messages_failed, 1)
+
+        GlobalBirthday.objects.create(name='C', birth_date='1992-01-01', added_by='1')
+        GlobalBirthday.objects.create(name='D', birth_date='1993-01-01', added_by='3')
+        with self.assertNumQueries(1):
+            top = list(birthday_stats.top_users())
+        self.assertEqual([(user['added_by'], user['user_name'], user['birthday_count']) for user in top],
+                         [('1', 'One', 2), ('3', None, 1)])
+        users = birthday_stats.with_birthday_counts(UserBirthdaySettings.objects.all())
+        self.assertEqual({user.user_id: user.birthday_count for user in users}, {'1': 2})
+        self.assertEqual(len(birthday_stats.history(7)), 1)
+
+        # The 30 day figure is counted, the daily ones come from the rows
+        UserBirthdaySettings.objects.create(user_id='4', user_name='Four')
+        UserBirthdaySettings.objects.filter(user_id='4').update(updated_at=timezone.now() - timedelta(days=31))
+        birthday_stats.seen('1')
+        TelegramAdmin.objects.create(user_id='1', user_name='One')
+        text = bot.cmd_stats('/stats', '1', 'One')
+        self.assertIn('Active Users (30d): 1\n', text)
+        self.assertIn('Active Users (today): 1\n', text)
+
+
+@mock.patch('requests.Session.post', telegram_response)
+@override_settings(CACHES=TEST_CACHES)
+class StateStoreTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def post(self, update, token='Birthday'):
+        return self.client.post('/telegram/', json.dumps(update), content_type='application/json',
+                                HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN=token)
+
+    def test_wizard_steps_read_nothing(self):
+        self.post(make_update(callback_data='add_birthday'))
+        self.assertEqual(UserState.objects.get().state, 'waiting_for_name')
+        # The step only writes the new state, the state and the admin list come from the cache
+        with self.assertNumQueries(1):
+            self.post(make_update('Sara'))
+        user_state = UserState.objects.get()
+        self.assertEqual((user_state.bot, user_state.state, user_state.context),
+                         ('birthday', 'waiting_for_birthday', {'name': 'Sara'}))
+
+    def test_states_of_the_bots_are_separate(self):
+        birthday = state_store.StateStore('birthday')
+        dutching = state_store.StateStore('dutching')
+        birthday.set('1', 'waiting_for_name')
+        dutching.set('1', 'awaiting_total_bet', {'step': 1})
+        self.assertEqual(birthday.get('1').state, 'waiting_for_name')
+        self.assertEqual(dutching.get('1').context, {'step': 1})
+        dutching.delete('1')
+        cache.clear()
+        self.assertIsNone(dutching.get('1'))
+        self.assertEqual(birthday.get('1').state, 'waiting_for_name')
+        # A user without a state is cached too
+        with self.assertNumQueries(0):
+            self.assertIsNone(dutching.get('1'))
+
+    def test_saved_state_stays_in_the_cache(self):
+        states = state_store.StateStore('birthday')
+        states.set('1', 'waiting_for_name')
+        user_state = states.get('1')
+        user_state.context['name'] = 'Sara'
+        user_state.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(states.get('1').context, {'name': 'Sara'})
+        self.assertEqual(UserState.objects.get().context, {'name': 'Sara'})
+        states.get('1').delete()
+        with self.assertNumQueries(0):
+            self.assertIsNone(states.get('1'))
+
+    def test_admins_and_sweep(self):
+        self.assertFalse(state_store.is_admin(ADMIN_ID))
+        admin = TelegramAdmin.objects.create(user_id=str(ADMIN_ID), user_name='Admin')
+        with self.assertNumQueries(1):
+            self.assertTrue(state_store.is_admin(ADMIN_ID))
+            self.assertFalse(state_store.is_admin(USER_ID))
+        admin.delete()
+        self.assertFalse(state_store.is_admin(ADMIN_ID))
+
+        state_store.StateStore('birthday').set('1', 'waiting_for_name')
+        state_store.StateStore('birthday').set('2', 'waiting_for_name')
+        UserState.objects.filter(user_id='1').update(updated_at=timezone.now() - timezone.timedelta(days=2))
+        self.assertEqual(state_store.sweep(), 1)
+        self.assertEqual(list(UserState.objects.values_list('user_id', flat=True)), ['2'])
+
+
+class DutchingSolverTest(TestCase):
+
+    def test_closed_form_matches_the_lp(self):
+        # Random markets, profitable ones and ones with a guaranteed loss (and infeasible weights)
+        rng = np.random.default_rng(20)
+        for market in range(30):
+            outcomes = int(rng.integers(2, 7))
+            odds = np.round(rng.uniform(1.05, 15.0, outcomes), 2).tolist()
+            weights = np.round(rng.uniform(0.2, 4.0, outcomes), 1).tolist()
+            total = float(rng.choice([10.0, 100.0, 2500.0]))
+            with self.subTest(odds=odds, weights=weights, total=total):
+                closed = dutching_solver.solve(odds, weights, total)
+                lp = dutching_solver.solve_lp(odds, weights, total)
+                self.assertEqual(closed.solver, 'closed form')
+                self.assertEqual(closed.status, lp.status)
+                if lp.optimal:
+                    np.testing.assert_allclose(closed.stakes, lp.stakes, atol=1e-4 * total)
+                    self.assertAlmostEqual(sum(closed.stakes), total)
+                    self.assertAlmostEqual(closed.base_profit, lp.base_profit, delta=1e-4 * total)
+
+    def test_many_markets_at_once(self):
+        solutions = dutching_solver.solve_markets([[2.0, 2.0, np.nan], [3.0, 3.0, 3.0], [1.5, 1.5, np.nan]],
+                                                  [[1, 1, np.nan], [1, 1, 1], [1, 5, np.nan]], [100, 90, 100])
+        np.testing.assert_allclose(solutions.stakes[1], [30, 30, 30])
+        self.assertTrue(np.isnan(solutions.stakes[0, 2]))
+        np.testing.assert_allclose(solutions.base_profit[:2], [0, 0], atol=1e-9)
+        self.assertEqual(solutions.feasible.tolist(), [True, True, True])
+        for market, (odds, weights) in enumerate([([2.0, 2.0], [1, 1]), ([1.5, 1.5], [1, 5])]):
+            single = dutching_solver.solve(odds, weights)
+            np.testing.assert_allclose(solutions.stakes[market * 2, :2], single.stakes)
+
+    def test_markets_which_need_the_lp(self):
+        # sum(w / o) is 0, the equations have no single solution
+        self.assertEqual(dutching_solver.solve([2.0, 3.0], [1, -1.5]).solver, 'lp')
+        bounded = dutching_solver.solve([2.1, 3.5], [1, 1], 100, max_stakes=[50, None])
+        self.assertEqual((bounded.solver, bounded.status), ('lp', 'Optimal'))
+        self.assertAlmostEqual(bounded.stakes[0], 50)
+        with self.assertRaises(ValueError):
+            dutching_solver.solve_markets([[2.0, 0.0]])
+
+    def test_calculation_text(self):
+        result = calculate_arbitrage({'Team 1': {'odds': 2.0, 'weight': 1}, 'Team 2': {'odds': 2.0, 'weight': 1}})
+        self.assertIn('Optimization Status: Optimal (closed form)', result)
+        self.assertIn('Stake on Team 1: $50.00 @ 2.00 odds', result)
+        # A loss which the stakes cannot spread by these weights
+        result = calculate_arbitrage({'Team 1': {'odds': 5.0, 'weight': 10}, 'Team 2': {'odds': 5.0, 'weight': 0.1},
+                                      'Team 3': {'odds': 1.2, 'weight': 0.1}})
+        self.assertIn('Infeasible', result)
+        self.assertIn('Could not find an optimal solution.', result)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DutchingScannerTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def sent_text(self, post):
+        return [call.kwargs['json']['text'] for call in post.call_args_list
+                if call.args[0].endswith('/sendMessage')][-1]
+
+    def test_parse_markets(self):
+        names, odds, weights, skipped = parse_markets(text_rows(
+            "Name Home Away\nArsenal-Chelsea 2.10 3.60 3.90\n\n2.5:2, 2.5\nbroken 1.0 3.0"))
+        self.assertEqual(names, ['Arsenal-Chelsea', 'Market 4'])
+        self.assertEqual(odds, [[2.1, 3.6, 3.9], [2.5, 2.5]])
+        self.assertEqual(weights, [[1, 1, 1], [2, 1]])
+        self.assertEqual(skipped, [1, 5])
+
+        # Numbers in the names of the teams are not odds
+        names, odds, weights, skipped = parse_markets(text_rows(
+            "Schalke 04 Bayern 2.1 3.4 3.2\nTSV 1860 Munich 2.5 2.5\nSchalke 04 2.0 2.0"))
+        self.assertEqual(names, ['Schalke 04 Bayern', 'TSV 1860 Munich', 'Schalke 04'])
+        self.assertEqual(odds, [[2.1, 3.4, 3.2], [2.5, 2.5], [2.0, 2.0]])
+        self.assertEqual(skipped, [])
+
+    def test_ranking(self):
+        # The last market has no stakes for its weights, it is ranked after the loss
+        solutions = dutching_solver.solve_markets(
+            [[5.0, 5.0, 1.2], [2.0, 2.2, np.nan], [1.8, 1.8, np.nan], [2.1, 2.1, np.nan]],
+            [[10, 0.1, 0.1], [1, 1, np.nan], [1, 1, np.nan], [1, 1, np.nan]])
+        self.assertEqual(solutions.ranking().tolist(), [3, 1, 2, 0])
+        self.assertTrue(np.isnan(solutions.guaranteed_profit[0]))
+        self.assertAlmostEqual(solutions.guaranteed_profit[3], 5.0)
+
+    @mock.patch('requests.Session.post', side_effect=telegram_response)
+    def test_scan_message(self, post):
+        process_update('Dutching', make_update("/scan 200\nLoss 1.80 1.80\nSure Bet 2.10 2.10\nbroken 1.0"))
+        text = self.sent_text(post)
+        self.assertIn('<b>2 markets</b> scanned, stake $200.00', text)
+        # The profitable market first, with its stakes, the others without
+        self.assertLess(text.index('Sure Bet: +5.00%'), text.index('Loss: -10.00%'))
+        self.assertIn('2.10 → $100.00', text)
+        self.assertEqual(text.count('→'), 2)
+        self.assertIn('Not markets (lines): 3', text)
+
+    def test_scan_csv(self):
+        document = {'file_id': 'F1', 'file_name': 'markets.csv', 'file_size': 60}
+        update = make_update()
+        update['message']['document'] = document
+        update['message']['caption'] = '50'
+        get_file = mock.Mock(status_code=200)
+        get_file.json.return_value = {'ok': True, 'result': {'file_path': 'documents/markets.csv', 'file_size': 60}}
+        content = mock.Mock(status_code=200, content=b'market;home;away\nA;2.1;2.1\nB;1.5;2.5\n')
+        with mock.patch('requests.Session.post', side_effect=lambda url, **kwargs: get_file if url.endswith(
+                '/getFile') else telegram_response()) as post, \
+                mock.patch('requests.Session.get', return_value=content) as get:
+            process_update('Dutching', update)
+        self.assertTrue(get.call_args.args[0].endswith('/documents/markets.csv'))
+        text = self.sent_text(post)
+        self.assertIn('<b>2 markets</b> scanned, stake $50.00', text)
+        self.assertIn('A: +5.00%', text)
+        self.assertIn('B: -6.25%', text)
+
+        document['file_name'] = 'markets.xlsx'
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            process_update('Dutching', update)
+        self.assertIn('CSV file', self.sent_text(post))
+
+
+def voice_update(duration=10, file_unique_id='U1'):
+    update = make_update()
+    update['message']['voice'] = {'file_id': 'V1', 'file_unique_id': file_unique_id, 'duration': duration}
+    return update
+
+
+def voice_api(url, **kwargs):
+    if url.endswith('/getFile'):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'ok': True, 'result': {'file_path': 'voice/file_1.oga'}}
+        return response
+    return telegram_response()
+
+
+@override_settings(CACHES=TEST_CACHES, TELEGRAM_VOICE_WORKERS=0)
+class VoiceTranscriptionJobTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bot = BotFactory.get_bot('Voice')
+        self.prediction = mock.Mock(status='succeeded', output={'text': 'سلام دنیا'})
+        replicate_client = mock.Mock()
+        replicate_client.predictions.create.return_value = self.prediction
+        openai_client = mock.Mock()
+        openai_client.chat.completions.create.return_value.choices = [mock.Mock(message=mock.Mock(content='Hello'))]
+        patchers = [mock.patch.object(self.bot, 'replicate_client', replicate_client),
+                    mock.patch.object(self.bot, 'openai_client', openai_client),
+                    # The download of the audio for its content hash
+                    mock.patch('requests.Session.get', return_value=mock.Mock(status_code=200, content=b'OggS audio'))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def calls(self, post):
+        return [(call.args[0].rsplit('/', 1)[1], call.kwargs['json']) for call in post.call_args_list]
+
+    def test_progress_is_edited_in_place(self):
+        with mock.patch('requests.Session.post', side_effect=voice_api) as post:
+            process_update('Voice', voice_update())
+        calls = self.calls(post)
+        self.assertEqual([method for method, data in calls], ['sendMessage', 'editMessageText', 'getFile',
+                                                              'editMessageText', 'editMessageText',
+                                                              'editMessageText', 'sendMessage'])
+        edits = [data for method, data in calls if method == 'editMessageText']
+        self.assertEqual([edit['text'] for edit in edits[:2]],
+                         [transcription_jobs.STAGE_TEXT['downloading'], transcription_jobs.STAGE_TEXT['transcribing']])
+        self.assertIn('Translating', edits[2]['text'])
+        # The progress message becomes the transcription, without the Cancel button
+        self.assertEqual(edits[3]['text'], 'سلام دنیا')
+        self.assertNotIn('reply_markup', edits[3])
+        self.assertEqual(calls[-1][1]['text'], 'Hello')
+        self.assertTrue(self.bot.replicate_client.predictions.create.call_args.kwargs['input']['audio']
+                        .endswith('/voice/file_1.oga'))
+        job = VoiceTranscriptionJob.objects.get()
+        self.assertEqual((job.status, job.transcription, job.translation, job.attempts),
+                         (VoiceTranscriptionJob.DONE, 'سلام دنیا', 'Hello', 1))
+
+    def test_cancel_while_transcribing(self):
+        self.prediction.status = 'processing'
+
+        def press_cancel():
+            job = VoiceTranscriptionJob.objects.get()
+            process_update('Voice', make_update(callback_data=f'{transcription_jobs.CANCEL_DATA}{job.pk}'))
+        self.prediction.reload.side_effect = press_cancel
+        with mock.patch('requests.Session.post', side_effect=voice_api) as post, \
+                mock.patch('apps.telegramApp.bots.voice_transcription_bot.time.sleep'):
+            process_update('Voice', voice_update())
+        self.prediction.cancel.assert_called_once()
+        self.assertEqual(VoiceTranscriptionJob.objects.get().status, VoiceTranscriptionJob.CANCELLED)
+        calls = self.calls(post)
+        self.assertIn('answerCallbackQuery', [method for method, data in calls])
+        self.assertEqual(calls[-1][1]['text'], transcription_jobs.CANCELLED_TEXT)
+        self.bot.openai_client.chat.completions.create.assert_not_called()
+
+    def test_jobs_are_bounded(self):
+        with override_settings(TELEGRAM_VOICE_WORKERS=1, TELEGRAM_VOICE_QUEUE=1):
+            self.assertEqual([transcription_jobs.reserve() for i in range(3)], [True, True, False])
+            transcription_jobs.release()
+            self.assertTrue(transcription_jobs.reserve())
+            transcription_jobs.release()
+            transcription_jobs.release()
+
+        VoiceTranscriptionJob.objects.bulk_create([VoiceTranscriptionJob(chat_id=str(USER_ID), file_id='V')
+                                                   for i in range(transcription_jobs.MAX_PER_CHAT)])
+        with mock.patch('requests.Session.post', side_effect=voice_api) as post:
+            process_update('Voice', voice_update())
+        self.assertIn('still being processed', post.call_args.kwargs['json']['text'])
+        self.assertEqual(VoiceTranscriptionJob.objects.count(), transcription_jobs.MAX_PER_CHAT)
+
+    def test_limit_of_the_chat_counts_the_earlier_jobs(self):
+        VoiceTranscriptionJob.objects.bulk_create([VoiceTranscriptionJob(chat_id=str(USER_ID), file_id='V')
+                                                   for i in range(transcription_jobs.MAX_PER_CHAT - 1)])
+        create = VoiceTranscriptionJob.objects.create
+
+        def concurrent(**fields):
+            # A voice message of the chat which another process inserted while this one was submitted
+            create(chat_id=fields['chat_id'], file_id='Earlier')
+            return create(**fields)
+
+        with mock.patch.object(VoiceTranscriptionJob.objects, 'create', side_effect=concurrent), \
+                mock.patch('requests.Session.post', side_effect=voice_api) as post:
+            process_update('Voice', voice_update())
+        self.assertIn('still being processed', post.call_args.kwargs['json']['text'])
+        self.assertFalse(VoiceTranscriptionJob.objects.filter(file_id='V1').exists())
+        self.assertEqual(VoiceTranscriptionJob.objects.count(), transcription_jobs.MAX_PER_CHAT)
+
+    @override_settings(TELEGRAM_VOICE_WORKERS=1)
+    def test_cron_runs_the_stale_jobs_inline(self):
+        VoiceTranscriptionJob.objects.bulk_create([
+            VoiceTranscriptionJob(chat_id=str(USER_ID), file_id=f'V{i}', attempts=1,
+                                  status=VoiceTranscriptionJob.TRANSCRIBING)
+            for i in range(transcription_jobs.INLINE_RECOVER + 1)])
+        VoiceTranscriptionJob.objects.update(updated_at=timezone.now() - transcription_jobs.LEASE - timedelta(minutes=1))
+        with mock.patch('requests.Session.post', side_effect=voice_api), \
+                mock.patch.object(transcription_jobs, 'start') as start:
+            cron.resume_voice_jobs()
+        start.assert_not_called()
+        self.assertEqual(sorted(VoiceTranscriptionJob.objects.values_list('status', flat=True)),
+                         [VoiceTranscriptionJob.DONE] * transcription_jobs.INLINE_RECOVER +
+                         [VoiceTranscriptionJob.TRANSCRIBING])
+
+    @override_settings(TELEGRAM_RATE_LIMITS={'chat': (1, 60)})
+    def test_progress_edits_do_not_wait_for_the_rate_limits(self):
+        with mock.patch('requests.Session.post', side_effect=voice_api) as post, \
+                mock.patch('apps.telegramApp.bots.rate_limit.time.sleep') as sleep:
+            process_update('Voice', voice_update())
+        sleep.assert_not_called()
+        # Only the progress message went out, the transcription and the translation wait in the outbox
+        self.assertEqual([method for method, data in self.calls(post) if method in rate_limit.SEND_METHODS],
+                         ['sendMessage'])
+        self.assertEqual([row.payload['text'] for row in TelegramOutbox.objects.order_by('pk')], ['سلام دنیا', 'Hello'])
+
+    def test_stale_jobs_are_started_again(self):
+        retry = VoiceTranscriptionJob.objects.create(chat_id=str(USER_ID), file_id='V1', message_id=5, attempts=1,
+                                                     status=VoiceTranscriptionJob.TRANSCRIBING)
+        given_up = VoiceTranscriptionJob.objects.create(chat_id='2', file_id='V2', message_id=6,
+                                                        attempts=transcription_jobs.MAX_ATTEMPTS,
+                                                        status=VoiceTranscriptionJob.TRANSCRIBING)
+        fresh = VoiceTranscriptionJob.objects.create(chat_id='3', file_id='V3', status=VoiceTranscriptionJob.QUEUED)
+        VoiceTranscriptionJob.objects.exclude(pk=fresh.pk) \
+            .update(updated_at=timezone.now() - transcription_jobs.LEASE - timedelta(minutes=1))
+        with mock.patch('requests.Session.post', side_effect=voice_api):
+            self.assertEqual(transcription_jobs.recover(bot=self.bot), 1)
+        retry.refresh_from_db()
+        given_up.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((retry.status, retry.attempts), (VoiceTranscriptionJob.DONE, 2))
+        self.assertEqual(given_up.status, VoiceTranscriptionJob.FAILED)
+        self.assertEqual(fresh.status, VoiceTranscriptionJob.QUEUED)
+
+    def test_forwarded_voice_messages_are_answered_from_the_cache(self):
+        with mock.patch('requests.Session.post', side_effect=voice_api):
+            process_update('Voice', voice_update())
+        with mock.patch('requests.Session.post', side_effect=voice_api) as post:
+            process_update('Voice', voice_update())
+        # No getFile, no download, no Replicate and no OpenAI for the second one
+        self.assertEqual([method for method, data in self.calls(post)], ['sendMessage', 'editMessageText',
+                                                                         'sendMessage'])
+        self.assertEqual(self.bot.replicate_client.predictions.create.call_count, 1)
+        self.assertEqual(self.bot.openai_client.chat.completions.create.call_count, 1)
+        self.assertEqual(requests.Session.get.call_count, 1)
+        self.assertEqual(self.calls(post)[-1][1]['text'], 'Hello')
+        self.assertEqual(VoiceTranscript.objects.get().hits, 1)
+        metrics = transcript_cache.metrics()
+        self.assertEqual((metrics['hits'], metrics['misses'], metrics['hit_rate']), (1, 1, 0.5))
+
+    def test_the_same_audio_in_another_file_is_found_by_its_content(self):
+        with mock.patch('requests.Session.post', side_effect=voice_api):
+            process_update('Voice', voice_update(file_unique_id='U1'))
+            process_update('Voice', voice_update(file_unique_id='U2'))
+        self.assertEqual(self.bot.replicate_client.predictions.create.call_count, 1)
+        self.assertEqual(sorted(VoiceTranscript.objects.values_list('file_unique_id', 'translation')),
+                         [('U1', 'Hello'), ('U2', 'Hello')])
+        self.assertEqual(transcript_cache.metrics()['content_hits'], 1)
+
+        # Another Whisper model transcribes it again
+        with mock.patch.object(self.bot, 'model_version', 'whisper:new'), \
+                mock.patch('requests.Session.post', side_effect=voice_api):
+            process_update('Voice', voice_update(file_unique_id='U1'))
+        self.assertEqual(self.bot.replicate_client.predictions.create.call_count, 2)
+        self.assertEqual(VoiceTranscript.objects.get(file_unique_id='U1').model_version, 'whisper:new')
+
+    def test_eviction(self):
+        for number in range(4):
+            VoiceTranscript.objects.create(file_unique_id=f'U{number}', model_version='w', transcription='t',
+                                           last_used_at=timezone.now() - timedelta(days=number * 100))
+        self.assertEqual(transcript_cache.evict(max_entries=10, max_days=250), 1)
+        self.assertEqual(transcript_cache.evict(max_entries=2, max_days=250), 1)
+        self.assertEqual(sorted(VoiceTranscript.objects.values_list('file_unique_id', flat=True)), ['U0', 'U1'])
+
+
+@mock.patch('requests.Session.post', telegram_response)
+@override_settings(CACHES=TEST_CACHES, TELEGRAM_STREAM_ANSWERS=False)
+class AnswerCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        answer_cache.clear_local()
+        self.addCleanup(answer_cache.clear_local)
+        self.openai = mock.Mock()
+        self.openai.chat.completions.create.side_effect = lambda **kwargs: mock.Mock(
+            choices=[mock.Mock(message=mock.Mock(content=f"Entry of {kwargs['messages'][0]['content']}"))])
+        for secret_token in ['Dictionary', 'Phrase']:
+            patcher = mock.patch.object(BotFactory.get_bot(secret_token), 'openai_client', self.openai)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_repeated_questions_are_not_asked_again(self):
+        process_update('Dictionary', make_update('Take  Off'))
+        answer_cache.clear_local()
+        with self.assertNumQueries(2):
+            # The row and its hit
+            process_update('Dictionary', make_update(' take off'))
+        with self.assertNumQueries(0):
+            process_update('Dictionary', make_update('TAKE OFF'))
+        self.assertEqual(self.openai.chat.completions.create.call_count, 1)
+        answer = LLMAnswer.objects.get()
+        self.assertEqual((answer.question, answer.answer, answer.hits), ('take off', 'Entry of Take  Off', 1))
+
+        # The phrase bot has answers of its own, and a new prompt version does not use the old answers
+        process_update('Phrase', make_update('take off'))
+        with mock.patch('apps.telegramApp.bots.dictionary_bot.PROMPT_VERSION', 2):
+            process_update('Dictionary', make_update('take off'))
+        self.assertEqual(self.openai.chat.completions.create.call_count, 3)
+
+    def test_expiry_and_pruning(self):
+        process_update('Dictionary', make_update('apple'))
+        process_update('Dictionary', make_update('pear'))
+        LLMAnswer.objects.filter(question='apple').update(expires_at=timezone.now())
+        answer_cache.clear_local()
+        process_update('Dictionary', make_update('apple'))
+        self.assertEqual(self.openai.chat.completions.create.call_count, 3)
+        self.assertEqual(LLMAnswer.objects.count(), 2)
+
+        LLMAnswer.objects.filter(question='pear').update(expires_at=timezone.now() - timedelta(days=1))
+        process_update('Dictionary', make_update('plum'))
+        LLMAnswer.objects.filter(question='plum').update(last_used_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(answer_cache.prune(max_entries=1), 2)
+        self.assertEqual(list(LLMAnswer.objects.values_list('question', flat=True)), ['apple'])
+
+    def test_warm_the_frequent_answers(self):
+        for word in ['apple', 'pear']:
+            process_update('Dictionary', make_update(word))
+        LLMAnswer.objects.filter(question='apple').update(hits=5, expires_at=timezone.now() + timedelta(hours=1))
+        questions = io.StringIO()
+        call_command('warm_answer_cache', '--dry-run', stdout=questions)
+        self.assertEqual(questions.getvalue().splitlines()[:-1], ['dictionary: apple'])
+
+        self.openai.chat.completions.create.reset_mock()
+        call_command('warm_answer_cache', stdout=io.StringIO())
+        self.assertEqual(self.openai.chat.completions.create.call_count, 1)
+        self.assertGreater(LLMAnswer.objects.get(question='apple').expires_at, timezone.now() + timedelta(days=29))
+
+
+def completion_chunks(*texts):
+    return iter([mock.Mock(choices=[mock.Mock(delta=mock.Mock(content=text))]) for text in texts])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StreamingReplyTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        answer_cache.clear_local()
+        self.addCleanup(answer_cache.clear_local)
+        streaming.reset_metrics()
+        self.bot = mock.Mock()
+        self.bot.call.return_value = {'ok': True, 'result': {'message_id': 7}}
+
+    def calls(self):
+        return [(call.args[0], call.args[1]['text'], call.kwargs['defer']) for call in self.bot.call.call_args_list]
+
+    def test_first_words_then_edits(self):
+        reply = streaming.StreamingReply(self.bot, '1', interval=0)
+        answer = reply.stream(completion_chunks('Hello ', 'world, this is ', 'a streamed answer.'))
+        self.assertEqual(answer, 'Hello world, this is a streamed answer.')
+        self.assertEqual(self.calls(), [
+            ('sendMessage', 'Hello world, this is ' + streaming.CURSOR, False),
+            ('editMessageText', answer + streaming.CURSOR, False),
+            ('editMessageText', answer, True),
+        ])
+        self.assertTrue(reply.sent)
+        self.assertEqual(streaming.metrics()['first_output']['answers'], 1)
+
+    def test_edits_are_throttled(self):
+        self.bot.call.side_effect = lambda method, data, defer, max_wait: {'ok': False, 'deferred': True} \
+            if method == 'editMessageText' and not defer else {'ok': True, 'result': {'message_id': 7}}
+        reply = streaming.StreamingReply(self.bot, '1', interval=0)
+        reply.stream(completion_chunks('The first twenty characters', ' and', ' more'))
+        # The edits which the rate limits refused are not counted as shown, the final one is sent for sure
+        self.assertEqual([(method, defer) for method, text, defer in self.calls()],
+                         [('sendMessage', False), ('editMessageText', False), ('editMessageText', False),
+                          ('editMessageText', True)])
+        self.bot.call.reset_mock(side_effect=True)
+        self.bot.call.return_value = {'ok': True, 'result': {'message_id': 7}}
+        streaming.StreamingReply(self.bot, '1', interval=60).stream(
+            completion_chunks('The first twenty characters', ' and', ' more'))
+        self.assertEqual([method for method, text, defer in self.calls()], ['sendMessage', 'editMessageText'])
+
+    @override_settings(TELEGRAM_RATE_LIMITS={'chat': (2, 60)})
+    def test_edits_do_not_wait_for_the_rate_limits(self):
+        bot = BotFactory.get_bot('Dictionary')
+        with mock.patch('requests.Session.post', side_effect=telegram_response) as post, \
+                mock.patch('apps.telegramApp.bots.rate_limit.time.sleep') as sleep:
+            reply = streaming.StreamingReply(bot, '1', interval=0)
+            reply.stream(completion_chunks('The first twenty characters', ' and', ' more', ' words'))
+        sleep.assert_not_called()
+        # The first message and one edit, the other edits are skipped and the final text waits in the outbox
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(TelegramOutbox.objects.get().payload['text'], 'The first twenty characters and more words')
+
+    def test_long_answers_go_on_in_new_messages(self):
+        text = ''.join(f"Line {number} of a long dictionary entry.\n" for number in range(300))
+        reply = streaming.StreamingReply(self.bot, '1', interval=0)
+        self.assertEqual(reply.stream(completion_chunks(*[text[i:i + 50] for i in range(0, len(text), 50)])), text)
+        calls = self.calls()
+        self.assertEqual([method for method, message, defer in calls].count('sendMessage'), 3)
+        self.assertTrue(all(len(message) <= streaming.MAX_MESSAGE for method, message, defer in calls))
+        finals = [message for method, message, defer in calls if defer]
+        self.assertEqual(len(finals), 3)
+        self.assertEqual('\n'.join(finals).strip(), text.strip())
+
+    def test_broken_streams_end_with_an_error_note(self):
+        def broken():
+            yield from completion_chunks('Serendipity (noun): ', 'finding something good ')
+            raise ConnectionError('Stream closed')
+
+        bot = BotFactory.get_bot('Dictionary')
+        openai_client = mock.Mock()
+        openai_client.chat.completions.create.side_effect = lambda **kwargs: broken()
+        with mock.patch.object(bot, 'openai_client', openai_client), \
+                mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            process_update('Dictionary', make_update('Serendipity'))
+        # The message loses the cursor, no second message with the error
+        self.assertEqual([call.kwargs['json']['text'] for call in post.call_args_list],
+                         ['Serendipity (noun): finding something good ' + streaming.CURSOR,
+                          'Serendipity (noun): finding something good ' + streaming.ERROR_NOTE])
+        # The broken answer is not cached
+        self.assertFalse(LLMAnswer.objects.exists())
+
+        # Nothing was shown yet, the bot answers with the error
+        def broken_at_once():
+            yield from completion_chunks('Short')
+            raise ConnectionError('Stream closed')
+
+        reply = streaming.StreamingReply(self.bot, '1', interval=0)
+        with self.assertRaises(ConnectionError):
+            reply.stream(broken_at_once())
+        self.assertFalse(reply.sent)
+        self.bot.call.assert_not_called()
+
+    def test_the_bots_stream_new_answers(self):
+        bot = BotFactory.get_bot('Dictionary')
+        openai_client = mock.Mock()
+        openai_client.chat.completions.create.side_effect = lambda **kwargs: completion_chunks(
+            'Serendipity (noun): ', 'finding something good ', 'by chance.')
+        with mock.patch.object(bot, 'openai_client', openai_client), \
+                mock.patch('requests.Session.post', side_effect=telegram_response) as post:
+            process_update('Dictionary', make_update('Serendipity'))
+            self.assertTrue(openai_client.chat.completions.create.call_args.kwargs['stream'])
+            texts = [call.kwargs['json']['text'] for call in post.call_args_list]
+            # No second message with the whole answer
+            self.assertEqual(texts[-1], 'Serendipity (noun): finding something good by chance.')
+            self.assertEqual(len(texts), 2)
+
+            # The cached answer is sent at once
+            post.reset_mock()
+            process_update('Dictionary', make_update('serendipity'))
+        self.assertEqual(openai_client.chat.completions.create.call_count, 1)
+        self.assertEqual([call.kwargs['json']['text'] for call in post.call_args_list],
+                         ['Serendipity (noun): finding something good by chance.'])
@@ -0,0 +1,131 @@
+## Cache of the transcriptions and translations of the VoiceTranscriptionBot (VoiceTranscript rows)
+## A voice message which is forwarded keeps its file_unique_id, it is answered from the cache without any call to
+## Telegram, Replicate or OpenAI. A voice message which was sent again as a new file has another file_unique_id but
+## the same audio, it is found by the SHA-256 of the content after the download (and saved for its file_unique_id).
+## - A transcript is only used with the Whisper model which made it, a translation only with its translation model.
+## - evict() deletes the transcripts which were not used for TELEGRAM_VOICE_CACHE_DAYS and the least recently used
+##   above TELEGRAM_VOICE_CACHE_ENTRIES (cron.evict_voice_transcripts).
+## - The hits, misses and the seconds which the hits saved are counted for all processes, see metrics().
+##
+## transcript = transcript_cache.lookup(file_unique_id, model_version)      >> None when it was not transcribed yet
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from datetime import timedelta
+from typing import Dict, Optional
+from .models import VoiceTranscript
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = 10000
+MAX_DAYS = 180
+COUNTERS = ['hits', 'content_hits', 'misses', 'saved_ms']
+
+
+def count(counter: str, amount: int = 1) -> None:
+    key = f"telegram:voice:cache:{counter}"
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        cache.set(key, amount, None)
+
+
+def metrics() -> Dict[str, float]:
+    """Hits (by file_unique_id and by content), misses, hit rate and the seconds which the hits saved."""
+    values = cache.get_many([f"telegram:voice:cache:{counter}" for counter in COUNTERS])
+    hits, content_hits, misses, saved_ms = [values.get(f"telegram:voice:cache:{counter}", 0) for counter in COUNTERS]
+    requests = hits + content_hits + misses
+    return {'hits': hits, 'content_hits': content_hits, 'misses': misses,
+            'hit_rate': (hits + content_hits) / requests if requests else 0.0, 'seconds_saved': saved_ms / 1000}
+
+
+def log_metrics() -> None:
+    values = metrics()
+    logger.info("Voice transcript cache: {hits} hits, {content_hits} content hits, {misses} misses "
+                "({hit_rate:.0%}), {seconds_saved:.0f} seconds saved".format(**values))
+
+
+def hit(transcript: VoiceTranscript, counter: str = 'hits') -> VoiceTranscript:
+    VoiceTranscript.objects.filter(pk=transcript.pk).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    count(counter)
+    count('saved_ms', int((transcript.transcribe_seconds + transcript.translate_seconds) * 1000))
+    return transcript
+
+
+def lookup(file_unique_id: str, model_version: str) -> Optional[VoiceTranscript]:
+    """The transcript of a file which was transcribed before by the model, counted as a hit."""
+    if not file_unique_id:
+        return None
+    transcript = VoiceTranscript.objects.filter(file_unique_id=file_unique_id, model_version=model_version).first()
+    return hit(transcript) if transcript else None
+
+
+def lookup_content(content_hash: str, file_unique_id: str, model_version: str) -> Optional[VoiceTranscript]:
+    """The transcript of the same audio in another file, saved for this file too. A miss is counted."""
+    transcript = VoiceTranscript.objects.filter(content_hash=content_hash, model_version=model_version) \
+        .order_by('-last_used_at').first() if content_hash else None
+    if transcript is None:
+        count('misses')
+        return None
+    hit(transcript, 'content_hits')
+    if file_unique_id and file_unique_id != transcript.file_unique_id:
+        copy = VoiceTranscript(file_unique_id=file_unique_id, content_hash=content_hash, model_version=model_version,
+                               translation_model=transcript.translation_model, transcription=transcript.transcription,
+                               translation=transcript.translation, duration=transcript.duration,
+                               transcribe_seconds=transcript.transcribe_seconds,
+                               translate_seconds=transcript.translate_seconds)
+        return save(copy)
+    return transcript
+
+
+def save(transcript: VoiceTranscript) -> VoiceTranscript:
+    """Save a new transcript, the one of a parallel job for the same file wins."""
+    try:
+        with transaction.atomic():
+            transcript.save()
+    except IntegrityError:
+        # A transcript of an older model is replaced
+        VoiceTranscript.objects.filter(file_unique_id=transcript.file_unique_id) \
+            .exclude(model_version=transcript.model_version).delete()
+        try:
+            with transaction.atomic():
+                transcript.save()
+        except IntegrityError:
+            pass
+    return transcript
+
+
+def store(file_unique_id: str, content_hash: str, model_version: str, transcription: str, duration: int,
+          seconds: float) -> VoiceTranscript:
+    """Save a transcription which was just done (without a file_unique_id it is not saved)."""
+    transcript = VoiceTranscript(file_unique_id=file_unique_id, content_hash=content_hash, model_version=model_version,
+                                 transcription=transcription, duration=duration, transcribe_seconds=seconds)
+    return save(transcript) if file_unique_id else transcript
+
+
+def add_translation(transcript: VoiceTranscript, translation: str, translation_model: str, seconds: float) -> None:
+    """The translation of a transcript, it is used while the translation model is the same."""
+    transcript.translation = translation
+    transcript.translation_model = translation_model
+    transcript.translate_seconds = seconds
+    if transcript.pk:
+        VoiceTranscript.objects.filter(pk=transcript.pk).update(
+            translation=translation, translation_model=translation_model, translate_seconds=seconds)
+
+
+def evict(max_entries: Optional[int] = None, max_days: Optional[int] = None) -> int:
+    """Delete the transcripts which were not used for max_days and the least recently used above max_entries."""
+    max_entries = getattr(settings, 'TELEGRAM_VOICE_CACHE_ENTRIES', MAX_ENTRIES) if max_entries is None else max_entries
+    max_days = getattr(settings, 'TELEGRAM_VOICE_CACHE_DAYS', MAX_DAYS) if max_days is None else max_days
+    deleted, _ = VoiceTranscript.objects.filter(last_used_at__lt=timezone.now() - timedelta(days=max_days)).delete()
+    while True:
+        over = list(VoiceTranscript.objects.order_by('-last_used_at', '-pk')
+                    .values_list('pk', flat=True)[max_entries:max_entries + 1000])
+        if not over:
+            return deleted
+        deleted += VoiceTranscript.objects.filter(pk__in=over).delete()[0]
@@ -0,0 +1,329 @@
+## Background jobs of the VoiceTranscriptionBot
+## A voice message is saved as a VoiceTranscriptionJob and answered at once with one progress message, the webhook (or
+## the queue worker) does not wait for Telegram, Replicate and OpenAI. The job runs in a thread pool of the process and
+## edits the progress message in place as it goes: queued >> downloading >> transcribing >> translating >> done.
+## - At most TELEGRAM_VOICE_WORKERS jobs run at the same time in a process and at most TELEGRAM_VOICE_QUEUE wait for
+##   a thread, more voice messages are refused with a busy answer. 0 workers run the job before submit() returns.
+## - The Cancel button (or /cancel) sets the status in the database, the job stops at its next check and the
+##   Replicate prediction is cancelled.
+## - At most MAX_PER_CHAT jobs of a chat wait or run, checked after the job was inserted: of two voice messages which
+##   arrive at the same time the later one counts the earlier one.
+## - A job whose process died is started again by recover(), at most MAX_ATTEMPTS times: in the pool of the queue
+##   worker, or one after the other in the process of cron.resume_voice_jobs (inline, at most INLINE_RECOVER jobs).
+## - A voice message which was transcribed before is answered from transcript_cache.py.
+##
+## answer = transcription_jobs.submit(bot, message)      >> None when the job was started
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+from .models import VoiceTranscriptionJob
+from .bots import transport
+from . import outbox, transcript_cache
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 2
+QUEUE = 8
+# Voice messages of one chat which may wait or run at the same time
+MAX_PER_CHAT = 3
+MAX_ATTEMPTS = 3
+# Stale jobs which cron runs one after the other in its own process, a transcription takes up to a few minutes
+INLINE_RECOVER = 2
+# A job without a change of its status for this long belongs to a process which died
+LEASE = timedelta(minutes=15)
+# Telegram allows 4096 characters in a message
+MAX_TEXT = 4000
+CANCEL_DATA = 'cancel_voice:'
+
+STAGE_TEXT = {
+    VoiceTranscriptionJob.QUEUED: "🎤 Your voice message is waiting to be processed...",
+    VoiceTranscriptionJob.DOWNLOADING: "🎤 Downloading your voice message...",
+    VoiceTranscriptionJob.TRANSCRIBING: "🎤 Transcribing your voice message...",
+}
+CANCELLED_TEXT = "🚫 Transcription cancelled."
+FAILED_TEXT = "❌ Could not transcribe the voice message. Please try again with a clearer recording."
+
+
+class JobCancelled(Exception):
+    # The user cancelled the job while it ran
+    pass
+
+
+class JobFailed(Exception):
+    # The voice message could not be transcribed, the message is the error of the job
+    pass
+
+
+_lock = threading.Lock()
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_pid: Optional[int] = None
+# Jobs of this process which run or wait for a thread
+_active = 0
+
+
+def workers() -> int:
+    return getattr(settings, 'TELEGRAM_VOICE_WORKERS', WORKERS)
+
+
+def queue_size() -> int:
+    return getattr(settings, 'TELEGRAM_VOICE_QUEUE', QUEUE)
+
+
+def get_pool() -> ThreadPoolExecutor:
+    # Called with the lock, a forked worker process starts its own threads
+    global _pool, _pool_pid, _active
+    if _pool_pid != os.getpid():
+        _pool = ThreadPoolExecutor(max_workers=workers(), thread_name_prefix='voice')
+        _pool_pid = os.getpid()
+        _active = 0
+    return _pool
+
+
+def reserve() -> bool:
+    """A place in the pool of this process for one job, False when it is full."""
+    global _active
+    if workers() <= 0:
+        return True
+    with _lock:
+        get_pool()
+        if _active >= workers() + queue_size():
+            return False
+        _active += 1
+        return True
+
+
+def release() -> None:
+    global _active
+    if workers() <= 0:
+        return
+    with _lock:
+        _active = max(_active - 1, 0)
+
+
+def start(pk: int, bot=None) -> None:
+    """Run a job which has a reserved place, in the pool or (0 workers) at once."""
+    if workers() <= 0:
+        run(pk, bot)
+        return
+    with _lock:
+        pool = get_pool()
+    pool.submit(run_task, pk, bot)
+
+
+def run_task(pk: int, bot=None) -> None:
+    """run() in a thread of the pool, which must not keep its database connection open."""
+    try:
+        run(pk, bot)
+    except Exception as e:
+        logger.error(f"Voice job {pk} failed: {e}", exc_info=True)
+    finally:
+        release()
+        connections.close_all()
+
+
+def cancel_keyboard(pk: int) -> Dict[str, Any]:
+    return {"inline_keyboard": [[{"text": "✖️ Cancel", "callback_data": f"{CANCEL_DATA}{pk}"}]]}
+
+
+def fit(text: str) -> str:
+    return text if len(text) <= MAX_TEXT else text[:MAX_TEXT] + "... (truncated)"
+
+
+def submit(bot, message: Dict[str, Any]) -> Optional[str]:
+    """Start the job of a voice message, returns the answer when it cannot be started (None when it was)."""
+    voice = message.get('voice', {})
+    chat_id = str(message.get('chat', {}).get('id'))
+    if not reserve():
+        return "⏳ The bot is busy right now, please send the voice message again in a few minutes."
+    try:
+        job = VoiceTranscriptionJob.objects.create(chat_id=chat_id, user_id=str(message.get('from', {}).get('id', '')),
+                                                   file_id=voice['file_id'], duration=voice.get('duration', 0),
+                                                   file_unique_id=voice.get('file_unique_id', ''))
+        # The limit of the chat counts the jobs inserted before this one, a count before the insert would let two
+        # voice messages at the same time both pass
+        if VoiceTranscriptionJob.objects.filter(chat_id=chat_id, status__in=VoiceTranscriptionJob.ACTIVE,
+                                                pk__lt=job.pk).count() >= MAX_PER_CHAT:
+            job.delete()
+            release()
+            return f"⏳ {MAX_PER_CHAT} of your voice messages are still being processed, please wait for them."
+        answer = bot.call('sendMessage', {"chat_id": chat_id, "text": STAGE_TEXT[job.QUEUED],
+                                          "reply_markup": cancel_keyboard(job.pk)})
+        if answer.get('ok'):
+            job.message_id = answer['result']['message_id']
+            job.save(update_fields=['message_id'])
+    except Exception:
+        release()
+        raise
+    start(job.pk, bot)
+    return None
+
+
+def advance(job: VoiceTranscriptionJob, status: str, **fields) -> bool:
+    """Move a job which is not finished (cancelled) to the next status, False when it is."""
+    now = timezone.now()
+    if status not in VoiceTranscriptionJob.ACTIVE:
+        fields['finished_at'] = now
+    changed = VoiceTranscriptionJob.objects.filter(pk=job.pk, status__in=VoiceTranscriptionJob.ACTIVE) \
+        .update(status=status, updated_at=now, **fields)
+    if changed:
+        job.status = status
+    return bool(changed)
+
+
+def is_cancelled(pk: int) -> bool:
+    return VoiceTranscriptionJob.objects.filter(pk=pk, status=VoiceTranscriptionJob.CANCELLED).exists()
+
+
+def progress(bot, job: VoiceTranscriptionJob, text: str, final: bool = False) -> None:
+    """Edit the progress message of the job, with the Cancel button until the text is final."""
+    if job.message_id is None:
+        # The progress message could not be sent, only the result is sent
+        if final:
+            bot.send_message(job.chat_id, text)
+        return
+    data = {"chat_id": job.chat_id, "message_id": job.message_id, "text": text}
+    if not final:
+        data["reply_markup"] = cancel_keyboard(job.pk)
+    try:
+        # A progress edit without a rate limit token is skipped at once (the pool thread does not wait for one), the
+        # final text waits in the outbox
+        bot.call('editMessageText', data, defer=final, max_wait=0)
+    except Exception as e:
+        logger.error(f"Error editing the progress of voice job {job.pk}: {e}")
+
+
+def fail(bot, job: VoiceTranscriptionJob, error: str, text: str = FAILED_TEXT) -> str:
+    if advance(job, VoiceTranscriptionJob.FAILED, error=error):
+        progress(bot, job, text, final=True)
+        return job.status
+    # Cancelled in the meantime
+    progress(bot, job, CANCELLED_TEXT, final=True)
+    return VoiceTranscriptionJob.CANCELLED
+
+
+def transcribe(bot, job: VoiceTranscriptionJob):
+    """Download and transcribe the voice message of a job, returns its VoiceTranscript. Raises JobFailed."""
+    progress(bot, job, STAGE_TEXT[job.DOWNLOADING])
+    file_info = bot._get_file_info(job.file_id)
+    if not file_info or not file_info.get('ok'):
+        raise JobFailed(f"getFile: {file_info}")
+    file_path = file_info['result']['file_path']
+    try:
+        content_hash = hashlib.sha256(transport.download(bot.token, file_path)).hexdigest()
+    except Exception as e:
+        # Replicate downloads the file itself, only the lookup by content is lost
+        logger.warning(f"Could not download voice message {job.file_id}: {e}")
+        content_hash = ''
+    transcript = transcript_cache.lookup_content(content_hash, job.file_unique_id, bot.model_version)
+    if transcript is not None:
+        return transcript
+
+    if not advance(job, job.TRANSCRIBING):
+        raise JobCancelled()
+    progress(bot, job, STAGE_TEXT[job.TRANSCRIBING])
+    start = time.monotonic()
+    transcription = bot._transcribe_audio(bot.file_url(file_path), cancelled=lambda: is_cancelled(job.pk))
+    if not transcription:
+        raise JobFailed("No transcription")
+    return transcript_cache.store(job.file_unique_id, content_hash, bot.model_version, transcription, job.duration,
+                                  time.monotonic() - start)
+
+
+def run(pk: int, bot=None) -> Optional[str]:
+    """Run a waiting job through its stages, returns its final status (None when it is not waiting)."""
+    job = VoiceTranscriptionJob.objects.filter(pk=pk).first()
+    # The claim, a job is run by one thread only
+    if job is None or not VoiceTranscriptionJob.objects.filter(pk=pk, status=job.QUEUED).update(
+            status=job.DOWNLOADING, updated_at=timezone.now(), attempts=F('attempts') + 1):
+        return None
+    job.status = job.DOWNLOADING
+    bot = bot or outbox.bot_named('VoiceTranscriptionBot')
+
+    try:
+        # A voice message which was transcribed before is answered without any external call
+        transcript = transcript_cache.lookup(job.file_unique_id, bot.model_version) or transcribe(bot, job)
+        transcription = transcript.transcription
+        if not advance(job, job.TRANSLATING, transcription=transcription):
+            raise JobCancelled()
+        translation = transcript.translation if transcript.translation_model == bot.translation_model else ''
+        if not translation and bot.openai_client:
+            progress(bot, job, f"{fit(transcription)}\n\n🌐 Translating to English...")
+            start = time.monotonic()
+            translation = bot._translate_to_english(transcription)
+            if translation:
+                transcript_cache.add_translation(transcript, translation, bot.translation_model,
+                                                 time.monotonic() - start)
+        if not advance(job, job.DONE, translation=translation or ''):
+            raise JobCancelled()
+    except JobCancelled:
+        progress(bot, job, CANCELLED_TEXT, final=True)
+        return VoiceTranscriptionJob.CANCELLED
+    except JobFailed as e:
+        return fail(bot, job, str(e))
+    except Exception as e:
+        logger.error(f"Error processing voice message {pk}: {e}", exc_info=True)
+        return fail(bot, job, f"{type(e).__name__}: {e}", f"❌ Error processing voice message: {e}")
+
+    # The progress message becomes the transcription, the translation is a message of its own
+    progress(bot, job, fit(transcription), final=True)
+    if translation:
+        bot.send_message(job.chat_id, fit(translation))
+    elif not bot.openai_client:
+        bot.send_message(job.chat_id, "❌ Translation service is not configured.")
+    else:
+        bot.send_message(job.chat_id, "❌ Could not translate to English. Translation service is unavailable.")
+    return job.status
+
+
+def cancel(pk: int, chat_id: str) -> bool:
+    """Cancel a job of the chat which is not finished, it stops at its next check."""
+    now = timezone.now()
+    return bool(VoiceTranscriptionJob.objects.filter(pk=pk, chat_id=chat_id, status__in=VoiceTranscriptionJob.ACTIVE)
+                .update(status=VoiceTranscriptionJob.CANCELLED, updated_at=now, finished_at=now))
+
+
+def cancel_chat(chat_id: str) -> List[VoiceTranscriptionJob]:
+    """Cancel all jobs of the chat which are not finished, returns them."""
+    active = VoiceTranscriptionJob.objects.filter(chat_id=chat_id, status__in=VoiceTranscriptionJob.ACTIVE)
+    return [job for job in active if cancel(job.pk, chat_id)]
+
+
+def recover(limit: int = 20, bot=None, inline: bool = False) -> int:
+    """
+    Start again the jobs whose process died, returns their number.
+    They are run in the pool of this process, or one after the other before recover() returns when inline is True
+    (for a process which exits afterwards, e.g. cron, its pool would hold the exit until the jobs are done).
+    """
+    now = timezone.now()
+    started = 0
+    for job in VoiceTranscriptionJob.objects.filter(status__in=VoiceTranscriptionJob.ACTIVE,
+                                                    updated_at__lt=now - LEASE).order_by('pk')[:limit]:
+        # Only when it did not change since it was read, another recover() may have taken it
+        unchanged = VoiceTranscriptionJob.objects.filter(pk=job.pk, status=job.status, updated_at=job.updated_at)
+        if job.attempts >= MAX_ATTEMPTS:
+            if unchanged.update(status=job.FAILED, error='Too many attempts', updated_at=now, finished_at=now):
+                progress(bot or outbox.bot_named('VoiceTranscriptionBot'), job, FAILED_TEXT, final=True)
+            continue
+        if not inline and not reserve():
+            break
+        if not unchanged.update(status=job.QUEUED, updated_at=now):
+            if not inline:
+                release()
+            continue
+        logger.warning(f"Voice job {job.pk} of {job.chat_id} started again (attempt {job.attempts + 1})")
+        if inline:
+            run(job.pk, bot)
+        else:
+            start(job.pk, bot)
+        started += 1
+    return started
@@ -0,0 +1,162 @@
+## Durable queue of the webhook updates (TELEGRAM_WEBHOOK_MODE = 'queue' in settings.py)
+## The webhook only checks the update, saves it as a TelegramUpdate row and answers Telegram at once.
+## The worker command reads the rows and runs the bots in a pool of threads or processes:
+## python manage.py process_telegram_updates --workers 4 --pool thread
+##
+## - The updates of one chat are processed one after the other in the order of their update_id, different chats
+##   in parallel. A chat is given to a worker as a whole, with all of its updates which are waiting.
+## - An update which raises is tried again later with an exponential backoff, the next updates of its chat wait
+##   for it. After max_attempts it is marked failed and the chat goes on.
+## - Telegram sends an update again when the webhook did not answer in time, the same update_id is saved once.
+##
+## Only one worker command should run at a time, it keeps track of the chats which are being processed.
+
+from django.db import connections
+from django.utils import timezone
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from .models import TelegramUpdate
+import logging
+import random
+import uuid
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# Backoff of the retries: 2, 4, 8, ... seconds (with jitter), never more than RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60 * 10
+# A claim older than this belongs to a worker which died, its updates are given out again
+LOCK_TIMEOUT = timedelta(minutes=15)
+# How many waiting rows one claim looks at for every chat it may hand out
+SCAN_FACTOR = 20
+# Types of update which carry a message (and so a chat)
+MESSAGE_KEYS = ['message', 'edited_message', 'channel_post', 'edited_channel_post']
+
+
+def chat_of(data: Dict[str, Any]) -> str:
+    """The chat of an update, its updates have to be processed in order."""
+    for key in MESSAGE_KEYS:
+        if key in data:
+            return str(data[key].get('chat', {}).get('id', ''))
+    if 'callback_query' in data:
+        callback_query = data['callback_query']
+        chat = callback_query.get('message', {}).get('chat', {}).get('id')
+        return str(chat if chat is not None else callback_query.get('from', {}).get('id', ''))
+    return ''
+
+
+def enqueue(secret_token: str, data: Any) -> Tuple[TelegramUpdate, bool]:
+    """Save an update of the webhook, returns (update, created). Raises ValueError for anything but an update."""
+    if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+        raise ValueError("Update without an update_id")
+    return TelegramUpdate.objects.get_or_create(
+        secret_token=secret_token, update_id=data['update_id'],
+        defaults={'chat_id': chat_of(data), 'payload': data})
+
+
+def retry_delay(attempts: int) -> float:
+    """Seconds until the next try of an update which failed this many times."""
+    delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+    # The jitter spreads the retries of updates which failed together (e.g. Telegram or OpenAI was down)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def recover_stale(keep: Optional[List[str]] = None) -> int:
+    """Give out again the updates of claims which are too old, except the claims in keep."""
+    stale = TelegramUpdate.objects.filter(status=TelegramUpdate.PROCESSING,
+                                          locked_at__lt=timezone.now() - LOCK_TIMEOUT)
+    if keep:
+        stale = stale.exclude(locked_by__in=keep)
+    count = stale.update(status=TelegramUpdate.PENDING, locked_by='', locked_at=None)
+    if count:
+        logger.warning(f"Released {count} updates of stale claims")
+    return count
+
+
+def claim_chats(limit: int, busy: Optional[set] = None) -> List[Tuple[str, Tuple[str, str]]]:
+    """
+    Claim the waiting updates of at most limit chats, returns a (claim id, (secret_token, chat_id)) per chat.
+    A chat is skipped when it is in busy ((secret_token, chat_id) pairs being processed) or when its
+    first waiting update is still in its backoff.
+    """
+    busy = busy or set()
+    now = timezone.now()
+    rows = TelegramUpdate.objects.filter(status=TelegramUpdate.PENDING).order_by('pk') \
+        .values_list('pk', 'secret_token', 'chat_id', 'available_at')[:limit * SCAN_FACTOR]
+    chats = {}
+    blocked = set(busy)
+    for pk, secret_token, chat_id, available_at in rows:
+        chat = (secret_token, chat_id)
+        if chat in blocked:
+            continue
+        if chat not in chats:
+            if available_at > now or len(chats) >= limit:
+                blocked.add(chat)
+                continue
+            chats[chat] = []
+        chats[chat].append(pk)
+
+    claims = []
+    for chat, pks in chats.items():
+        claim = uuid.uuid4().hex
+        # Only rows which are still waiting, a row is never claimed twice
+        if TelegramUpdate.objects.filter(pk__in=pks, status=TelegramUpdate.PENDING) \
+                .update(status=TelegramUpdate.PROCESSING, locked_by=claim, locked_at=now):
+            claims.append((claim, chat))
+    return claims
+
+
+def process_claim(claim: str, max_attempts: int = MAX_ATTEMPTS) -> Dict[str, int]:
+    """Run the bots for the updates of one claim (one chat) in order, returns the number of updates per outcome."""
+    # Imported here, the views enqueue the updates
+    from .views import process_update
+
+    counts = {'done': 0, 'retried': 0, 'failed': 0}
+    updates = list(TelegramUpdate.objects.filter(locked_by=claim, status=TelegramUpdate.PROCESSING)
+                   .order_by('update_id'))
+    for position, update in enumerate(updates):
+        update.attempts += 1
+        try:
+            process_update(update.secret_token, update.payload)
+        except Exception as e:
+            logger.error(f"Update {update.update_id} of '{update.secret_token}' failed "
+                         f"(attempt {update.attempts}): {e}", exc_info=True)
+            update.error = f"{type(e).__name__}: {e}"
+            update.locked_by = ''
+            update.locked_at = None
+            if update.attempts >= max_attempts:
+                update.status = TelegramUpdate.FAILED
+                update.processed_at = timezone.now()
+                update.save(update_fields=['attempts', 'error', 'status', 'locked_by', 'locked_at', 'processed_at'])
+                counts['failed'] += 1
+                continue
+            update.status = TelegramUpdate.PENDING
+            update.available_at = timezone.now() + timedelta(seconds=retry_delay(update.attempts))
+            update.save(update_fields=['attempts', 'error', 'status', 'locked_by', 'locked_at', 'available_at'])
+            counts['retried'] += 1
+            # The later updates of the chat wait for this one
+            rest = [later.pk for later in updates[position + 1:]]
+            TelegramUpdate.objects.filter(pk__in=rest).update(status=TelegramUpdate.PENDING, locked_by='', locked_at=None)
+            break
+        update.status = TelegramUpdate.DONE
+        update.processed_at = timezone.now()
+        update.error = ''
+        update.save(update_fields=['attempts', 'error', 'status', 'processed_at'])
+        counts['done'] += 1
+    return counts
+
+
+def process_claim_task(claim: str, max_attempts: int = MAX_ATTEMPTS) -> Dict[str, int]:
+    """process_claim in a thread or process of the pool, which must not keep its database connection open."""
+    try:
+        return process_claim(claim, max_attempts)
+    finally:
+        connections.close_all()
+
+
+def purge(days: int) -> int:
+    """Delete the processed updates older than days, returns their number."""
+    deleted, _ = TelegramUpdate.objects.filter(status__in=[TelegramUpdate.DONE, TelegramUpdate.FAILED],
+                                               processed_at__lt=timezone.now() - timedelta(days=days)).delete()
+    return deleted
@@ -1,10 +1,13 @@
+from django.conf import settings
 from django.http import HttpResponse
 from django.views import generic
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 import json
 import logging
-from typing import Optional
+import os
+import threading
+from typing import Optional, Dict, Any, Type
 
 from .bots.birthday_bot import BirthdayBot
 from .bots.dictionary_bot import DictionaryBot
@@ -12,6 +15,7 @@ from .bots.phrase_bot import PhraseBot
 from .bots.voice_transcription_bot import VoiceTranscriptionBot
 from .bots.dutching_bot import DutchingBot
 from .bots.base import TelegramBot
+from . import update_queue
 
 logger = logging.getLogger(__name__)
 ############################################################
@@ -37,28 +41,79 @@ logger = logging.getLogger(__name__)
 # https://api.telegram.org/bot<token>/setWebhook?url=https://www.gammaturkey.com/telegram/&secret_token=Dutching
 
 class BotFactory:
-    @staticmethod
-    def create_bot(secret_token: str) -> Optional[TelegramBot]:
-        logger.info(f"Creating bot for secret_token: '{secret_token}'")
-        
-        if secret_token == 'Birthday':
-            logger.info("Creating BirthdayBot")
-            return BirthdayBot()
-        elif secret_token == 'Phrase':
-            logger.info("Creating PhraseBot")
-            return PhraseBot()
-        elif secret_token == 'Voice':
-            logger.info("Creating VoiceTranscriptionBot")
-            return VoiceTranscriptionBot()
-        elif secret_token == 'Dutching':
-            logger.info("Creating DutchingBot")
-            return DutchingBot()
-        elif secret_token == 'Dictionary' or secret_token == '':
-            logger.info("Creating DictionaryBot (default)")
-            return DictionaryBot()
-        else:
+    # secret_token >> bot class, unknown tokens get the DictionaryBot
+    BOT_CLASSES = {
+        'Birthday': BirthdayBot,
+        'Phrase': PhraseBot,
+        'Voice': VoiceTranscriptionBot,
+        'Dutching': DutchingBot,
+        'Dictionary': DictionaryBot,
+    }
+    # Bots of this process, built on their first update and reused with their HTTP and OpenAI clients
+    _bots: Dict[Type[TelegramBot], TelegramBot] = {}
+    _bots_pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_class(cls, secret_token: str) -> Type[TelegramBot]:
+        if secret_token not in cls.BOT_CLASSES and secret_token != '':
             logger.warning(f"Unknown secret_token '{secret_token}', defaulting to DictionaryBot")
-            return DictionaryBot()
+        return cls.BOT_CLASSES.get(secret_token, DictionaryBot)
+
+    @classmethod
+    def create_bot(cls, secret_token: str) -> Optional[TelegramBot]:
+        """A new bot for the secret_token."""
+        bot_class = cls.get_class(secret_token)
+        logger.info(f"Creating {bot_class.__name__} for secret_token: '{secret_token}'")
+        return bot_class()
+
+    @classmethod
+    def get_bot(cls, secret_token: str) -> Optional[TelegramBot]:
+        """The bot for the secret_token of this process, the bots keep no state of a chat between updates."""
+        bot_class = cls.get_class(secret_token)
+        with cls._lock:
+            # A forked worker process builds its own clients
+            if cls._bots_pid != os.getpid():
+                cls._bots = {}
+                cls._bots_pid = os.getpid()
+            if bot_class not in cls._bots:
+                cls._bots[bot_class] = cls.create_bot(secret_token)
+            return cls._bots[bot_class]
+
+def process_update(secret_token: str, data: Dict[str, Any]) -> None:
+    """Run the bot of the secret_token for one update, called by the webhook or by the queue worker."""
+    # The bot of this process for the secret_token
+    bot = BotFactory.get_bot(secret_token)
+    if not bot:
+        raise ValueError(f"Invalid bot token: {secret_token}")
+
+    # Handle callback query if present
+    if 'callback_query' in data:
+        logger.info("Handling callback query")
+        bot.handle_callback_query(data['callback_query'])
+        return
+
+    # Handle regular message
+    message = data.get('message', {})
+    chat_id = str(message.get('chat', {}).get('id'))
+    user = message.get('from', {})
+    user_id = str(user.get('id'))
+    username = user.get('username', '')
+    message_text = message.get('text', '')
+
+    logger.info(f"Processing message from user {user_id} ({username}): '{message_text}'")
+    logger.info(f"Chat ID: {chat_id}")
+
+    # Handle both text and voice messages
+    response = bot.handle_command(message)
+    logger.info(f"Bot response: '{response}'")
+
+    if response:
+        logger.info(f"Sending response to chat {chat_id}")
+        send_result = bot.send_message(chat_id, response)
+        logger.info(f"Send message result: {send_result}")
+    else:
+        logger.warning("Bot returned no response")
 
 class TelegramWebhookView(generic.View):
     @method_decorator(csrf_exempt)
@@ -72,44 +127,20 @@ class TelegramWebhookView(generic.View):
             secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
             
             logger.info(f"Received webhook with secret_token: '{secret_token}'")
-            logger.info(f"Update data: {json.dumps(data, indent=2)}")
-            
-            # Create appropriate bot instance
-            bot = BotFactory.create_bot(secret_token)
-            if not bot:
-                logger.error("Invalid bot token received: %s", secret_token)
-                return HttpResponse('Invalid bot token', status=400)
-
-            # Handle callback query if present
-            if 'callback_query' in data:
-                logger.info("Handling callback query")
-                bot.handle_callback_query(data['callback_query'])
+
+            # Queue mode: save the update for the worker (update_queue.py) and answer Telegram at once
+            if getattr(settings, 'TELEGRAM_WEBHOOK_MODE', 'inline') == 'queue':
+                try:
+                    update, created = update_queue.enqueue(secret_token, data)
+                except ValueError as e:
+                    logger.error("Invalid update: %s", str(e))
+                    return HttpResponse('Invalid update', status=400)
+                if not created:
+                    logger.info(f"Update {update.update_id} is already queued")
                 return HttpResponse('Success', status=200)
 
-            # Handle regular message
-            message = data.get('message', {})
-            chat_id = str(message.get('chat', {}).get('id'))
-            user = message.get('from', {})
-            user_id = str(user.get('id'))
-            username = user.get('username', '')
-            first_name = user.get('first_name', '')
-            last_name = user.get('last_name', '')
-            message_text = message.get('text', '')
-
-            logger.info(f"Processing message from user {user_id} ({username}): '{message_text}'")
-            logger.info(f"Chat ID: {chat_id}")
-
-            # Handle both text and voice messages
-            response = bot.handle_command(message)
-            logger.info(f"Bot response: '{response}'")
-            
-            if response:
-                logger.info(f"Sending response to chat {chat_id}")
-                send_result = bot.send_message(chat_id, response)
-                logger.info(f"Send message result: {send_result}")
-            else:
-                logger.warning("Bot returned no response")
-            
+            logger.info(f"Update data: {json.dumps(data, indent=2)}")
+            process_update(secret_token, data)
             return HttpResponse('Success', status=200)
 
         except json.JSONDecodeError as e:
@@ -118,4 +149,3 @@ class TelegramWebhookView(generic.View):
         except Exception as e:
             logger.error("Unexpected error processing telegram update: %s", str(e), exc_info=True)
             return HttpResponse('Internal Server Error', status=500)
-